@@ -26,10 +26,18 @@
     http://code.google.com/p/leveldb-py/
 
     Missing still (but in progress):
-      * custom comparators, filter policies, caches
+      * custom comparators, filter policies other than bloom filters
 
     This interface requires nothing more than the leveldb shared object with
-    the C api being installed.
+    the C api being installed. The shared object is loaded the first time it
+    is needed, from the path in the LEVELDB_LIBRARY environment variable if
+    that is set (see also loadLibrary).
+
+    The C api is called through ctypes, unless the LEVELDB_BACKEND
+    environment variable is set to "cffi" (or loadLibrary is told so), which
+    needs cffi and is cheaper per call. buildCFFIModule compiles an optional
+    cffi API mode module that is faster still, which is only used when its
+    path is given in LEVELDB_CFFI_MODULE or to loadLibrary.
 
     Now requires LevelDB 1.6 or newer.
 
@@ -44,163 +52,318 @@
      * WriteBatch - this class is a standalone object. You can perform writes
             and deletes on it, but nothing happens to your database until you
             write the writebatch to the database with DB::write
+     * ShardedDB - spreads keys over several LevelDBs by hash or by range
+            and returns a single DBInterface over all of them
+     * MergedIterator - merges Iterators from several scopes, databases or
+            snapshots into one ordered Iterator
+     * Transaction - created by calls to DBInterface::transaction. Reads
+            from a snapshot and commits its writes in one batch, unless a
+            key it read has changed since
+     * ScopedWriteBatch - created by calls to DBInterface::newBatch. A write
+            batch bound to a scope, whose keys are prefixed as they are added
+     * DBPool - opens databases on demand and closes the least recently
+            used ones, for when there are too many to keep open at once
+     * IndexedDB - keeps secondary indexes over the rows of a DBInterface,
+            updated in the same write batch as the rows
+     * Counters - combines counter increments (or other associative
+            updates) in memory and writes them in periodic batches
+     * BufferedDB - buffers writes in memory and writes them to a database
+            in large batches, while reads still see them
+     * ZlibCodec - compresses values with zlib and trained preset
+            dictionaries (see trainDictionary), for DB or a scope
+     * InfoLog - follows a database's LOG file and reports memtable
+            flushes, compactions and write stalls as LogEvents
+     * DBServer - serves an open database to other processes over a Unix
+            domain socket. Connect to it with RemoteDB, which returns a
+            DBInterface
 """
 
 __author__ = "JT Olds"
 __email__ = "jt@spacemonkey.com"
 
+import os
+import sys
+import re
+import zlib
+import stat
+import time
+import math
+import Queue
+import heapq
+import imp
+import itertools
+import operator
+import base64
 import bisect
 import ctypes
 import ctypes.util
+import socket
+import struct
 import weakref
+import functools
 import threading
-from collections import namedtuple
-
-_ldb = ctypes.CDLL(ctypes.util.find_library('leveldb'))
-
-_ldb.leveldb_filterpolicy_create_bloom.argtypes = [ctypes.c_int]
-_ldb.leveldb_filterpolicy_create_bloom.restype = ctypes.c_void_p
-_ldb.leveldb_filterpolicy_destroy.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_filterpolicy_destroy.restype = None
-_ldb.leveldb_cache_create_lru.argtypes = [ctypes.c_size_t]
-_ldb.leveldb_cache_create_lru.restype = ctypes.c_void_p
-_ldb.leveldb_cache_destroy.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_cache_destroy.restype = None
-
-_ldb.leveldb_options_create.argtypes = []
-_ldb.leveldb_options_create.restype = ctypes.c_void_p
-_ldb.leveldb_options_set_filter_policy.argtypes = [ctypes.c_void_p,
-        ctypes.c_void_p]
-_ldb.leveldb_options_set_filter_policy.restype = None
-_ldb.leveldb_options_set_create_if_missing.argtypes = [ctypes.c_void_p,
-        ctypes.c_ubyte]
-_ldb.leveldb_options_set_create_if_missing.restype = None
-_ldb.leveldb_options_set_error_if_exists.argtypes = [ctypes.c_void_p,
-        ctypes.c_ubyte]
-_ldb.leveldb_options_set_error_if_exists.restype = None
-_ldb.leveldb_options_set_paranoid_checks.argtypes = [ctypes.c_void_p,
-        ctypes.c_ubyte]
-_ldb.leveldb_options_set_paranoid_checks.restype = None
-_ldb.leveldb_options_set_write_buffer_size.argtypes = [ctypes.c_void_p,
-        ctypes.c_size_t]
-_ldb.leveldb_options_set_write_buffer_size.restype = None
-_ldb.leveldb_options_set_max_open_files.argtypes = [ctypes.c_void_p,
-        ctypes.c_int]
-_ldb.leveldb_options_set_max_open_files.restype = None
-_ldb.leveldb_options_set_cache.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
-_ldb.leveldb_options_set_cache.restype = None
-_ldb.leveldb_options_set_block_size.argtypes = [ctypes.c_void_p,
-        ctypes.c_size_t]
-_ldb.leveldb_options_set_block_size.restype = None
-_ldb.leveldb_options_destroy.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_options_destroy.restype = None
-
-_ldb.leveldb_open.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
-        ctypes.c_void_p]
-_ldb.leveldb_open.restype = ctypes.c_void_p
-_ldb.leveldb_close.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_close.restype = None
-_ldb.leveldb_put.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t,
-        ctypes.c_void_p]
-_ldb.leveldb_put.restype = None
-_ldb.leveldb_delete.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
-_ldb.leveldb_delete.restype = None
-_ldb.leveldb_write.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_void_p, ctypes.c_void_p]
-_ldb.leveldb_write.restype = None
-_ldb.leveldb_get.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_void_p]
-_ldb.leveldb_get.restype = ctypes.POINTER(ctypes.c_char)
-
-_ldb.leveldb_writeoptions_create.argtypes = []
-_ldb.leveldb_writeoptions_create.restype = ctypes.c_void_p
-_ldb.leveldb_writeoptions_destroy.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_writeoptions_destroy.restype = None
-_ldb.leveldb_writeoptions_set_sync.argtypes = [ctypes.c_void_p,
-        ctypes.c_ubyte]
-_ldb.leveldb_writeoptions_set_sync.restype = None
-
-_ldb.leveldb_readoptions_create.argtypes = []
-_ldb.leveldb_readoptions_create.restype = ctypes.c_void_p
-_ldb.leveldb_readoptions_destroy.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_readoptions_destroy.restype = None
-_ldb.leveldb_readoptions_set_verify_checksums.argtypes = [ctypes.c_void_p,
-        ctypes.c_ubyte]
-_ldb.leveldb_readoptions_set_verify_checksums.restype = None
-_ldb.leveldb_readoptions_set_fill_cache.argtypes = [ctypes.c_void_p,
-        ctypes.c_ubyte]
-_ldb.leveldb_readoptions_set_fill_cache.restype = None
-_ldb.leveldb_readoptions_set_snapshot.argtypes = [ctypes.c_void_p,
-        ctypes.c_void_p]
-_ldb.leveldb_readoptions_set_snapshot.restype = None
-
-_ldb.leveldb_create_iterator.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
-_ldb.leveldb_create_iterator.restype = ctypes.c_void_p
-_ldb.leveldb_iter_destroy.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_iter_destroy.restype = None
-_ldb.leveldb_iter_valid.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_iter_valid.restype = ctypes.c_bool
-_ldb.leveldb_iter_key.argtypes = [ctypes.c_void_p,
-        ctypes.POINTER(ctypes.c_size_t)]
-_ldb.leveldb_iter_key.restype = ctypes.c_void_p
-_ldb.leveldb_iter_value.argtypes = [ctypes.c_void_p,
-        ctypes.POINTER(ctypes.c_size_t)]
-_ldb.leveldb_iter_value.restype = ctypes.c_void_p
-_ldb.leveldb_iter_next.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_iter_next.restype = None
-_ldb.leveldb_iter_prev.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_iter_prev.restype = None
-_ldb.leveldb_iter_seek_to_first.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_iter_seek_to_first.restype = None
-_ldb.leveldb_iter_seek_to_last.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_iter_seek_to_last.restype = None
-_ldb.leveldb_iter_seek.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_size_t]
-_ldb.leveldb_iter_seek.restype = None
-_ldb.leveldb_iter_get_error.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
-_ldb.leveldb_iter_get_error.restype = None
-
-_ldb.leveldb_writebatch_create.argtypes = []
-_ldb.leveldb_writebatch_create.restype = ctypes.c_void_p
-_ldb.leveldb_writebatch_destroy.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_writebatch_destroy.restype = None
-_ldb.leveldb_writebatch_clear.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_writebatch_clear.restype = None
-
-_ldb.leveldb_writebatch_put.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t]
-_ldb.leveldb_writebatch_put.restype = None
-_ldb.leveldb_writebatch_delete.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_size_t]
-_ldb.leveldb_writebatch_delete.restype = None
-
-_ldb.leveldb_approximate_sizes.argtypes = [ctypes.c_void_p, ctypes.c_int,
-        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_void_p]
-_ldb.leveldb_approximate_sizes.restype = None
-
-_ldb.leveldb_compact_range.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
-        ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t]
-_ldb.leveldb_compact_range.restype = None
-
-_ldb.leveldb_create_snapshot.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_create_snapshot.restype = ctypes.c_void_p
-_ldb.leveldb_release_snapshot.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
-_ldb.leveldb_release_snapshot.restype = None
-
-_ldb.leveldb_free.argtypes = [ctypes.c_void_p]
-_ldb.leveldb_free.restype = None
+import SocketServer
+from collections import namedtuple, OrderedDict
+
+_SIGNATURES = {
+    "leveldb_filterpolicy_create_bloom": (
+            [ctypes.c_int], ctypes.c_void_p),
+    "leveldb_filterpolicy_destroy": (
+            [ctypes.c_void_p], None),
+    "leveldb_cache_create_lru": (
+            [ctypes.c_size_t], ctypes.c_void_p),
+    "leveldb_cache_destroy": (
+            [ctypes.c_void_p], None),
+
+    "leveldb_options_create": ([], ctypes.c_void_p),
+    "leveldb_options_set_filter_policy": (
+            [ctypes.c_void_p, ctypes.c_void_p], None),
+    "leveldb_options_set_create_if_missing": (
+            [ctypes.c_void_p, ctypes.c_ubyte], None),
+    "leveldb_options_set_error_if_exists": (
+            [ctypes.c_void_p, ctypes.c_ubyte], None),
+    "leveldb_options_set_paranoid_checks": (
+            [ctypes.c_void_p, ctypes.c_ubyte], None),
+    "leveldb_options_set_write_buffer_size": (
+            [ctypes.c_void_p, ctypes.c_size_t], None),
+    "leveldb_options_set_max_open_files": (
+            [ctypes.c_void_p, ctypes.c_int], None),
+    "leveldb_options_set_cache": (
+            [ctypes.c_void_p, ctypes.c_void_p], None),
+    "leveldb_options_set_block_size": (
+            [ctypes.c_void_p, ctypes.c_size_t], None),
+    "leveldb_options_destroy": (
+            [ctypes.c_void_p], None),
+
+    "leveldb_open": (
+            [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p],
+            ctypes.c_void_p),
+    "leveldb_close": (
+            [ctypes.c_void_p], None),
+    "leveldb_put": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p],
+            None),
+    "leveldb_delete": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_void_p], None),
+    "leveldb_write": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+            ctypes.c_void_p], None),
+    "leveldb_get": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_void_p, ctypes.c_void_p],
+            ctypes.POINTER(ctypes.c_char)),
+
+    "leveldb_writeoptions_create": ([], ctypes.c_void_p),
+    "leveldb_writeoptions_destroy": (
+            [ctypes.c_void_p], None),
+    "leveldb_writeoptions_set_sync": (
+            [ctypes.c_void_p, ctypes.c_ubyte], None),
+
+    "leveldb_readoptions_create": ([], ctypes.c_void_p),
+    "leveldb_readoptions_destroy": (
+            [ctypes.c_void_p], None),
+    "leveldb_readoptions_set_verify_checksums": (
+            [ctypes.c_void_p, ctypes.c_ubyte], None),
+    "leveldb_readoptions_set_fill_cache": (
+            [ctypes.c_void_p, ctypes.c_ubyte], None),
+    "leveldb_readoptions_set_snapshot": (
+            [ctypes.c_void_p, ctypes.c_void_p], None),
+
+    "leveldb_create_iterator": (
+            [ctypes.c_void_p, ctypes.c_void_p], ctypes.c_void_p),
+    "leveldb_iter_destroy": (
+            [ctypes.c_void_p], None),
+    "leveldb_iter_valid": (
+            [ctypes.c_void_p], ctypes.c_bool),
+    "leveldb_iter_key": (
+            [ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t)],
+            ctypes.c_void_p),
+    "leveldb_iter_value": (
+            [ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t)],
+            ctypes.c_void_p),
+    "leveldb_iter_next": (
+            [ctypes.c_void_p], None),
+    "leveldb_iter_prev": (
+            [ctypes.c_void_p], None),
+    "leveldb_iter_seek_to_first": (
+            [ctypes.c_void_p], None),
+    "leveldb_iter_seek_to_last": (
+            [ctypes.c_void_p], None),
+    "leveldb_iter_seek": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t], None),
+    "leveldb_iter_get_error": (
+            [ctypes.c_void_p, ctypes.c_void_p], None),
+
+    "leveldb_writebatch_create": ([], ctypes.c_void_p),
+    "leveldb_writebatch_destroy": (
+            [ctypes.c_void_p], None),
+    "leveldb_writebatch_clear": (
+            [ctypes.c_void_p], None),
+
+    "leveldb_writebatch_put": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t,
+            ctypes.c_void_p, ctypes.c_size_t], None),
+    "leveldb_writebatch_delete": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t], None),
+
+    "leveldb_approximate_sizes": (
+            [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p,
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p], None),
+
+    "leveldb_compact_range": (
+            [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t,
+            ctypes.c_void_p, ctypes.c_size_t], None),
+
+    "leveldb_create_snapshot": (
+            [ctypes.c_void_p], ctypes.c_void_p),
+    "leveldb_release_snapshot": (
+            [ctypes.c_void_p, ctypes.c_void_p], None),
+
+    "leveldb_free": (
+            [ctypes.c_void_p], None),
+}
+
+
+def _libraryPath(path=None):
+    if path is None:
+        path = os.environ.get("LEVELDB_LIBRARY")
+    if path is None:
+        path = ctypes.util.find_library("leveldb")
+    if path is None:
+        raise Error("cannot find the leveldb shared library. set "
+                    "LEVELDB_LIBRARY or call leveldb.loadLibrary")
+    return path
+
+
+class _Library(object):
+
+    """LevelDB's C API, bound lazily. The shared library is only looked up
+    and loaded when the first function is used, and each function is only
+    given its signature the first time it is used. After that, the function
+    is cached as an attribute.
+    """
+
+    def __init__(self, signatures):
+        self._signatures = signatures
+        self._lock = threading.Lock()
+        self._lib = None
+
+    def load(self, path=None):
+        with self._lock:
+            if self._lib is None:
+                self._lib = ctypes.CDLL(_libraryPath(path))
+            return self._lib
+
+    def __getattr__(self, name):
+        try:
+            argtypes, restype = self._signatures[name]
+        except KeyError:
+            raise AttributeError(name)
+        func = getattr(self.load(), name)
+        func.argtypes = argtypes
+        func.restype = restype
+        setattr(self, name, func)
+        return func
+
+
+_ldb = _Library(_SIGNATURES)
+
+
+def loadLibrary(path=None, backend=None, cffi_module=None):
+    """Loads the LevelDB shared library right away, instead of when it is
+    first needed. If path is None, the LEVELDB_LIBRARY environment variable
+    is used if set, and otherwise the library is searched for.
+
+    backend picks how the library is called: "ctypes" or "cffi". By default,
+    the LEVELDB_BACKEND environment variable decides, and otherwise it is
+    ctypes. For cffi, cffi_module (by default, the LEVELDB_CFFI_MODULE
+    environment variable) is the path of a module built by buildCFFIModule
+    to use instead of loading the library in ABI mode. Has no effect once
+    the library is loaded.
+    """
+    _backend.select(backend, path, cffi_module)
 
 
 Row = namedtuple('Row', 'key value')
+Estimate = namedtuple('Estimate', 'value low high')
+Page = namedtuple('Page', 'rows token')
+Splits = namedtuple('Splits', 'keys sizes counts')
+LogEvent = namedtuple('LogEvent',
+                      'kind time duration level bytes keys message')
 
 
 class Error(Exception):
     pass
 
 
+class TransactionConflict(Error):
+
+    """Raised when a Transaction can't commit because a key it read has
+    changed since."""
+
+
+def _nextPrefix(prefix):
+    """Returns the smallest key that sorts after every key starting with
+    prefix, or None if there is no such key."""
+    prefix = prefix.rstrip("\xff")
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _toBytes(data):
+    """Copies data, which may be any buffer, into a str. Only needed where
+    keys or values are kept or compared, as the C API takes any buffer."""
+    if isinstance(data, str):
+        return data
+    if isinstance(data, unicode):
+        raise TypeError("keys and values must be bytes, not unicode")
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(buffer(data))
+
+
+class _KeyBuffer(object):
+
+    """A reusable buffer for prefixing keys that aren't strs. Concatenating
+    would copy such a key twice, first into a str and then into the result.
+    """
+
+    __slots__ = ["_buf"]
+
+    def __init__(self):
+        self._buf = bytearray(64)
+
+    def join(self, prefix, key):
+        """Returns prefix + key as a view of this buffer, which is only good
+        until the next call"""
+        start, end = len(prefix), len(prefix) + len(key)
+        if end > len(self._buf):
+            self._buf = bytearray(max(end, 2 * len(self._buf)))
+        buf = self._buf
+        buf[:start] = prefix
+        buf[start:end] = key
+        return buffer(buf, 0, end)
+
+
+_key_buffers = threading.local()
+
+
+def _joinKey(prefix, key):
+    """Returns prefix + key, without copying key if it is a buffer. The
+    result may only be passed straight to an implementation, as it is reused
+    by the next call from the same thread."""
+    if isinstance(key, str):
+        return prefix + key
+    try:
+        key_buffer = _key_buffers.key_buffer
+    except AttributeError:
+        key_buffer = _key_buffers.key_buffer = _KeyBuffer()
+    return key_buffer.join(prefix, key)
+
+
 class Iterator(object):
 
     """This class is created by calling __iter__ or iterator on a DB interface
@@ -246,16 +409,14 @@ class Iterator(object):
         """
         # if we have no prefix or the last possible prefix of this length, just
         # seek to the last key in the db.
-        if self._prefix is None or self._prefix == "\xff" * len(self._prefix):
+        next_prefix = None
+        if self._prefix is not None:
+            next_prefix = _nextPrefix(self._prefix)
+        if next_prefix is None:
             self._impl.seekLast()
             return self
 
         # we have a prefix. see if there's anything after our prefix.
-        # there's probably a much better way to calculate the next prefix.
-        hex_prefix = self._prefix.encode('hex')
-        next_prefix = hex(long(hex_prefix, 16) + 1)[2:].rstrip("L")
-        next_prefix = next_prefix.rjust(len(hex_prefix), "0")
-        next_prefix = next_prefix.decode("hex").rstrip("\x00")
         self._impl.seek(next_prefix)
         if self._impl.valid():
             # there is something after our prefix. we're on it, so step back
@@ -276,7 +437,7 @@ class Iterator(object):
         @rtype: Iter
         """
         if self._prefix is not None:
-            key = self._prefix + key
+            key = _joinKey(self._prefix, key)
         self._impl.seek(key)
         return self
 
@@ -299,6 +460,34 @@ class Iterator(object):
         """
         return self._impl.val()
 
+    def item(self):
+        """Returns the iterator's current key and value together, which is
+        cheaper than calling key() and value(). You should be sure the
+        iterator is currently valid first by calling valid()
+
+        @rtype: Row (namedtuple of key, value)
+        """
+        key, val = self._impl.item()
+        if self._prefix is not None:
+            key = key[len(self._prefix):]
+        return Row(key, val)
+
+    def _current(self):
+        # fetches the key and value together, checking the prefix once
+        if not self._impl.valid():
+            raise StopIteration()
+        if self._keys_only:
+            key = self._impl.key()
+        else:
+            key, val = self._impl.item()
+        if self._prefix is not None:
+            if key[:len(self._prefix)] != self._prefix:
+                raise StopIteration()
+            key = key[len(self._prefix):]
+        if self._keys_only:
+            return key
+        return Row(key, val)
+
     def __iter__(self):
         return self
 
@@ -311,12 +500,7 @@ class Iterator(object):
 
         @raise StopIteration: if called on an iterator that is not valid
         """
-        if not self.valid():
-            raise StopIteration()
-        if self._keys_only:
-            rv = self.key()
-        else:
-            rv = Row(self.key(), self.value())
+        rv = self._current()
         self._impl.next()
         return rv
 
@@ -329,12 +513,7 @@ class Iterator(object):
 
         @raise StopIteration: if called on an iterator that is not valid
         """
-        if not self.valid():
-            raise StopIteration()
-        if self._keys_only:
-            rv = self.key()
-        else:
-            rv = Row(self.key(), self.value())
+        rv = self._current()
         self._impl.prev()
         return rv
 
@@ -391,10 +570,52 @@ class _OpaqueWriteBatch(object):
         self._deletes = set()
 
 
+class ScopedWriteBatch(_OpaqueWriteBatch):
+
+    """This class is created by calling newBatch on a DBInterface, and is
+    bound to that DBInterface's scope. Keys are prefixed once, as they are
+    added, so the batch can be written through any DBInterface on the same
+    database without being copied.
+
+    Calling scope on a batch returns a view, bound to a nested scope, that
+    adds to the same batch. This way one batch can hold writes for several
+    scopes.
+    """
+
+    def __init__(self, prefix=None):
+        _OpaqueWriteBatch.__init__(self)
+        self._prefix = prefix or ""
+
+    def clear(self):
+        # views share these with each other, so they are emptied in place
+        self._puts.clear()
+        self._deletes.clear()
+
+    def scope(self, prefix):
+        view = ScopedWriteBatch(self._prefix + prefix)
+        view._puts = self._puts
+        view._deletes = self._deletes
+        return view
+
+    def put(self, key, val):
+        key = self._prefix + _toBytes(key)
+        self._deletes.discard(key)
+        self._puts[key] = val
+
+    def delete(self, key):
+        key = self._prefix + _toBytes(key)
+        self._puts.pop(key, None)
+        self._deletes.add(key)
+
+
 class WriteBatch(_OpaqueWriteBatch):
 
     """This class is created stand-alone, but then written to some existing
     DBInterface
+
+    Values may be any buffer, such as a bytearray or memoryview, and are not
+    copied until the batch is written, so they must not be changed before
+    then.
     """
 
     def __init__(self):
@@ -402,10 +623,12 @@ class WriteBatch(_OpaqueWriteBatch):
         self._private = False
 
     def put(self, key, val):
+        key = _toBytes(key)
         self._deletes.discard(key)
         self._puts[key] = val
 
     def delete(self, key):
+        key = _toBytes(key)
         self._puts.pop(key, None)
         self._deletes.add(key)
 
@@ -445,19 +668,25 @@ class DBInterface(object):
             self._impl.close()
 
     def newBatch(self):
-        return _OpaqueWriteBatch()
+        """Returns a new write batch bound to this scope. See
+        ScopedWriteBatch.
+
+        @rtype: ScopedWriteBatch
+        """
+        return ScopedWriteBatch(self._prefix)
 
     def put(self, key, val, sync=None):
         if sync is None:
             sync = self._default_sync
         if self._prefix is not None:
-            key = self._prefix + key
+            key = _joinKey(self._prefix, key)
         self._impl.put(key, val, sync=sync)
 
     # pylint: disable=W0212
     def putTo(self, batch, key, val):
         if not batch._private:
             raise ValueError("batch not from DBInterface.newBatch")
+        key = _toBytes(key)
         if self._prefix is not None:
             key = self._prefix + key
         batch._deletes.discard(key)
@@ -467,13 +696,14 @@ class DBInterface(object):
         if sync is None:
             sync = self._default_sync
         if self._prefix is not None:
-            key = self._prefix + key
+            key = _joinKey(self._prefix, key)
         self._impl.delete(key, sync=sync)
 
     # pylint: disable=W0212
     def deleteFrom(self, batch, key):
         if not batch._private:
             raise ValueError("batch not from DBInterface.newBatch")
+        key = _toBytes(key)
         if self._prefix is not None:
             key = self._prefix + key
         batch._puts.pop(key, None)
@@ -485,10 +715,23 @@ class DBInterface(object):
         if fill_cache is None:
             fill_cache = self._default_fill_cache
         if self._prefix is not None:
-            key = self._prefix + key
+            key = _joinKey(self._prefix, key)
         return self._impl.get(key, verify_checksums=verify_checksums,
                 fill_cache=fill_cache)
 
+    def getMany(self, keys, verify_checksums=None, fill_cache=None):
+        """Looks up several keys at once. Returns a list of values in the same
+        order as keys, with None for keys that are missing.
+        """
+        if verify_checksums is None:
+            verify_checksums = self._default_verify_checksums
+        if fill_cache is None:
+            fill_cache = self._default_fill_cache
+        if self._prefix is not None:
+            keys = [self._prefix + _toBytes(key) for key in keys]
+        return self._impl.getMany(keys, verify_checksums=verify_checksums,
+                fill_cache=fill_cache)
+
     # pylint: disable=W0212
     def write(self, batch, sync=None):
         if sync is None:
@@ -503,7 +746,17 @@ class DBInterface(object):
         return self._impl.write(batch, sync=sync)
 
     def iterator(self, verify_checksums=None, fill_cache=None, prefix=None,
-                 keys_only=False):
+                 keys_only=False, readahead=None, readahead_chunks=2):
+        """Returns an Iterator over this scope, or only over the keys
+        starting with prefix.
+
+        If readahead is given, a background thread reads rows readahead at
+        a time ahead of the consumer, keeping up to readahead_chunks chunks
+        queued, so reading overlaps with processing the rows. Only forward
+        iteration is read ahead. With keys_only, values aren't read at all.
+
+        @rtype: Iterator
+        """
         if verify_checksums is None:
             verify_checksums = self._default_verify_checksums
         if fill_cache is None:
@@ -513,13 +766,150 @@ class DBInterface(object):
                 prefix = self._prefix
             else:
                 prefix = self._prefix + prefix
-        return Iterator(
-                self._impl.iterator(verify_checksums=verify_checksums,
-                                    fill_cache=fill_cache),
-                keys_only=keys_only, prefix=prefix)
+        impl = self._impl.iterator(verify_checksums=verify_checksums,
+                                   fill_cache=fill_cache)
+        if readahead is not None:
+            reader = _ReadaheadReader(impl, readahead_chunks, keys_only)
+            impl = _ChunkedIteratorImpl(reader.read, reader.close, readahead)
+        return Iterator(impl, keys_only=keys_only, prefix=prefix)
+
+    def update(self, key, fn, sync=None):
+        """Replaces the value of key with fn(value), where value is None if
+        key is missing, and returns the new value. If fn returns None, key is
+        deleted. See updateMany.
+        """
+        if isinstance(_baseImpl(self._impl)[0], _RemoteDBImpl):
+            return self.updateMany([key], fn, sync=sync)[0]
+        if sync is None:
+            sync = self._default_sync
+        key = _toBytes(key)
+        if self._prefix is not None:
+            key = self._prefix + key
+        key_locks = _keyLocks(self._impl)
+        locks = key_locks.acquire([key])
+        try:
+            val = fn(self._impl.get(key,
+                    verify_checksums=self._default_verify_checksums,
+                    fill_cache=self._default_fill_cache))
+            if val is None:
+                self._impl.delete(key, sync=sync)
+            else:
+                self._impl.put(key, val, sync=sync)
+            key_locks.written([key])
+        finally:
+            key_locks.release(locks)
+        return val
+
+    # pylint: disable=W0212
+    def updateMany(self, keys, fn, sync=None):
+        """Replaces the value of each of keys with fn(value), like update,
+        reading them all with one getMany and writing them all in one batch.
+        Returns the new values in the same order as keys.
+
+        Updates lock the keys they touch for as long as they run, using one
+        of a fixed set of locks per database picked by a hash of the key, so
+        updates and transaction commits on the same key (through any scope)
+        take turns while most updates to other keys run at once. fn must not
+        update other keys itself. Only updates and commits are locked out;
+        plain puts and deletes are not.
+
+        On a RemoteDB, which other processes share, updates don't lock.
+        Instead the server writes them only if the keys haven't changed
+        since they were read, and they start over otherwise, so fn may be
+        called more than once.
+        """
+        if sync is None:
+            sync = self._default_sync
+        keys = [_toBytes(key) for key in keys]
+        if self._prefix is not None:
+            keys = [self._prefix + key for key in keys]
+        results = []
+
+        def build(values):
+            values = dict(itertools.izip(keys, values))
+            del results[:]
+            for key in keys:
+                values[key] = fn(values[key])
+                results.append(values[key])
+            batch = _OpaqueWriteBatch()
+            for key, val in values.iteritems():
+                if val is None:
+                    batch._deletes.add(key)
+                else:
+                    batch._puts[key] = val
+            return batch
+
+        self._rewrite(keys, build, sync)
+        return results
+
+    # pylint: disable=W0212
+    def _rewrite(self, keys, build, sync):
+        """Reads the (unscoped) keys and writes the batch that build returns
+        for their values, without letting an update or transaction commit of
+        any of the keys in between."""
+        impl, codecs = _baseImpl(self._impl)
+        if isinstance(impl, _RemoteDBImpl):
+            # the server compares the stored bytes, so values are read from
+            # under the codec, and buffered writes go out first.
+            self.flush(sync=False)
+            while True:
+                version = impl.version()
+                data = impl.getMany(keys,
+                        verify_checksums=self._default_verify_checksums,
+                        fill_cache=self._default_fill_cache)
+                batch = build([_decodeValue(codecs, stored)
+                               for stored in data])
+                try:
+                    _commitBatch(self._impl, version,
+                                 dict(itertools.izip(keys, data)), batch,
+                                 sync)
+                    return
+                except TransactionConflict:
+                    pass
+        impl = self._impl
+        key_locks = _keyLocks(impl)
+        locks = key_locks.acquire(keys)
+        try:
+            impl.write(build(impl.getMany(keys,
+                    verify_checksums=self._default_verify_checksums,
+                    fill_cache=self._default_fill_cache)), sync=sync)
+            key_locks.written(keys)
+        finally:
+            key_locks.release(locks)
+
+    def transaction(self):
+        """Starts a transaction over this scope. See Transaction.
+
+        @rtype: Transaction
+        """
+        return Transaction(self)
+
+    def transact(self, func, retries=10, sync=None):
+        """Calls func with a new transaction and commits it, starting over
+        with another one if it conflicts, up to retries more times. Returns
+        what func returned. func may be called several times, so it should
+        not have side effects outside the transaction.
+        """
+        for attempt in itertools.count():
+            txn = self.transaction()
+            try:
+                result = func(txn)
+                txn.commit(sync=sync)
+                return result
+            except TransactionConflict:
+                if attempt >= retries:
+                    raise
+            finally:
+                txn.abort()
 
     def snapshot(self, default_sync=None, default_verify_checksums=None,
                  default_fill_cache=None):
+        """Returns a read-only DBInterface over the database as it is now.
+        The snapshot is released when it is closed (or garbage collected),
+        which does not close the database.
+
+        @rtype: DBInterface
+        """
         if default_sync is None:
             default_sync = self._default_sync
         if default_verify_checksums is None:
@@ -527,7 +917,7 @@ class DBInterface(object):
         if default_fill_cache is None:
             default_fill_cache = self._default_fill_cache
         return DBInterface(self._impl.snapshot(), prefix=self._prefix,
-                allow_close=False, default_sync=default_sync,
+                allow_close=True, default_sync=default_sync,
                 default_verify_checksums=default_verify_checksums,
                 default_fill_cache=default_fill_cache)
 
@@ -553,8 +943,15 @@ class DBInterface(object):
         return self.get(key, verify_checksums=verify_checksums,
                 fill_cache=fill_cache) is not None
 
+    # pylint: disable=W0212
     def scope(self, prefix, default_sync=None, default_verify_checksums=None,
-                 default_fill_cache=None):
+                 default_fill_cache=None, value_codec=None):
+        """Returns a DBInterface over the keys starting with prefix, with the
+        prefix stripped. If value_codec is given, values in the scope are
+        encoded with it instead of this scope's codec, if any.
+
+        @rtype: DBInterface
+        """
         if default_sync is None:
             default_sync = self._default_sync
         if default_verify_checksums is None:
@@ -563,7 +960,12 @@ class DBInterface(object):
             default_fill_cache = self._default_fill_cache
         if self._prefix is not None:
             prefix = self._prefix + prefix
-        return DBInterface(self._impl, prefix=prefix, allow_close=False,
+        impl = self._impl
+        if value_codec is not None:
+            if isinstance(impl, _CodecDBImpl):
+                impl = impl._impl
+            impl = _CodecDBImpl(impl, value_codec)
+        return DBInterface(impl, prefix=prefix, allow_close=False,
                 default_sync=default_sync,
                 default_verify_checksums=default_verify_checksums,
                 default_fill_cache=default_fill_cache)
@@ -574,34 +976,1381 @@ class DBInterface(object):
             verify_checksums = self._default_verify_checksums
         if fill_cache is None:
             fill_cache = self._default_fill_cache
-        return self.iterator(verify_checksums=verify_checksums,
-                fill_cache=fill_cache).range(start_key=start_key,
-                        end_key=end_key, start_inclusive=start_inclusive,
-                        end_inclusive=end_inclusive)
+        it = self.iterator(verify_checksums=verify_checksums,
+                fill_cache=fill_cache)
+        return _closing(it, it.range(start_key=start_key, end_key=end_key,
+                start_inclusive=start_inclusive, end_inclusive=end_inclusive))
 
     def keys(self, verify_checksums=None, fill_cache=None, prefix=None):
         if verify_checksums is None:
             verify_checksums = self._default_verify_checksums
         if fill_cache is None:
             fill_cache = self._default_fill_cache
-        return self.iterator(verify_checksums=verify_checksums,
-                fill_cache=fill_cache, prefix=prefix).seekFirst().keys()
+        it = self.iterator(verify_checksums=verify_checksums,
+                fill_cache=fill_cache, prefix=prefix)
+        return _closing(it, it.seekFirst().keys())
 
     def values(self, verify_checksums=None, fill_cache=None, prefix=None):
         if verify_checksums is None:
             verify_checksums = self._default_verify_checksums
         if fill_cache is None:
             fill_cache = self._default_fill_cache
-        return self.iterator(verify_checksums=verify_checksums,
-                fill_cache=fill_cache, prefix=prefix).seekFirst().values()
+        it = self.iterator(verify_checksums=verify_checksums,
+                fill_cache=fill_cache, prefix=prefix)
+        return _closing(it, it.seekFirst().values())
+
+    # pylint: disable=W0212
+    def deleteRange(self, start_key=None, end_key=None, sync=None,
+                    batch_bytes=(1024 * 1024), compact=False, progress=None):
+        """Deletes every key from start_key (inclusive) to end_key
+        (exclusive). Missing endpoints mean the start or end of the database
+        (or scope).
+
+        Keys are read from a snapshot and deleted in write batches of roughly
+        batch_bytes worth of keys each. After each batch, progress (if given)
+        is called with the number of keys deleted so far. The chunks of blobs
+        stored in the range by putStream are deleted along with them (but
+        not counted). If compact is true, the range is compacted afterwards,
+        so the deletion markers left behind don't slow down later reads of
+        the range.
+
+        @return: the number of keys deleted
+        @rtype: int
+        """
+        if sync is None:
+            sync = self._default_sync
+        start_key, end_key = self._rawRange(start_key, end_key)
+        snapshot = self._impl.snapshot()
+        it = snapshot.iterator(fill_cache=False)
+        try:
+            if start_key is None:
+                it.seekFirst()
+            else:
+                it.seek(start_key)
+            batch, size, count, deleted = _OpaqueWriteBatch(), 0, 0, 0
+            while it.valid():
+                key = it.key()
+                if end_key is not None and key >= end_key:
+                    break
+                batch._deletes.add(key)
+                size += len(key)
+                count += 1
+                val = it.val()
+                if val.startswith(_BLOB_MAGIC):
+                    _deleteBlobChunks(batch, val)
+                if size >= batch_bytes:
+                    self._impl.write(batch, sync=sync)
+                    deleted += count
+                    batch, size, count = _OpaqueWriteBatch(), 0, 0
+                    if progress is not None:
+                        progress(deleted)
+                it.next()
+            if batch._deletes:
+                self._impl.write(batch, sync=sync)
+                deleted += count
+                if progress is not None:
+                    progress(deleted)
+        finally:
+            it.close()
+            snapshot.close()
+        if compact:
+            self._impl.compactRange(start_key, end_key)
+        return deleted
+
+    def deletePrefix(self, prefix, **kwargs):
+        """Deletes every key starting with prefix. Takes the same keyword
+        arguments as deleteRange.
+
+        @return: the number of keys deleted
+        @rtype: int
+        """
+        return self.scope(prefix).deleteRange(**kwargs)
+
+    def _rawRange(self, start_key, end_key):
+        """Translates a range of keys in this scope into a range of keys in
+        the underlying database. None means the start or end of the scope
+        (or database)."""
+        if self._prefix is None:
+            return start_key, end_key
+        if start_key is None:
+            start_key = self._prefix
+        else:
+            start_key = self._prefix + start_key
+        if end_key is None:
+            end_key = _nextPrefix(self._prefix)
+        else:
+            end_key = self._prefix + end_key
+        return start_key, end_key
+
+    def page(self, start_after=None, limit=100, prefix=None, reverse=False,
+             verify_checksums=None, fill_cache=None):
+        """Returns up to limit rows, in key order (reverse key order if
+        reverse is true), starting with the first key (last key, if reverse)
+        in the scope or the given prefix.
+
+        Along with the rows comes an opaque token, or None if there are no
+        more rows. Passing the token back as start_after returns the next
+        page, starting right after the last row of this one, with a single
+        seek. The token is only good for the same scope, prefix and
+        direction.
+
+        @rtype: Page (namedtuple of rows, token)
+        """
+        scope = (self._prefix or "") + (prefix or "")
+        it = self.iterator(verify_checksums=verify_checksums,
+                           fill_cache=fill_cache, prefix=prefix)
+        try:
+            if start_after is None:
+                if reverse:
+                    it.seekLast()
+                else:
+                    it.seekFirst()
+            else:
+                last_key = _decodePageToken(start_after, scope, reverse)
+                it.seek(last_key)
+                if reverse:
+                    if it.valid():
+                        it.stepBackward()
+                    else:
+                        it.seekLast()
+                elif it.valid() and it.key() == last_key:
+                    it.stepForward()
+            step = it.prev if reverse else it.next
+            rows = []
+            while len(rows) < limit and it.valid():
+                rows.append(step())
+            token = None
+            if rows and it.valid():
+                token = _encodePageToken(scope, rows[-1].key, reverse)
+        finally:
+            it.close()
+        return Page(rows, token)
+
+    def toArrays(self, start_key=None, end_key=None, key_dtype=None,
+                 value_dtype=None, chunk_size=4096, verify_checksums=None,
+                 fill_cache=None):
+        """Reads every row from start_key (inclusive) to end_key (exclusive)
+        into NumPy arrays, chunk_size rows at a time. Returns a pair of the
+        keys and the values.
+
+        If key_dtype is given, the keys are returned as one array of that
+        dtype, and every key must be exactly key_dtype.itemsize bytes.
+        Otherwise, they are returned as a pair (offsets, data) of an int64
+        array of n + 1 offsets into a uint8 array of all of the keys, so key
+        i is data[offsets[i]:offsets[i + 1]]. The same goes for the values
+        and value_dtype. Either way, no per row objects are created beyond
+        what reading the rows takes. Requires NumPy.
+
+        @rtype: tuple
+        """
+        import numpy  # pylint: disable=F0401
+        if verify_checksums is None:
+            verify_checksums = self._default_verify_checksums
+        if fill_cache is None:
+            fill_cache = self._default_fill_cache
+        start_key, end_key = self._rawRange(start_key, end_key)
+        keys = _ArrayBuilder(numpy, key_dtype, skip=len(self._prefix or ""))
+        vals = _ArrayBuilder(numpy, value_dtype)
+        it = self._impl.iterator(verify_checksums=verify_checksums,
+                                 fill_cache=fill_cache)
+        try:
+            if start_key is None:
+                it.seekFirst()
+            else:
+                it.seek(start_key)
+            while True:
+                rows = _collectRows(it, chunk_size)
+                chunk_keys = rows[::2]
+                done = len(chunk_keys) < chunk_size
+                if end_key is not None and chunk_keys and (
+                        chunk_keys[-1] >= end_key):
+                    del chunk_keys[bisect.bisect_left(chunk_keys, end_key):]
+                    done = True
+                keys.add(chunk_keys)
+                vals.add(rows[1:2 * len(chunk_keys):2])
+                if done:
+                    break
+        finally:
+            it.close()
+        return keys.build(), vals.build()
+
+    def flush(self, sync=None):
+        """Writes the writes buffered by a BufferedDB. Does nothing for other
+        databases."""
+        if sync is None:
+            sync = self._default_sync
+        flush = getattr(self._impl, "flush", None)
+        if flush is not None:
+            flush(sync=sync)
+
+    # pylint: disable=W0212
+    def putStream(self, key, fileobj, chunk_size=(64 * 1024),
+                  batch_bytes=(4 * 1024 * 1024), sync=None):
+        """Stores everything read from fileobj as a blob under key, without
+        holding it all in memory. The blob is split into chunks of
+        chunk_size bytes, and written in batches of roughly batch_bytes. The
+        value of key itself becomes a small manifest, written (along with
+        the deletion of any blob it replaces) once every chunk is in, so
+        readers see either the old blob or the new one.
+
+        The chunks are kept outside of every scope, under keys starting with
+        "\\xff\\xffblob\\x00" at the root of the database, so iterating
+        over a scope (or planning splits of it) only sees the scope's own
+        keys.
+
+        Read blobs back with openStream, and delete them with deleteStream,
+        deletePrefix or deleteRange; deleting the key any other way leaves
+        its chunks behind, as does a putStream that doesn't finish.
+
+        @return: the number of bytes stored
+        @rtype: int
+        """
+        if sync is None:
+            sync = self._default_sync
+        key = _toBytes(key)
+        chunk_prefix = _BLOB_PREFIX
+        if self._prefix is not None:
+            key = self._prefix + key
+        blob_id = os.urandom(8)
+        batch, size, length = _OpaqueWriteBatch(), 0, 0
+        for index in itertools.count():
+            chunk = _readFully(fileobj, chunk_size)
+            if not chunk:
+                break
+            batch._puts[_blobChunkKey(chunk_prefix, blob_id, index)] = chunk
+            size += len(chunk)
+            length += len(chunk)
+            if size >= batch_bytes:
+                self._impl.write(batch, sync=sync)
+                batch, size = _OpaqueWriteBatch(), 0
+        manifest = _BLOB_MANIFEST.pack(
+                _BLOB_MAGIC, blob_id, length, chunk_size) + chunk_prefix
+
+        def build(values):
+            final = _OpaqueWriteBatch()
+            final._puts.update(batch._puts)
+            _deleteBlobChunks(final, values[0])
+            final._deletes.discard(key)
+            final._puts[key] = manifest
+            return final
+
+        self._rewrite([key], build, sync)
+        return length
+
+    def openStream(self, key, verify_checksums=None, fill_cache=None):
+        """Returns a read-only file-like object over the blob stored under key
+        by putStream, or None if key is missing. Chunks are read as they are
+        needed, from a snapshot taken now.
+
+        @rtype: BlobReader
+        """
+        if verify_checksums is None:
+            verify_checksums = self._default_verify_checksums
+        if fill_cache is None:
+            fill_cache = self._default_fill_cache
+        if self._prefix is not None:
+            key = _joinKey(self._prefix, key)
+        snapshot = self._impl.snapshot()
+        try:
+            manifest = snapshot.get(key, verify_checksums=verify_checksums,
+                                    fill_cache=fill_cache)
+            if manifest is None:
+                snapshot.close()
+                return None
+            chunk_prefix, blob_id, length, chunk_size = _unpackBlobManifest(
+                    manifest)
+        except Exception:
+            snapshot.close()
+            raise
+        return BlobReader(snapshot, chunk_prefix, blob_id, length, chunk_size,
+                          verify_checksums, fill_cache)
+
+    # pylint: disable=W0212
+    def deleteStream(self, key, sync=None):
+        """Deletes the blob stored under key by putStream, along with its
+        chunks, in one batch."""
+        if sync is None:
+            sync = self._default_sync
+        key = _toBytes(key)
+        if self._prefix is not None:
+            key = self._prefix + key
+
+        def build(values):
+            batch = _OpaqueWriteBatch()
+            _deleteBlobChunks(batch, values[0])
+            batch._deletes.add(key)
+            return batch
+
+        self._rewrite([key], build, sync)
 
     def approximateDiskSizes(self, *ranges):
+        if self._prefix is not None:
+            ranges = [(self._prefix + start_key, self._prefix + end_key)
+                      for start_key, end_key in ranges]
         return self._impl.approximateDiskSizes(*ranges)
 
+    def approximateSize(self, prefix=None):
+        """Estimates how many bytes the keys starting with prefix (or the
+        whole scope, if prefix is None) take up on disk. Data that hasn't
+        been flushed out of LevelDB's memtable yet isn't counted.
+
+        @rtype: int
+        """
+        full_prefix = (self._prefix or "") + (prefix or "")
+        return self._impl.approximateDiskSizes(_sizeRange(
+                full_prefix or None, _nextPrefix(full_prefix)))[0]
+
+    def approximateCount(self, start_key=None, end_key=None, samples=100,
+                         probes=10):
+        """Estimates the number of keys from start_key (inclusive) to end_key
+        (exclusive) without scanning them all.
+
+        If the range holds no more than samples keys, they are simply counted.
+        Otherwise, the size of an average row is sampled from the start of
+        the range and from probes points spread out across it, and the disk
+        size of the range is divided by it. The low and high bounds are a 95%
+        confidence interval for the sampling error alone; compression and
+        data that is still in the memtable can skew the estimate further.
+
+        Snapshots have no disk sizes, and neither does data that is all still
+        in the memtable. Then the keys are counted the way splitPoints counts
+        them, from how closely the rows it samples are packed, with its
+        default number of probes. Such an estimate is rougher, so its bounds
+        only promise the rows actually read, and take the rest to be off by
+        up to a factor of two either way.
+
+        @rtype: Estimate (namedtuple of value, low, high)
+        """
+        start_key, end_key = self._rawRange(start_key, end_key)
+        try:
+            disk_size = self._impl.approximateDiskSizes(
+                    _sizeRange(start_key, end_key))[0]
+        except TypeError:
+            disk_size = 0
+        it = self._impl.iterator(fill_cache=False)
+        try:
+            if start_key is None:
+                it.seekFirst()
+            else:
+                it.seek(start_key)
+            first_key = it.valid() and it.key()
+            sizes = _sampleRowSizes(it, end_key, samples + 1)
+            if len(sizes) <= samples:
+                return Estimate(len(sizes), len(sizes), len(sizes))
+            seen = len(sizes)
+            # probe between the first and last keys actually in the range
+            if end_key is None:
+                it.seekLast()
+            else:
+                it.seek(end_key)
+                if it.valid():
+                    it.prev()
+                else:
+                    it.seekLast()
+            last_key = it.key()
+            per_probe = max(samples // max(probes, 1), 1)
+            if disk_size <= 0:
+                # with as many probes as splitPoints takes by default, as a
+                # handful of them is not enough to go by position
+                planner = _SplitPlanner(it, first_key, last_key, end_key)
+                planner.probe(64, 16)
+                read, guessed = planner.counts()
+                return Estimate(max(seen, int(round(read + guessed))),
+                                max(seen, int(read + guessed / 2)),
+                                max(seen, int(math.ceil(read + 2 * guessed))))
+            for i in xrange(1, probes + 1):
+                it.seek(_interpolateKey(first_key, last_key,
+                                        float(i) / (probes + 1)))
+                sizes.extend(_sampleRowSizes(it, end_key, per_probe))
+        finally:
+            it.close()
+        mean = float(sum(sizes)) / len(sizes)
+        variance = sum((size - mean) ** 2 for size in sizes) / len(sizes)
+        error = 1.96 * math.sqrt(variance / len(sizes))
+        return Estimate(max(seen, int(round(disk_size / mean))),
+                        max(seen, int(disk_size / (mean + error))),
+                        max(seen, int(math.ceil(
+                                disk_size / max(mean - error, 1.0)))))
+
+    def splitPoints(self, n, start_key=None, end_key=None, probes=64,
+                    samples=16):
+        """Picks up to n - 1 keys that split the range from start_key
+        (inclusive) to end_key (exclusive) into n pieces of about the same
+        size, without scanning it. Each key is the first key of a piece.
+
+        The range is sampled by reading up to samples rows at each of up to
+        probes points, which are placed where the rows turn out to be, and
+        up to probes more points around the keys being picked. Where
+        possible, the keys are then found by bisecting the key space with
+        approximateDiskSizes, so that the pieces take up the same space on
+        disk. Snapshots have no disk sizes, and neither does data that is
+        still in the memtable, so otherwise the pieces get the same amount of
+        sampled data. Fewer keys are returned if the range doesn't have
+        enough keys to go around.
+
+        Along with the keys come the estimated size (on disk, if known) and
+        number of keys (from the samples) of each piece. Which byte values
+        each position of the keys uses is learned from the samples too, so
+        hex or decimal keys are counted as such. The estimates run high
+        where keys leave byte values unused that the samples don't give
+        away, as the rows sampled look denser than the rest.
+
+        @rtype: Splits (namedtuple of keys, sizes, counts)
+        """
+        if n < 1:
+            raise ValueError("n must be at least 1")
+        start_key, end_key = self._rawRange(start_key, end_key)
+        it = self._impl.iterator(fill_cache=False)
+        try:
+            first_key, last_key = _rangeBounds(it, start_key, end_key)
+            if first_key is None:
+                return Splits([], [0], [0])
+            try:
+                # up to the last row rather than the end of the range, which
+                # would take in the index at the end of the last table too
+                total = self._impl.approximateDiskSizes(
+                        (start_key or "", last_key))[0]
+            except TypeError:
+                total = 0
+            planner = _SplitPlanner(it, first_key, last_key, end_key)
+            planner.probe(probes, samples)
+            if total > 0:
+                numbers = planner.bisect(self._impl, start_key, total, n)
+                planner.refine(lambda: numbers, probes, samples)
+            else:
+                planner.refine(lambda: planner.quantiles(n), probes, samples)
+                numbers = planner.quantiles(n)
+            keys = planner.snap(numbers)
+            sizes, counts = planner.estimate(keys)
+            if total > 0:
+                bounds = [first_key] + keys + [end_key]
+                sizes = self._impl.approximateDiskSizes(*[
+                        _sizeRange(bounds[i], bounds[i + 1])
+                        for i in xrange(len(bounds) - 1)])
+        finally:
+            it.close()
+        prefix_length = len(self._prefix or "")
+        return Splits([key[prefix_length:] for key in keys], sizes, counts)
+
     def compactRange(self, start_key, end_key):
+        start_key, end_key = self._rawRange(start_key, end_key)
         return self._impl.compactRange(start_key, end_key)
 
 
+class Transaction(object):
+
+    """This class is created by calling transaction on a DBInterface. Reads
+    come from a snapshot taken when the transaction starts (or from the
+    transaction's own writes), and writes are kept until commit, which
+    writes them all in one batch.
+
+    Commit first checks that none of the keys the transaction read have
+    changed since, and raises TransactionConflict if one has, without
+    writing anything. While it checks and writes, commit holds the locks of
+    the keys it read and wrote, the same per-database locks that updates
+    take (see DBInterface.updateMany), so two transactions can't both pass
+    the check and then overwrite each other, and updates can't slip in
+    between.
+    Commits and updates also mark the keys they write with a new version,
+    so a key one of them changed and then changed back still conflicts.
+    Plain puts and deletes have no versions, and are compared by value; they
+    are only noticed if they land before the check.
+
+    On a RemoteDB, the server does the check and the write, so transactions
+    of different processes conflict with each other as well.
+
+    Used as a context manager, a transaction commits at the end of the block
+    unless the block raised (then it aborts). Commit, whether it succeeds or
+    not, and abort both release the snapshot, which ends the transaction.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        # reads and commits go around any codec and buffer, so that the
+        # values compared at commit are the bytes actually stored, which is
+        # what a server compares too.
+        self._impl, self._codecs = _baseImpl(db._impl)
+        self._prefix = db._prefix or ""
+        db.flush(sync=False)
+        # the version is read first, so that anything the snapshot misses
+        # has a newer one.
+        self._version = _keyVersion(self._impl)
+        self._snapshot = self._impl.snapshot()
+        self._reads = {}
+        self._data = {}
+        self._writes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def get(self, key):
+        return self.getMany([key])[0]
+
+    def getMany(self, keys):
+        keys = [_toBytes(key) for key in keys]
+        missing = [key for key in keys
+                   if key not in self._writes and key not in self._reads]
+        if missing:
+            data = self._snapshot.getMany(
+                    [self._prefix + key for key in missing],
+                    verify_checksums=self._db._default_verify_checksums,
+                    fill_cache=self._db._default_fill_cache)
+            for key, stored in itertools.izip(missing, data):
+                self._data[key] = stored
+                self._reads[key] = _decodeValue(self._codecs, stored)
+        return [self._writes[key] if key in self._writes else self._reads[key]
+                for key in keys]
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def put(self, key, val):
+        self._writes[_toBytes(key)] = _toBytes(val)
+
+    def delete(self, key):
+        self._writes[_toBytes(key)] = None
+
+    def abort(self):
+        self._reads = {}
+        self._data = {}
+        self._writes = {}
+        self._snapshot.close()
+
+    # pylint: disable=W0212
+    def commit(self, sync=None):
+        """Writes the transaction, or raises TransactionConflict if a key it
+        read has changed."""
+        if sync is None:
+            sync = self._db._default_sync
+        batch = ScopedWriteBatch(self._prefix)
+        for key, val in self._writes.iteritems():
+            if val is None:
+                batch.delete(key)
+            else:
+                batch.put(key, _encodeValue(self._codecs, val))
+        reads = dict((self._prefix + key, stored)
+                     for key, stored in self._data.iteritems())
+        try:
+            self._db.flush(sync=False)
+            _commitBatch(self._impl, self._version, reads, batch, sync)
+        finally:
+            self.abort()
+
+
+class _KeyLocks(object):
+
+    """The locks and key versions that updates and transaction commits of
+    one database coordinate through. A key is guarded by one of a fixed set
+    of locks, picked by its hash. Every write made under the locks gives the
+    keys it wrote a new version, so a transaction can tell whether a key it
+    read was written after it started.
+
+    Only the most recent max_versions key versions are kept. A transaction
+    that started before the newest version that was dropped takes every key
+    it read that isn't still listed as written.
+    """
+
+    __slots__ = ["_locks", "_mutex", "_versions", "_max_versions", "_floor",
+                 "version"]
+
+    def __init__(self, stripes=64, max_versions=(64 * 1024)):
+        self._locks = [threading.Lock() for _ in xrange(stripes)]
+        self._mutex = threading.Lock()
+        self._versions = OrderedDict()
+        self._max_versions = max_versions
+        self._floor = 0
+        self.version = 0
+
+    def acquire(self, keys):
+        """Takes the locks of keys, in the same order every caller does, and
+        returns them for release."""
+        locks = [self._locks[i] for i in sorted(set(
+                hash(key) % len(self._locks) for key in keys))]
+        for lock in locks:
+            lock.acquire()
+        return locks
+
+    @staticmethod
+    def release(locks):
+        for lock in reversed(locks):
+            lock.release()
+
+    def written(self, keys):
+        """Gives keys, which must be locked, a new version"""
+        with self._mutex:
+            self.version += 1
+            for key in keys:
+                self._versions.pop(key, None)
+                self._versions[key] = self.version
+            while len(self._versions) > self._max_versions:
+                self._floor = self._versions.popitem(last=False)[1]
+
+    def changed(self, keys, version):
+        """Returns the first of keys, which must be locked, written after
+        version, or None"""
+        with self._mutex:
+            for key in keys:
+                written = self._versions.get(key)
+                if written is None:
+                    if version < self._floor:
+                        return key
+                elif written > version:
+                    return key
+        return None
+
+
+_key_locks = weakref.WeakKeyDictionary()
+_key_locks_lock = threading.Lock()
+
+
+# pylint: disable=W0212
+def _baseImpl(impl):
+    """Returns the implementation under the value codecs and buffers that
+    wrap impl, along with the codecs, outermost first."""
+    codecs = []
+    while isinstance(impl, (_CodecDBImpl, _BufferedDBImpl)):
+        if isinstance(impl, _CodecDBImpl):
+            codecs.append(impl._codec)
+            impl = impl._impl
+        else:
+            impl = impl._db
+    return impl, codecs
+
+
+def _encodeValue(codecs, val):
+    for codec in codecs:
+        val = codec.encode(val)
+    return val
+
+
+def _decodeValue(codecs, data):
+    if data is None:
+        return None
+    for codec in reversed(codecs):
+        data = codec.decode(data)
+    return data
+
+
+# pylint: disable=W0212
+def _keyLocks(impl):
+    """Returns the _KeyLocks of the database that the implementation impl
+    reads and writes, creating them if needed."""
+    impl = _baseImpl(impl)[0]
+    if isinstance(impl, _PooledDBImpl):
+        return impl._pool._keyLocks(impl._path)
+    with _key_locks_lock:
+        key_locks = _key_locks.get(impl)
+        if key_locks is None:
+            key_locks = _key_locks[impl] = _KeyLocks()
+        return key_locks
+
+
+def _keyVersion(impl):
+    """Returns the latest key version of the database of impl"""
+    impl = _baseImpl(impl)[0]
+    if isinstance(impl, _RemoteDBImpl):
+        return impl.version()
+    return _keyLocks(impl).version
+
+
+# pylint: disable=W0212
+def _commitBatch(impl, version, reads, batch, sync):
+    """Writes batch to impl, unless one of the keys in reads (a dict of
+    unscoped keys and the values they had) was written after version or no
+    longer has its value, in which case TransactionConflict is raised.
+
+    The batch is written past any buffer of impl, which should be flushed
+    first. On a RemoteDB the server compares the stored bytes, so reads
+    must hold those rather than values decoded by a codec.
+    """
+    impl, codecs = _baseImpl(impl)
+    if codecs:
+        encoded = _OpaqueWriteBatch()
+        for key, val in batch._puts.iteritems():
+            encoded._puts[key] = _encodeValue(codecs, val)
+        encoded._deletes = batch._deletes
+        batch = encoded
+    if isinstance(impl, _RemoteDBImpl):
+        impl.commit(version, reads, batch, sync)
+        return
+    keys = list(batch._puts)
+    keys.extend(batch._deletes)
+    key_locks = _keyLocks(impl)
+    locks = key_locks.acquire(keys + reads.keys())
+    try:
+        key = key_locks.changed(reads, version)
+        if key is None:
+            read_keys = reads.keys()
+            for read_key, stored in itertools.izip(read_keys,
+                                                   impl.getMany(read_keys)):
+                if _decodeValue(codecs, stored) != reads[read_key]:
+                    key = read_key
+                    break
+        if key is not None:
+            raise TransactionConflict("%r changed" % (key,))
+        if keys:
+            impl.write(batch, sync=sync)
+            key_locks.written(keys)
+    finally:
+        key_locks.release(locks)
+
+
+# A blob's chunks are kept at the root of the database, under _BLOB_PREFIX,
+# the blob's random id and the chunk's index, so they never show up in the
+# scope the blob was stored in. The blob's own key holds a manifest, which
+# ends with the chunks' prefix, so that the blob can be read or deleted
+# through any scope.
+_BLOB_PREFIX = "\xff\xffblob\x00"
+_BLOB_MANIFEST = struct.Struct("!4s8sQI")
+_BLOB_MAGIC = "BLB1"
+_BLOB_CHUNK_INDEX = struct.Struct("!Q")
+
+
+def _blobChunkKey(chunk_prefix, blob_id, index):
+    return chunk_prefix + blob_id + _BLOB_CHUNK_INDEX.pack(index)
+
+
+def _unpackBlobManifest(manifest):
+    """Returns the chunks' prefix, blob id, length and chunk size of a
+    blob's manifest."""
+    if (len(manifest) < _BLOB_MANIFEST.size + len(_BLOB_PREFIX) or
+            not manifest.startswith(_BLOB_MAGIC) or
+            not manifest.endswith(_BLOB_PREFIX)):
+        raise ValueError("value is not a blob stored by putStream")
+    fields = _BLOB_MANIFEST.unpack_from(manifest)[1:]
+    return (manifest[_BLOB_MANIFEST.size:],) + fields
+
+
+# pylint: disable=W0212
+def _deleteBlobChunks(batch, manifest):
+    """Adds the deletion of the chunks of the blob that manifest (if it is a
+    blob's manifest at all) describes to batch."""
+    if manifest is None:
+        return
+    try:
+        chunk_prefix, blob_id, length, chunk_size = _unpackBlobManifest(
+                manifest)
+    except ValueError:
+        return
+    for index in xrange((length + chunk_size - 1) // chunk_size):
+        batch._deletes.add(_blobChunkKey(chunk_prefix, blob_id, index))
+
+
+def _readFully(fileobj, size):
+    """Reads size bytes from fileobj, or fewer only at the end of it."""
+    data = fileobj.read(size)
+    if len(data) in (0, size):
+        return data
+    parts, remaining = [data], size - len(data)
+    while remaining > 0:
+        part = fileobj.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return "".join(parts)
+
+
+class BlobReader(object):
+
+    """A read-only file-like object over a blob, created by calling
+    openStream on a DBInterface. Only the chunk being read is kept in
+    memory, and seeking is free until the next read.
+    """
+
+    def __init__(self, snapshot, chunk_prefix, blob_id, length, chunk_size,
+                 verify_checksums, fill_cache):
+        self._snapshot = snapshot
+        self._chunk_prefix = chunk_prefix
+        self._blob_id = blob_id
+        self.size = length
+        self._chunk_size = chunk_size
+        self._verify_checksums = verify_checksums
+        self._fill_cache = fill_cache
+        self._pos = 0
+        self._chunk_index = None
+        self._chunk = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _loadChunk(self, index):
+        if index != self._chunk_index:
+            if self._snapshot is None:
+                raise ValueError("I/O operation on closed blob")
+            chunk = self._snapshot.get(
+                    _blobChunkKey(self._chunk_prefix, self._blob_id, index),
+                    verify_checksums=self._verify_checksums,
+                    fill_cache=self._fill_cache)
+            if chunk is None:
+                raise Error("blob chunk %d is missing" % index)
+            self._chunk_index, self._chunk = index, chunk
+        return self._chunk
+
+    def read(self, size=-1):
+        end = self.size
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        parts = []
+        while self._pos < end:
+            index, offset = divmod(self._pos, self._chunk_size)
+            part = self._loadChunk(index)[offset:offset + end - self._pos]
+            parts.append(part)
+            self._pos += len(part)
+        return "".join(parts)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError("negative seek position %d" % offset)
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        snapshot, self._snapshot = self._snapshot, None
+        self._chunk_index, self._chunk = None, ""
+        if snapshot is not None:
+            snapshot.close()
+
+
+# larger than any key that doesn't start with this many \xff bytes
+_LAST_KEY = "\xff" * 64
+
+
+def _closing(iterator, rows):
+    """Yields rows, then closes iterator, even if the rows aren't all read"""
+    try:
+        for row in rows:
+            yield row
+    finally:
+        iterator.close()
+
+
+class _ArrayBuilder(object):
+
+    """Collects the keys or values for DBInterface.toArrays into a single
+    buffer. With a dtype, every item must be skip + dtype.itemsize bytes, and
+    the array skips the first skip bytes of each without copying. Without
+    one, the first skip bytes of each item are cut off and the lengths kept
+    for the offsets array."""
+
+    def __init__(self, numpy, dtype, skip=0):
+        self._numpy = numpy
+        self._dtype = None if dtype is None else numpy.dtype(dtype)
+        self._skip = skip
+        self._data = bytearray()
+        self._lengths = []
+        self._count = 0
+
+    def add(self, items):
+        if self._dtype is None:
+            if self._skip:
+                items = [item[self._skip:] for item in items]
+            self._lengths.extend(map(len, items))
+        elif items:
+            width = self._skip + self._dtype.itemsize
+            if set(map(len, items)) != set([width]):
+                raise ValueError("expected every item to be %d bytes" %
+                                 self._dtype.itemsize)
+        self._data += "".join(items)
+        self._count += len(items)
+
+    def build(self):
+        numpy = self._numpy
+        if self._dtype is None:
+            offsets = numpy.zeros(self._count + 1, numpy.int64)
+            numpy.cumsum(self._lengths, out=offsets[1:])
+            if not self._data:
+                return offsets, numpy.empty(0, numpy.uint8)
+            return offsets, numpy.frombuffer(self._data, numpy.uint8)
+        if not self._count:
+            return numpy.empty(0, self._dtype)
+        return numpy.ndarray((self._count,), self._dtype, buffer=self._data,
+                             offset=self._skip,
+                             strides=(self._skip + self._dtype.itemsize,))
+
+
+def _sizeRange(start_key, end_key):
+    """Turns a range with possibly open ends into one that approximate disk
+    size calculations accept."""
+    if end_key is None:
+        end_key = _LAST_KEY
+    return (start_key or "", end_key)
+
+
+def _sampleRowSizes(it, end_key, count):
+    """Returns the sizes of up to count rows from the iterator (implementation)
+    it, stopping at end_key."""
+    sizes = []
+    while len(sizes) < count and it.valid():
+        key = it.key()
+        if end_key is not None and key >= end_key:
+            break
+        sizes.append(len(key) + len(it.val()))
+        it.next()
+    return sizes
+
+
+def _keyNumber(key, length):
+    """Treats the first length bytes of key as a big-endian number"""
+    return long(key[:length].ljust(length, "\x00").encode("hex") or "0", 16)
+
+
+def _numberKey(number, length):
+    """The inverse of _keyNumber"""
+    return ("%x" % number).rjust(2 * length, "0").decode("hex")
+
+
+def _interpolateKey(start_key, end_key, fraction):
+    """Returns a key roughly fraction of the way from start_key to end_key,
+    treating keys as big-endian numbers."""
+    length = max(len(start_key), len(end_key))
+    start = _keyNumber(start_key, length)
+    end = _keyNumber(end_key, length)
+    return _numberKey(start + long((end - start) * fraction), length)
+
+
+def _rangeBounds(it, start_key, end_key):
+    """Returns the first and last keys in a range, or (None, None) if it is
+    empty."""
+    if start_key is None:
+        it.seekFirst()
+    else:
+        it.seek(start_key)
+    if not it.valid() or (end_key is not None and it.key() >= end_key):
+        return None, None
+    first_key = it.key()
+    if end_key is None:
+        it.seekLast()
+    else:
+        it.seek(end_key)
+        if it.valid():
+            it.prev()
+        else:
+            it.seekLast()
+    return first_key, it.key()
+
+
+# 2 ** 64 divided by the golden ratio. Multiples of it (mod 2 ** 64) spread
+# points out evenly without lining them up on round numbers.
+_GOLDEN_RATIO_64 = 0x9e3779b97f4a7c15
+
+# digits, upper and lower case letters
+_KEY_BYTE_KINDS = ((0x30, 0x39), (0x41, 0x5a), (0x61, 0x7a))
+
+
+class _SplitPlanner(object):
+
+    """Finds split points for DBInterface.splitPoints.
+
+    Keys are treated as numbers, with a digit per byte, so the range can be
+    cut in between keys. Each digit only spans the byte values seen at that
+    position in a sample of the range's keys, plus one for keys that are
+    too short to have that byte, so that keys such as "user:000123" spread
+    out evenly instead of crowding into a sliver of all possible strings.
+    """
+
+    def __init__(self, it, first_key, last_key, end_key):
+        self._it = it
+        self._end_key = end_key
+        # (low, high, size, count, guessed) of each probed slice, in order
+        self._slices = []
+        # every round samples keys spread out by the digits learned so far,
+        # which finds byte values the round before missed. A couple of rows
+        # at many points show more of each digit's values than long runs of
+        # rows, which share their leading bytes.
+        keys = [first_key, last_key]
+        columns = None
+        for _ in xrange(4):
+            learned = self._learnColumns(keys)
+            if learned == columns:
+                break
+            columns = learned
+            self._setDigits(columns)
+            first, last = self._number(first_key), self._number(last_key)
+            for i in xrange(65):
+                it.seek(self._key(first + ((last - first) * (
+                        (i * _GOLDEN_RATIO_64) % (1 << 64)) >> 64)))
+                if it.valid():
+                    keys.extend(key for key, _ in self._sample(it.key(),
+                                                                2)[0])
+        self._first = self._number(first_key)
+        self._last = self._number(last_key) + 1
+
+    @staticmethod
+    def _learnColumns(keys):
+        """Picks the byte values each digit spans, as ranges, and whether
+        keys can end before it. Digits, upper and lower case letters are
+        assumed to take any value of their kind, unless the keys show a
+        digit using just a run of them, such as a-f in hex: at least 4
+        values, with no gaps, each seen 4 times on average. Other bytes that
+        vary could take any value."""
+        length = max(len(key) for key in keys) + 1
+        columns = []
+        for column in itertools.izip_longest(*[map(ord, key) for key in keys]):
+            values = frozenset(value for value in column if value is not None)
+            ranges, others = [], set(values)
+            for kind_low, kind_high in _KEY_BYTE_KINDS:
+                kind = [value for value in values
+                        if kind_low <= value <= kind_high]
+                if not kind:
+                    continue
+                low, high = min(kind), max(kind)
+                hits = sum(1 for value in column
+                           if value is not None and low <= value <= high)
+                if (len(kind) >= 4 and high - low + 1 == len(kind) and
+                        hits >= 4 * len(kind)):
+                    ranges.append((low, high))
+                else:
+                    ranges.append((kind_low, kind_high))
+                others.difference_update(kind)
+            if len(others) > 1:
+                ranges = [(0, 255)]
+            else:
+                ranges.extend((value, value) for value in others)
+                ranges.sort()
+            columns.append((tuple(ranges), None in column))
+        columns.extend([(((0, 255),), True)] * (length - len(columns)))
+        return columns
+
+    def _setDigits(self, columns):
+        """Lays out the digits. A digit's values are the bytes in its ranges,
+        after a value for keys that end before it, if they can. A byte
+        outside of the ranges gets the next value, with the rest of the key
+        at its lowest, or the last value, with the rest at its highest."""
+        self._digits = []
+        for ranges, optional in columns:
+            # the value and rounding of every byte
+            values = []
+            chars = [None] if optional else []
+            for low, high in ranges:
+                values.extend([(len(chars), -1)] * (low - len(values)))
+                for value in xrange(low, high + 1):
+                    values.append((len(chars), 0))
+                    chars.append(chr(value))
+            values.extend([(len(chars) - 1, 1)] * (256 - len(values)))
+            self._digits.append((values, chars))
+
+    def _number(self, key):
+        number = 0
+        for i, (values, chars) in enumerate(self._digits):
+            if i >= len(key):
+                digit, rounding = 0, -1
+            else:
+                digit, rounding = values[ord(key[i])]
+            number = number * len(chars) + digit
+            if rounding:
+                for _, chars in self._digits[i + 1:]:
+                    number *= len(chars)
+                    if rounding > 0:
+                        number += len(chars) - 1
+                return number
+        return number
+
+    def _key(self, number):
+        digits = []
+        for _, chars in reversed(self._digits):
+            number, digit = divmod(number, len(chars))
+            digits.append(chars[digit])
+        key = []
+        for char in reversed(digits):
+            if char is None:
+                break
+            key.append(char)
+        return "".join(key)
+
+    def _sample(self, key, samples, end_key=None):
+        """Reads up to samples rows from key, stopping at end_key or the end
+        of the range. Returns their keys and sizes, and the key of the row
+        after them if there is one before the end."""
+        if end_key is None or (self._end_key is not None and
+                               self._end_key < end_key):
+            end_key = self._end_key
+        it = self._it
+        it.seek(key)
+        rows = []
+        while it.valid() and len(rows) < samples:
+            row_key = it.key()
+            if end_key is not None and row_key >= end_key:
+                break
+            rows.append((row_key, len(row_key) + len(it.val())))
+            it.next()
+        if len(rows) < samples or not it.valid():
+            return rows, None
+        next_key = it.key()
+        if end_key is not None and next_key >= end_key:
+            return rows, None
+        return rows, next_key
+
+    def bisect(self, impl, start_key, total, n):
+        """Finds the numbers where the disk size from start_key reaches each
+        nth of total, all at once, one approximateDiskSizes call per step.
+        Each step measures up to the first row after the middle, or if there
+        is none before the upper bound, moves that down to the last row
+        before the middle, so that stretches without rows take one step."""
+        targets = [total * i / float(n) for i in xrange(1, n)]
+        bounds = [[self._first, self._last] for _ in targets]
+        tolerance = total / (100.0 * n)
+        it = self._it
+        for _ in xrange(64):
+            if all(high - low < 2 for low, high in bounds):
+                break
+            measured = []
+            for i, (low, high) in enumerate(bounds):
+                if high - low < 2:
+                    continue
+                middle = (low + high) // 2
+                it.seek(self._key(middle))
+                number = self._number(it.key()) if it.valid() else high
+                if number >= high:
+                    bounds[i][1] = max(self._lastNumber(middle), low + 1)
+                else:
+                    measured.append((i, middle, number, it.key()))
+            if not measured:
+                continue
+            sizes = impl.approximateDiskSizes(*[
+                    (start_key or "", key) for _, _, _, key in measured])
+            for (i, middle, number, _), size in itertools.izip(measured,
+                                                               sizes):
+                if abs(size - targets[i]) <= tolerance:
+                    bounds[i] = [number, number]
+                elif size < targets[i]:
+                    bounds[i][0] = max(number, middle)
+                else:
+                    bounds[i][1] = number
+        return [high for _, high in bounds]
+
+    def _addRows(self, low, high, rows):
+        """Adds a slice for each of rows, which are all of the rows from low
+        to high, starting at the row's own number."""
+        numbers = [min(max(self._number(key), low), high) for key, _ in rows]
+        self._slices.append((low, numbers[0] if rows else high, 0, 0, False))
+        numbers.append(high)
+        for i, (_, row_size) in enumerate(rows):
+            self._slices.append((numbers[i], max(numbers[i + 1], numbers[i]),
+                                 row_size, 1, False))
+
+    def _lastNumber(self, high):
+        """Returns the number just past the last row before high."""
+        it = self._it
+        it.seek(self._key(high))
+        if it.valid():
+            it.prev()
+        else:
+            it.seekLast()
+        return min(self._number(it.key()) + 1, high)
+
+    def _probeSlice(self, low, high, samples, pending):
+        rows, next_key = self._sample(self._key(low), samples,
+                                      end_key=self._key(high))
+        if next_key is None:
+            self._addRows(low, high, rows)
+            return
+        # the rows read are known, and so is the empty space after the last
+        # row of the slice, which keeps guesses from spreading over the gaps
+        # between groups of keys. What is left in between is guessed from
+        # how closely the rows read were packed.
+        first = min(max(self._number(rows[0][0]), low), high)
+        middle = min(max(self._number(next_key), first + 1), high)
+        last = max(self._lastNumber(high), middle)
+        self._addRows(low, middle, rows)
+        if last < high:
+            self._slices.append((last, high, 0, 0, False))
+        size = sum(row_size for _, row_size in rows)
+        width = float(max(middle - first, 1))
+        heapq.heappush(pending, (-size * (last - middle) / width, middle, last,
+                                 size / width, len(rows) / width))
+
+    def _guess(self, pending):
+        """Adds the slices that were left unread, with their guessed size and
+        number of keys. There is at least one key in each, as a slice starts
+        at a row, and no more than one per number."""
+        for _, low, high, size_density, count_density in pending:
+            width = high - low
+            count = min(max(count_density * width, 1.0), max(width, 1))
+            self._slices.append((low, high,
+                                 count * size_density / count_density, count,
+                                 True))
+        del pending[:]
+
+    def _split(self, pending, samples):
+        """Probes both halves of the unread slice with the largest guessed
+        size, and returns the number of probes that took."""
+        piece = heapq.heappop(pending)
+        low, high = piece[1], piece[2]
+        if high - low < 2:
+            self._guess([piece])
+            return 0
+        middle = (low + high) // 2
+        self._probeSlice(low, middle, samples, pending)
+        self._probeSlice(middle, high, samples, pending)
+        return 2
+
+    def probe(self, probes, samples):
+        """Estimates the size and number of keys of slices of the range, by
+        reading up to samples rows at the start of each. The range starts
+        out as one slice, and each further pair of probes splits the slice
+        with the largest guessed size in two, so the probes end up where the
+        rows are."""
+        pending = []
+        self._probeSlice(self._first, self._last, samples, pending)
+        used = 1
+        while pending and (used < probes or self._dominates(pending)):
+            used += self._split(pending, samples)
+            if used >= 2 * probes + 64:
+                break
+        self._guess(pending)
+        self._slices.sort()
+
+    def _dominates(self, pending):
+        """Whether the unread slice with the largest guessed size makes up
+        more than half of all of the sizes, read and guessed. Its guess
+        comes from a handful of rows at one end of it, so it is split until
+        the estimate no longer hangs on it."""
+        largest = -pending[0][0]
+        return largest * 2 > (sum(piece[2] for piece in self._slices) +
+                              sum(-piece[0] for piece in pending))
+
+    def refine(self, numbers, probes, samples):
+        """Keeps probing the unread slices that numbers (a function that
+        returns the split numbers for the slices probed so far) fall in,
+        until every split is between rows that were read, or probes run
+        out. Where the rows are dense, a guess is only as good as the rows
+        it was made from, so this puts the probes where the splits are."""
+        used = 0
+        while used < probes:
+            lows = [piece[0] for piece in self._slices]
+            chosen = set()
+            for number in numbers():
+                i = bisect.bisect_right(lows, number) - 1
+                piece = self._slices[max(i, 0)]
+                if piece[4] and piece[1] - piece[0] >= 2:
+                    chosen.add(max(i, 0))
+            if not chosen:
+                break
+            pending = []
+            for i in sorted(chosen, reverse=True):
+                low, high, size, count, _ = self._slices.pop(i)
+                width = float(high - low)
+                pending.append((-size, low, high, size / width,
+                                count / width))
+            heapq.heapify(pending)
+            while pending and used < probes:
+                used += self._split(pending, samples)
+            self._guess(pending)
+            self._slices.sort()
+
+    def _cumulative(self, column, number):
+        """Adds up a column of the probed slices up to number, assuming it is
+        spread evenly within each slice."""
+        result = 0.0
+        for piece in self._slices:
+            low, high = piece[0], piece[1]
+            if number >= high:
+                result += piece[column]
+            else:
+                if number > low:
+                    result += piece[column] * (number - low) / float(
+                            high - low)
+                break
+        return result
+
+    def quantiles(self, n):
+        """Finds the numbers where the probed size reaches each nth of the
+        total."""
+        total = sum(piece[2] for piece in self._slices)
+        numbers = []
+        cumulative, j = 0.0, 0
+        for i in xrange(1, n):
+            target = total * i / float(n)
+            while (cumulative + self._slices[j][2] < target and
+                   j < len(self._slices) - 1):
+                cumulative += self._slices[j][2]
+                j += 1
+            low, high, size = self._slices[j][:3]
+            fraction = min((target - cumulative) / max(size, 1.0), 1.0)
+            numbers.append(low + long((high - low) * fraction))
+        return numbers
+
+    def snap(self, numbers):
+        """Moves each number to the first key at or after it, dropping those
+        that land on the first key, past the range or on the same key as the
+        one before."""
+        keys = []
+        for number in numbers:
+            if number <= self._first:
+                continue
+            self._it.seek(self._key(number))
+            if not self._it.valid():
+                break
+            key = self._it.key()
+            if self._end_key is not None and key >= self._end_key:
+                break
+            if not keys or key > keys[-1]:
+                keys.append(key)
+        return keys
+
+    def counts(self):
+        """Returns the number of rows read by the probes, and the number of
+        keys guessed to be in the rest of the range."""
+        read = sum(piece[3] for piece in self._slices if not piece[4])
+        return read, sum(piece[3] for piece in self._slices if piece[4])
+
+    def estimate(self, keys):
+        """Returns the probed sizes and numbers of keys of the pieces that
+        keys split the range into."""
+        numbers = ([self._first] + [self._number(key) for key in keys] +
+                   [self._last])
+        sizes, counts = [], []
+        for low, high in itertools.izip(numbers, numbers[1:]):
+            sizes.append(int(round(self._cumulative(2, high) -
+                                   self._cumulative(2, low))))
+            counts.append(int(round(self._cumulative(3, high) -
+                                    self._cumulative(3, low))))
+        return sizes, counts
+
+
+_PAGE_TOKEN_HEADER = struct.Struct("!BBI")
+_PAGE_TOKEN_VERSION = 1
+
+
+def _encodePageToken(scope, key, reverse):
+    return base64.urlsafe_b64encode(_PAGE_TOKEN_HEADER.pack(
+            _PAGE_TOKEN_VERSION, bool(reverse), len(scope)) + scope + key)
+
+
+def _decodePageToken(token, scope, reverse):
+    """Returns the last key of the page token was handed out with"""
+    try:
+        data = base64.urlsafe_b64decode(str(token))
+        version, token_reverse, scope_len = _PAGE_TOKEN_HEADER.unpack_from(
+                data)
+    except (TypeError, struct.error):
+        raise ValueError("malformed page token")
+    if version != _PAGE_TOKEN_VERSION:
+        raise ValueError("unsupported page token version %d" % version)
+    start = _PAGE_TOKEN_HEADER.size
+    if data[start:start + scope_len] != scope:
+        raise ValueError("page token is for a different scope")
+    if bool(token_reverse) != bool(reverse):
+        raise ValueError("page token is for the other direction")
+    return data[start + scope_len:]
+
+
 def MemoryDB(*_args, **kwargs):
     """This is primarily for unit testing. If you are doing anything serious,
     you definitely are more interested in the standard DB class.
@@ -633,8 +2382,11 @@ class _IteratorMemImpl(object):
     def val(self):
         return self._data[self._idx][1]
 
+    def item(self):
+        return self._data[self._idx]
+
     def seek(self, key):
-        self._idx = bisect.bisect_left(self._data, (key, ""))
+        self._idx = bisect.bisect_left(self._data, (_toBytes(key),))
 
     def seekFirst(self):
         self._idx = 0
@@ -655,7 +2407,7 @@ class _IteratorMemImpl(object):
 
 class _MemoryDBImpl(object):
 
-    __slots__ = ["_data", "_lock", "_is_snapshot"]
+    __slots__ = ["_data", "_lock", "_is_snapshot", "__weakref__"]
 
     def __init__(self, data=None, is_snapshot=False):
         if data is None:
@@ -672,8 +2424,7 @@ class _MemoryDBImpl(object):
     def put(self, key, val, **_kwargs):
         if self._is_snapshot:
             raise TypeError("cannot put on leveldb snapshot")
-        assert isinstance(key, str)
-        assert isinstance(val, str)
+        key, val = _toBytes(key), _toBytes(val)
         with self._lock:
             idx = bisect.bisect_left(self._data, (key, ""))
             if 0 <= idx < len(self._data) and self._data[idx][0] == key:
@@ -684,18 +2435,24 @@ class _MemoryDBImpl(object):
     def delete(self, key, **_kwargs):
         if self._is_snapshot:
             raise TypeError("cannot delete on leveldb snapshot")
+        key = _toBytes(key)
         with self._lock:
             idx = bisect.bisect_left(self._data, (key, ""))
             if 0 <= idx < len(self._data) and self._data[idx][0] == key:
                 del self._data[idx]
 
     def get(self, key, **_kwargs):
+        key = _toBytes(key)
         with self._lock:
             idx = bisect.bisect_left(self._data, (key, ""))
             if 0 <= idx < len(self._data) and self._data[idx][0] == key:
                 return self._data[idx][1]
             return None
 
+    def getMany(self, keys, **_kwargs):
+        with self._lock:
+            return [self.get(key) for key in keys]
+
     # pylint: disable=W0212
     def write(self, batch, **_kwargs):
         if self._is_snapshot:
@@ -719,45 +2476,160 @@ class _MemoryDBImpl(object):
     def approximateDiskSizes(self, *ranges):
         if self._is_snapshot:
             raise TypeError("cannot calculate disk sizes on leveldb snapshot")
-        return [0] * len(ranges)
+        sizes = []
+        with self._lock:
+            for start_key, end_key in ranges:
+                start = bisect.bisect_left(self._data, (start_key, ""))
+                end = bisect.bisect_left(self._data, (end_key, ""))
+                sizes.append(sum(len(key) + len(val)
+                                 for key, val in self._data[start:end]))
+        return sizes
 
     def compactRange(self, start_key, end_key):
         pass
 
     def snapshot(self):
         if self._is_snapshot:
-            return self
+            # snapshots never change their data, so they can share it
+            return _MemoryDBImpl(data=self._data, is_snapshot=True)
         with self._lock:
             return _MemoryDBImpl(data=self._data[:], is_snapshot=True)
 
 
 class _PointerRef(object):
 
-    __slots__ = ["ref", "_close", "_referrers", "__weakref__"]
+    """Owns a C object, ref, that close_cb destroys. Referrers, such as the
+    iterators and snapshots of a database, are closed first. Each referrer
+    is held weakly and removes itself as soon as it is closed or collected,
+    so registering and unregistering are single dict operations, which need
+    no locking, and finished referrers don't pile up.
+    """
+
+    __slots__ = ["ref", "_close", "_referrers", "_registrations",
+                 "__weakref__"]
+
+    _tokens = itertools.count()
 
     def __init__(self, ref, close_cb):
         self.ref = ref
         self._close = close_cb
-        self._referrers = weakref.WeakValueDictionary()
+        self._referrers = {}
+        # (referrers dict, token) for every _PointerRef this refers to
+        self._registrations = []
 
     def addReferrer(self, referrer):
-        self._referrers[id(referrer)] = referrer
+        token = next(self._tokens)
+        self._referrers[token] = weakref.ref(referrer)
+        referrer._registrations.append((self._referrers, token))
+
+    def hasReferrers(self, ignore=()):
+        """Returns whether any referrer, other than those in ignore, is still
+        alive and open"""
+        for referrer in self._referrers.values():
+            referrer = referrer()
+            if (referrer is not None and referrer.ref is not None and
+                    referrer not in ignore):
+                return True
+        return False
 
     def close(self):
-        ref, self.ref = self.ref, None
+        # ref stays set until the referrers are closed, as they may still be
+        # using it from other threads until then (see _ReadaheadReader).
+        # only the outermost call destroys it, if closing a referrer closes
+        # this again.
+        ref = self.ref
         close, self._close = self._close, None
-        referrers = self._referrers
-        self._referrers = weakref.WeakValueDictionary()
-        for referrer in referrers.valuerefs():
+        registrations, self._registrations = self._registrations, []
+        for referrers, token in registrations:
+            referrers.pop(token, None)
+        for referrer in self._referrers.values():
             referrer = referrer()
             if referrer is not None:
                 referrer.close()
+        self._referrers.clear()
+        self.ref = None
         if ref is not None and close is not None:
             close(ref)
 
     __del__ = close
 
 
+class _PyBuffer(ctypes.Structure):
+
+    _fields_ = [("buf", ctypes.c_void_p),
+                ("obj", ctypes.c_void_p),
+                ("len", ctypes.c_ssize_t),
+                ("itemsize", ctypes.c_ssize_t),
+                ("readonly", ctypes.c_int),
+                ("ndim", ctypes.c_int),
+                ("format", ctypes.c_char_p),
+                ("shape", ctypes.c_void_p),
+                ("strides", ctypes.c_void_p),
+                ("suboffsets", ctypes.c_void_p),
+                ("smalltable", ctypes.c_ssize_t * 2),
+                ("internal", ctypes.c_void_p)]
+
+
+def _pythonFunction(name, restype, *argtypes):
+    # private prototypes, so other users of ctypes.pythonapi are unaffected
+    return ctypes.PYFUNCTYPE(restype, *argtypes)((name, ctypes.pythonapi))
+
+
+try:
+    _asReadBuffer = _pythonFunction("PyObject_AsReadBuffer", ctypes.c_int,
+            ctypes.py_object, ctypes.POINTER(ctypes.c_void_p),
+            ctypes.POINTER(ctypes.c_ssize_t))
+    _getBuffer = _pythonFunction("PyObject_GetBuffer", ctypes.c_int,
+            ctypes.py_object, ctypes.POINTER(_PyBuffer), ctypes.c_int)
+    _releaseBuffer = _pythonFunction("PyBuffer_Release", None,
+            ctypes.POINTER(_PyBuffer))
+except AttributeError:
+    # not CPython. buffers get copied into strs instead
+    _asReadBuffer = _getBuffer = _releaseBuffer = None
+
+
+def _readBuffer(data):
+    """Returns a pointer to the contents of data, which may be any buffer,
+    and its length, so it can be passed to the C API without being copied
+    into a str first. The pointer is only good while data is alive and isn't
+    resized, and while the returned pointer object is."""
+    if isinstance(data, str):
+        return data, len(data)
+    if isinstance(data, unicode):
+        raise TypeError("keys and values must be bytes, not unicode")
+    if _asReadBuffer is None:
+        data = _toBytes(data)
+        return data, len(data)
+    pointer, length = ctypes.c_void_p(), ctypes.c_ssize_t()
+    try:
+        # bytearray, buffer, mmap, array and numpy arrays
+        _asReadBuffer(data, ctypes.byref(pointer), ctypes.byref(length))
+        return pointer, length.value
+    except TypeError:
+        pass
+    # memoryview only has the new buffer interface
+    view = _HeldBuffer(data)
+    return view, view.length
+
+
+class _HeldBuffer(object):
+
+    """The new style buffer of an object, passed to ctypes as a pointer to
+    its contents. The buffer is held until this is collected, so the pointer
+    stays good for the C call it is passed to."""
+
+    __slots__ = ["_view", "_as_parameter_", "length"]
+
+    def __init__(self, data):
+        self._view = _PyBuffer()
+        _getBuffer(data, ctypes.byref(self._view), 0)
+        self._as_parameter_ = ctypes.c_void_p(self._view.buf)
+        self.length = self._view.len
+
+    def __del__(self):
+        _releaseBuffer(ctypes.byref(self._view))
+
+
 def _checkError(error):
     if bool(error):
         message = ctypes.string_at(error)
@@ -765,219 +2637,3657 @@ def _checkError(error):
         raise Error(message)
 
 
-class _IteratorDbImpl(object):
-
-    __slots__ = ["_ref"]
+class _Backend(object):
 
-    def __init__(self, iterator_ref):
-        self._ref = iterator_ref
+    """The low level operations _LevelDBImpl and _IteratorDbImpl are built
+    on, implemented once per way of calling the LevelDB C API. Write options,
+    and read options without a snapshot, are created once per backend instead
+    of once per call.
+    """
 
-    def valid(self):
-        return _ldb.leveldb_iter_valid(self._ref.ref)
+    name = None
 
-    def key(self):
-        length = ctypes.c_size_t(0)
-        val_p = _ldb.leveldb_iter_key(self._ref.ref, ctypes.byref(length))
-        assert bool(val_p)
-        return ctypes.string_at(val_p, length.value)
+    def __init__(self):
+        self._write_options = {}
+        for sync in (False, True):
+            self._write_options[sync] = self._newWriteOptions(sync)
+        self._read_options = {}
+        for verify_checksums in (False, True):
+            for fill_cache in (False, True):
+                self._read_options[verify_checksums, fill_cache] = \
+                        self._newReadOptions(verify_checksums, fill_cache)
+
+    def destroyOptions(self):
+        """Destroys the shared options, once every database is closed"""
+        write_options, self._write_options = self._write_options, {}
+        for options in write_options.itervalues():
+            self._destroyWriteOptions(options)
+        read_options, self._read_options = self._read_options, {}
+        for options in read_options.itervalues():
+            self._destroyReadOptions(options)
+
+    def _writeOptions(self, sync):
+        return self._write_options[bool(sync)]
+
+    def _readOptions(self, verify_checksums, fill_cache, snapshot):
+        if snapshot is None:
+            return self._read_options[bool(verify_checksums),
+                                      bool(fill_cache)]
+        return self._newReadOptions(verify_checksums, fill_cache, snapshot)
+
+    def _releaseReadOptions(self, options, snapshot):
+        if snapshot is not None:
+            self._destroyReadOptions(options)
+
+    def get(self, db, key, verify_checksums, fill_cache, snapshot):
+        options = self._readOptions(verify_checksums, fill_cache, snapshot)
+        try:
+            return self._get(db, options, key)
+        finally:
+            self._releaseReadOptions(options, snapshot)
+
+    def getMany(self, db, keys, verify_checksums, fill_cache, snapshot):
+        options = self._readOptions(verify_checksums, fill_cache, snapshot)
+        try:
+            return [self._get(db, options, key) for key in keys]
+        finally:
+            self._releaseReadOptions(options, snapshot)
+
+    def createIterator(self, db, verify_checksums, fill_cache, snapshot):
+        options = self._readOptions(verify_checksums, fill_cache, snapshot)
+        try:
+            return self._createIterator(db, options)
+        finally:
+            self._releaseReadOptions(options, snapshot)
+
+
+class _CTypesBackend(_Backend):
+
+    """The C API called through ctypes. Always available."""
+
+    name = "ctypes"
+
+    def _newWriteOptions(self, sync):
+        options = _ldb.leveldb_writeoptions_create()
+        _ldb.leveldb_writeoptions_set_sync(options, sync)
+        return options
 
-    def val(self):
+    def _newReadOptions(self, verify_checksums, fill_cache, snapshot=None):
+        options = _ldb.leveldb_readoptions_create()
+        _ldb.leveldb_readoptions_set_verify_checksums(options,
+                verify_checksums)
+        _ldb.leveldb_readoptions_set_fill_cache(options, fill_cache)
+        if snapshot is not None:
+            _ldb.leveldb_readoptions_set_snapshot(options, snapshot)
+        return options
+
+    def _destroyWriteOptions(self, options):
+        _ldb.leveldb_writeoptions_destroy(options)
+
+    def _destroyReadOptions(self, options):
+        _ldb.leveldb_readoptions_destroy(options)
+
+    def createCache(self, capacity):
+        return _ldb.leveldb_cache_create_lru(capacity)
+
+    def destroyCache(self, cache):
+        _ldb.leveldb_cache_destroy(cache)
+
+    def createBloomFilter(self, bits_per_key):
+        return _ldb.leveldb_filterpolicy_create_bloom(bits_per_key)
+
+    def destroyFilterPolicy(self, filter_policy):
+        _ldb.leveldb_filterpolicy_destroy(filter_policy)
+
+    def open(self, path, filter_policy, cache, create_if_missing,
+             error_if_exists, paranoid_checks, write_buffer_size,
+             max_open_files, block_size):
+        options = _ldb.leveldb_options_create()
+        _ldb.leveldb_options_set_filter_policy(options, filter_policy)
+        _ldb.leveldb_options_set_create_if_missing(options, create_if_missing)
+        _ldb.leveldb_options_set_error_if_exists(options, error_if_exists)
+        _ldb.leveldb_options_set_paranoid_checks(options, paranoid_checks)
+        _ldb.leveldb_options_set_write_buffer_size(options, write_buffer_size)
+        _ldb.leveldb_options_set_max_open_files(options, max_open_files)
+        _ldb.leveldb_options_set_cache(options, cache)
+        _ldb.leveldb_options_set_block_size(options, block_size)
+
+        error = ctypes.POINTER(ctypes.c_char)()
+        db = _ldb.leveldb_open(options, path, ctypes.byref(error))
+        _ldb.leveldb_options_destroy(options)
+        _checkError(error)
+        return db
+
+    def close(self, db):
+        _ldb.leveldb_close(db)
+
+    def put(self, db, key, val, sync):
+        error = ctypes.POINTER(ctypes.c_char)()
+        key, key_len = _readBuffer(key)
+        val, val_len = _readBuffer(val)
+        _ldb.leveldb_put(db, self._writeOptions(sync), key, key_len, val,
+                val_len, ctypes.byref(error))
+        _checkError(error)
+
+    def delete(self, db, key, sync):
+        error = ctypes.POINTER(ctypes.c_char)()
+        key, key_len = _readBuffer(key)
+        _ldb.leveldb_delete(db, self._writeOptions(sync), key, key_len,
+                ctypes.byref(error))
+        _checkError(error)
+
+    def write(self, db, puts, deletes, sync):
+        batch = _ldb.leveldb_writebatch_create()
+        try:
+            for key, val in puts:
+                key, key_len = _readBuffer(key)
+                val, val_len = _readBuffer(val)
+                _ldb.leveldb_writebatch_put(batch, key, key_len, val,
+                        val_len)
+            for key in deletes:
+                key, key_len = _readBuffer(key)
+                _ldb.leveldb_writebatch_delete(batch, key, key_len)
+            error = ctypes.POINTER(ctypes.c_char)()
+            _ldb.leveldb_write(db, self._writeOptions(sync), batch,
+                    ctypes.byref(error))
+        finally:
+            _ldb.leveldb_writebatch_destroy(batch)
+        _checkError(error)
+
+    def _get(self, db, options, key):
+        error = ctypes.POINTER(ctypes.c_char)()
+        size = ctypes.c_size_t(0)
+        key, key_len = _readBuffer(key)
+        val_p = _ldb.leveldb_get(db, options, key, key_len,
+                ctypes.byref(size), ctypes.byref(error))
+        if bool(val_p):
+            val = ctypes.string_at(val_p, size.value)
+            _ldb.leveldb_free(ctypes.cast(val_p, ctypes.c_void_p))
+        else:
+            val = None
+        _checkError(error)
+        return val
+
+    def _createIterator(self, db, options):
+        return _ldb.leveldb_create_iterator(db, options)
+
+    def destroyIterator(self, it):
+        _ldb.leveldb_iter_destroy(it)
+
+    def iterValid(self, it):
+        return bool(_ldb.leveldb_iter_valid(it))
+
+    def iterKey(self, it):
+        length = ctypes.c_size_t(0)
+        val_p = _ldb.leveldb_iter_key(it, ctypes.byref(length))
+        assert bool(val_p)
+        return ctypes.string_at(val_p, length.value)
+
+    def iterValue(self, it):
         length = ctypes.c_size_t(0)
-        val_p = _ldb.leveldb_iter_value(self._ref.ref, ctypes.byref(length))
+        val_p = _ldb.leveldb_iter_value(it, ctypes.byref(length))
         assert bool(val_p)
         return ctypes.string_at(val_p, length.value)
 
+    def iterItem(self, it):
+        length = ctypes.c_size_t(0)
+        key_p = _ldb.leveldb_iter_key(it, ctypes.byref(length))
+        key = ctypes.string_at(key_p, length.value)
+        val_p = _ldb.leveldb_iter_value(it, ctypes.byref(length))
+        return key, ctypes.string_at(val_p, length.value)
+
+    def _iterCheckError(self, it):
+        error = ctypes.POINTER(ctypes.c_char)()
+        _ldb.leveldb_iter_get_error(it, ctypes.byref(error))
+        _checkError(error)
+
+    def iterSeek(self, it, key):
+        key, key_len = _readBuffer(key)
+        _ldb.leveldb_iter_seek(it, key, key_len)
+        self._iterCheckError(it)
+
+    def iterSeekFirst(self, it):
+        _ldb.leveldb_iter_seek_to_first(it)
+        self._iterCheckError(it)
+
+    def iterSeekLast(self, it):
+        _ldb.leveldb_iter_seek_to_last(it)
+        self._iterCheckError(it)
+
+    def iterNext(self, it):
+        _ldb.leveldb_iter_next(it)
+        self._iterCheckError(it)
+
+    def iterPrev(self, it):
+        _ldb.leveldb_iter_prev(it)
+        self._iterCheckError(it)
+
+    def iterRead(self, it, count, backward=False):
+        # an iterator that fails becomes invalid, so checking for an error
+        # once at the end is enough
+        valid = _ldb.leveldb_iter_valid
+        key, value = _ldb.leveldb_iter_key, _ldb.leveldb_iter_value
+        step = _ldb.leveldb_iter_prev if backward else _ldb.leveldb_iter_next
+        string_at = ctypes.string_at
+        length = ctypes.c_size_t(0)
+        length_p = ctypes.byref(length)
+        rows = []
+        append = rows.append
+        for _ in xrange(count):
+            if not valid(it):
+                break
+            append(string_at(key(it, length_p), length.value))
+            append(string_at(value(it, length_p), length.value))
+            step(it)
+        self._iterCheckError(it)
+        return rows
+
+    def iterReadKeys(self, it, count, backward=False):
+        # iterRead without the values
+        valid, key = _ldb.leveldb_iter_valid, _ldb.leveldb_iter_key
+        step = _ldb.leveldb_iter_prev if backward else _ldb.leveldb_iter_next
+        string_at = ctypes.string_at
+        length = ctypes.c_size_t(0)
+        length_p = ctypes.byref(length)
+        keys = []
+        append = keys.append
+        for _ in xrange(count):
+            if not valid(it):
+                break
+            append(string_at(key(it, length_p), length.value))
+            step(it)
+        self._iterCheckError(it)
+        return keys
+
+    def approximateSizes(self, db, ranges):
+        key_type = ctypes.c_void_p * len(ranges)
+        len_type = ctypes.c_size_t * len(ranges)
+        start_keys, start_lens = key_type(), len_type()
+        end_keys, end_lens = key_type(), len_type()
+        sizes = (ctypes.c_uint64 * len(ranges))()
+        for i, (start_key, end_key) in enumerate(ranges):
+            start_keys[i] = ctypes.cast(start_key, ctypes.c_void_p)
+            end_keys[i] = ctypes.cast(end_key, ctypes.c_void_p)
+            start_lens[i], end_lens[i] = len(start_key), len(end_key)
+        _ldb.leveldb_approximate_sizes(db, len(ranges), start_keys,
+                start_lens, end_keys, end_lens, sizes)
+        return list(sizes)
+
+    def compactRange(self, db, start_key, end_key):
+        _ldb.leveldb_compact_range(db, start_key, len(start_key or ""),
+                end_key, len(end_key or ""))
+
+    def createSnapshot(self, db):
+        return _ldb.leveldb_create_snapshot(db)
+
+    def releaseSnapshot(self, db, snapshot):
+        _ldb.leveldb_release_snapshot(db, snapshot)
+
+
+_CFFI_CDEF = """
+typedef struct leveldb_t leveldb_t;
+typedef struct leveldb_cache_t leveldb_cache_t;
+typedef struct leveldb_filterpolicy_t leveldb_filterpolicy_t;
+typedef struct leveldb_iterator_t leveldb_iterator_t;
+typedef struct leveldb_options_t leveldb_options_t;
+typedef struct leveldb_readoptions_t leveldb_readoptions_t;
+typedef struct leveldb_snapshot_t leveldb_snapshot_t;
+typedef struct leveldb_writebatch_t leveldb_writebatch_t;
+typedef struct leveldb_writeoptions_t leveldb_writeoptions_t;
+
+leveldb_t* leveldb_open(const leveldb_options_t* options, const char* name,
+                        char** errptr);
+void leveldb_close(leveldb_t* db);
+void leveldb_put(leveldb_t* db, const leveldb_writeoptions_t* options,
+                 const char* key, size_t keylen, const char* val,
+                 size_t vallen, char** errptr);
+void leveldb_delete(leveldb_t* db, const leveldb_writeoptions_t* options,
+                    const char* key, size_t keylen, char** errptr);
+void leveldb_write(leveldb_t* db, const leveldb_writeoptions_t* options,
+                   leveldb_writebatch_t* batch, char** errptr);
+char* leveldb_get(leveldb_t* db, const leveldb_readoptions_t* options,
+                  const char* key, size_t keylen, size_t* vallen,
+                  char** errptr);
+leveldb_iterator_t* leveldb_create_iterator(
+        leveldb_t* db, const leveldb_readoptions_t* options);
+const leveldb_snapshot_t* leveldb_create_snapshot(leveldb_t* db);
+void leveldb_release_snapshot(leveldb_t* db,
+                              const leveldb_snapshot_t* snapshot);
+void leveldb_approximate_sizes(
+        leveldb_t* db, int num_ranges,
+        const char* const* range_start_key,
+        const size_t* range_start_key_len,
+        const char* const* range_limit_key,
+        const size_t* range_limit_key_len, uint64_t* sizes);
+void leveldb_compact_range(leveldb_t* db, const char* start_key,
+                           size_t start_key_len, const char* limit_key,
+                           size_t limit_key_len);
+
+void leveldb_iter_destroy(leveldb_iterator_t*);
+unsigned char leveldb_iter_valid(const leveldb_iterator_t*);
+void leveldb_iter_seek_to_first(leveldb_iterator_t*);
+void leveldb_iter_seek_to_last(leveldb_iterator_t*);
+void leveldb_iter_seek(leveldb_iterator_t*, const char* k, size_t klen);
+void leveldb_iter_next(leveldb_iterator_t*);
+void leveldb_iter_prev(leveldb_iterator_t*);
+const char* leveldb_iter_key(const leveldb_iterator_t*, size_t* klen);
+const char* leveldb_iter_value(const leveldb_iterator_t*, size_t* vlen);
+void leveldb_iter_get_error(const leveldb_iterator_t*, char** errptr);
+
+leveldb_writebatch_t* leveldb_writebatch_create();
+void leveldb_writebatch_destroy(leveldb_writebatch_t*);
+void leveldb_writebatch_put(leveldb_writebatch_t*, const char* key,
+                            size_t klen, const char* val, size_t vlen);
+void leveldb_writebatch_delete(leveldb_writebatch_t*, const char* key,
+                               size_t klen);
+
+leveldb_options_t* leveldb_options_create();
+void leveldb_options_destroy(leveldb_options_t*);
+void leveldb_options_set_filter_policy(leveldb_options_t*,
+                                       leveldb_filterpolicy_t*);
+void leveldb_options_set_create_if_missing(leveldb_options_t*,
+                                           unsigned char);
+void leveldb_options_set_error_if_exists(leveldb_options_t*, unsigned char);
+void leveldb_options_set_paranoid_checks(leveldb_options_t*, unsigned char);
+void leveldb_options_set_cache(leveldb_options_t*, leveldb_cache_t*);
+void leveldb_options_set_write_buffer_size(leveldb_options_t*, size_t);
+void leveldb_options_set_max_open_files(leveldb_options_t*, int);
+void leveldb_options_set_block_size(leveldb_options_t*, size_t);
+
+leveldb_filterpolicy_t* leveldb_filterpolicy_create_bloom(int bits_per_key);
+void leveldb_filterpolicy_destroy(leveldb_filterpolicy_t*);
+
+leveldb_readoptions_t* leveldb_readoptions_create();
+void leveldb_readoptions_destroy(leveldb_readoptions_t*);
+void leveldb_readoptions_set_verify_checksums(leveldb_readoptions_t*,
+                                              unsigned char);
+void leveldb_readoptions_set_fill_cache(leveldb_readoptions_t*,
+                                        unsigned char);
+void leveldb_readoptions_set_snapshot(leveldb_readoptions_t*,
+                                      const leveldb_snapshot_t*);
+
+leveldb_writeoptions_t* leveldb_writeoptions_create();
+void leveldb_writeoptions_destroy(leveldb_writeoptions_t*);
+void leveldb_writeoptions_set_sync(leveldb_writeoptions_t*, unsigned char);
+
+leveldb_cache_t* leveldb_cache_create_lru(size_t capacity);
+void leveldb_cache_destroy(leveldb_cache_t* cache);
+
+void leveldb_free(void* ptr);
+"""
+
+# fused helpers, only available in API mode, that each replace several calls
+_CFFI_HELPERS_CDEF = """
+void leveldb_py_iter_entry(const leveldb_iterator_t* it, const char** key,
+                           size_t* klen, const char** val, size_t* vlen);
+void leveldb_py_iter_step(leveldb_iterator_t* it, int forward,
+                          char** errptr);
+size_t leveldb_py_iter_read(leveldb_iterator_t* it, int forward,
+                            size_t count, char* buf, size_t buf_len,
+                            size_t* lengths);
+"""
+
+_CFFI_SOURCE = """
+#include <string.h>
+#include <leveldb/c.h>
+
+static void leveldb_py_iter_entry(const leveldb_iterator_t* it,
+                                  const char** key, size_t* klen,
+                                  const char** val, size_t* vlen) {
+    *key = leveldb_iter_key(it, klen);
+    *val = leveldb_iter_value(it, vlen);
+}
+
+static void leveldb_py_iter_step(leveldb_iterator_t* it, int forward,
+                                 char** errptr) {
+    if (forward) {
+        leveldb_iter_next(it);
+    } else {
+        leveldb_iter_prev(it);
+    }
+    leveldb_iter_get_error(it, errptr);
+}
+
+/* copies up to count rows, keys and values back to back, into buf, and
+   their lengths into lengths. returns how many rows fit. when not even the
+   first row fits, its lengths are still filled in. */
+static size_t leveldb_py_iter_read(leveldb_iterator_t* it, int forward,
+                                   size_t count, char* buf, size_t buf_len,
+                                   size_t* lengths) {
+    size_t rows = 0, used = 0, klen, vlen;
+    const char *key, *val;
+    while (rows < count && leveldb_iter_valid(it)) {
+        key = leveldb_iter_key(it, &klen);
+        val = leveldb_iter_value(it, &vlen);
+        lengths[2 * rows] = klen;
+        lengths[2 * rows + 1] = vlen;
+        if (klen + vlen > buf_len - used) {
+            break;
+        }
+        memcpy(buf + used, key, klen);
+        memcpy(buf + used + klen, val, vlen);
+        used += klen + vlen;
+        rows++;
+        if (forward) {
+            leveldb_iter_next(it);
+        } else {
+            leveldb_iter_prev(it);
+        }
+    }
+    return rows;
+}
+"""
+
+
+def buildCFFIModule(tmpdir=".", **kwargs):
+    """Compiles _leveldb_cffi, the cffi backend's API mode module, into
+    tmpdir. Given its path as cffi_module to loadLibrary (or in the
+    LEVELDB_CFFI_MODULE environment variable), the cffi backend uses it
+    instead of loading the shared library in ABI mode, which is faster and
+    adds fused helpers for iteration. Needs cffi, a C compiler and the
+    LevelDB headers. kwargs are passed to cffi's set_source, e.g.
+    include_dirs and library_dirs.
+
+    @return: the path of the compiled module
+    @rtype: string
+    """
+    import cffi
+    kwargs.setdefault("libraries", ["leveldb"])
+    ffi = cffi.FFI()
+    ffi.cdef(_CFFI_CDEF + _CFFI_HELPERS_CDEF)
+    ffi.set_source("_leveldb_cffi", _CFFI_SOURCE, **kwargs)
+    return ffi.compile(tmpdir=tmpdir)
+
+
+def _loadCFFI(path=None, module=None):
+    """Returns the ffi and lib for the cffi backend, from the compiled API
+    mode module at module if given and otherwise in ABI mode. Raises
+    ImportError if cffi isn't installed."""
+    if module is not None:
+        module = imp.load_dynamic("_leveldb_cffi", module)
+        if not hasattr(module.lib, "leveldb_py_iter_read"):
+            raise Error("%s was not built by buildCFFIModule" %
+                        module.__file__)
+        return module.ffi, module.lib
+    import cffi
+    ffi = cffi.FFI()
+    ffi.cdef(_CFFI_CDEF)
+    return ffi, ffi.dlopen(_libraryPath(path))
+
+
+class _CFFIBackend(_Backend):
+
+    """The C API called through cffi, which costs far less per call than
+    ctypes, especially on PyPy.
+    """
+
+    name = "cffi"
+
+    def __init__(self, ffi, lib):
+        self._ffi = ffi
+        self._lib = lib
+        self._null = ffi.NULL
+        if hasattr(lib, "leveldb_py_iter_entry"):
+            self.iterItem = self._iterEntry
+            self.iterNext = functools.partial(self._iterStep, forward=1)
+            self.iterPrev = functools.partial(self._iterStep, forward=0)
+            self.iterRead = self._iterReadBlocks
+        _Backend.__init__(self)
+
+    def _readBuffer(self, data):
+        # see _readBuffer. cffi handles every kind of buffer itself
+        if isinstance(data, str):
+            return data, len(data)
+        if isinstance(data, unicode):
+            raise TypeError("keys and values must be bytes, not unicode")
+        data = self._ffi.from_buffer(data)
+        return data, len(data)
+
+    def _checkError(self, error):
+        if error[0] != self._null:
+            message = self._ffi.string(error[0])
+            self._lib.leveldb_free(error[0])
+            raise Error(message)
+
+    def _newWriteOptions(self, sync):
+        options = self._lib.leveldb_writeoptions_create()
+        self._lib.leveldb_writeoptions_set_sync(options, sync)
+        return options
+
+    def _newReadOptions(self, verify_checksums, fill_cache, snapshot=None):
+        lib = self._lib
+        options = lib.leveldb_readoptions_create()
+        lib.leveldb_readoptions_set_verify_checksums(options,
+                verify_checksums)
+        lib.leveldb_readoptions_set_fill_cache(options, fill_cache)
+        if snapshot is not None:
+            lib.leveldb_readoptions_set_snapshot(options, snapshot)
+        return options
+
+    def _destroyWriteOptions(self, options):
+        self._lib.leveldb_writeoptions_destroy(options)
+
+    def _destroyReadOptions(self, options):
+        self._lib.leveldb_readoptions_destroy(options)
+
+    def createCache(self, capacity):
+        return self._lib.leveldb_cache_create_lru(capacity)
+
+    def destroyCache(self, cache):
+        self._lib.leveldb_cache_destroy(cache)
+
+    def createBloomFilter(self, bits_per_key):
+        return self._lib.leveldb_filterpolicy_create_bloom(bits_per_key)
+
+    def destroyFilterPolicy(self, filter_policy):
+        self._lib.leveldb_filterpolicy_destroy(filter_policy)
+
+    def open(self, path, filter_policy, cache, create_if_missing,
+             error_if_exists, paranoid_checks, write_buffer_size,
+             max_open_files, block_size):
+        lib = self._lib
+        options = lib.leveldb_options_create()
+        lib.leveldb_options_set_filter_policy(options, filter_policy)
+        lib.leveldb_options_set_create_if_missing(options, create_if_missing)
+        lib.leveldb_options_set_error_if_exists(options, error_if_exists)
+        lib.leveldb_options_set_paranoid_checks(options, paranoid_checks)
+        lib.leveldb_options_set_write_buffer_size(options, write_buffer_size)
+        lib.leveldb_options_set_max_open_files(options, max_open_files)
+        lib.leveldb_options_set_cache(options, cache)
+        lib.leveldb_options_set_block_size(options, block_size)
+
+        error = self._ffi.new("char**")
+        db = lib.leveldb_open(options, path, error)
+        lib.leveldb_options_destroy(options)
+        self._checkError(error)
+        return db
+
+    def close(self, db):
+        self._lib.leveldb_close(db)
+
+    def put(self, db, key, val, sync):
+        error = self._ffi.new("char**")
+        key, key_len = self._readBuffer(key)
+        val, val_len = self._readBuffer(val)
+        self._lib.leveldb_put(db, self._writeOptions(sync), key, key_len,
+                val, val_len, error)
+        self._checkError(error)
+
+    def delete(self, db, key, sync):
+        error = self._ffi.new("char**")
+        key, key_len = self._readBuffer(key)
+        self._lib.leveldb_delete(db, self._writeOptions(sync), key, key_len,
+                error)
+        self._checkError(error)
+
+    def write(self, db, puts, deletes, sync):
+        lib = self._lib
+        batch = lib.leveldb_writebatch_create()
+        try:
+            for key, val in puts:
+                key, key_len = self._readBuffer(key)
+                val, val_len = self._readBuffer(val)
+                lib.leveldb_writebatch_put(batch, key, key_len, val, val_len)
+            for key in deletes:
+                key, key_len = self._readBuffer(key)
+                lib.leveldb_writebatch_delete(batch, key, key_len)
+            error = self._ffi.new("char**")
+            lib.leveldb_write(db, self._writeOptions(sync), batch, error)
+        finally:
+            lib.leveldb_writebatch_destroy(batch)
+        self._checkError(error)
+
+    def _get(self, db, options, key):
+        ffi, lib = self._ffi, self._lib
+        error = ffi.new("char**")
+        size = ffi.new("size_t*")
+        key, key_len = self._readBuffer(key)
+        val_p = lib.leveldb_get(db, options, key, key_len, size, error)
+        if val_p != self._null:
+            val = ffi.unpack(val_p, size[0])
+            lib.leveldb_free(val_p)
+        else:
+            val = None
+        self._checkError(error)
+        return val
+
+    def _createIterator(self, db, options):
+        return self._lib.leveldb_create_iterator(db, options)
+
+    def destroyIterator(self, it):
+        self._lib.leveldb_iter_destroy(it)
+
+    def iterValid(self, it):
+        return bool(self._lib.leveldb_iter_valid(it))
+
+    def iterKey(self, it):
+        length = self._ffi.new("size_t*")
+        key_p = self._lib.leveldb_iter_key(it, length)
+        assert key_p != self._null
+        return self._ffi.unpack(key_p, length[0])
+
+    def iterValue(self, it):
+        length = self._ffi.new("size_t*")
+        val_p = self._lib.leveldb_iter_value(it, length)
+        assert val_p != self._null
+        return self._ffi.unpack(val_p, length[0])
+
+    def iterItem(self, it):
+        ffi, lib = self._ffi, self._lib
+        length = ffi.new("size_t*")
+        key = ffi.unpack(lib.leveldb_iter_key(it, length), length[0])
+        val = ffi.unpack(lib.leveldb_iter_value(it, length), length[0])
+        return key, val
+
+    def _iterEntry(self, it):
+        ffi = self._ffi
+        entry = ffi.new("const char*[2]")
+        lengths = ffi.new("size_t[2]")
+        self._lib.leveldb_py_iter_entry(it, entry, lengths, entry + 1,
+                lengths + 1)
+        return (ffi.unpack(entry[0], lengths[0]),
+                ffi.unpack(entry[1], lengths[1]))
+
+    # the size of the buffer _iterReadBlocks copies rows into at first
+    _READ_BLOCK_SIZE = 64 * 1024
+
+    def _iterReadBlocks(self, it, count, backward=False):
+        ffi, read = self._ffi, self._lib.leveldb_py_iter_read
+        buf_len = self._READ_BLOCK_SIZE
+        buf = ffi.new("char[]", buf_len)
+        lengths = ffi.new("size_t[]", 2 * count)
+        rows = []
+        append = rows.append
+        while len(rows) < 2 * count:
+            read_count = read(it, not backward, count - len(rows) // 2, buf,
+                              buf_len, lengths)
+            if read_count == 0:
+                if not self.iterValid(it):
+                    break
+                # the next row doesn't fit
+                buf_len = max(2 * buf_len, lengths[0] + lengths[1])
+                buf = ffi.new("char[]", buf_len)
+                continue
+            block = ffi.buffer(buf)
+            pos = 0
+            for length in ffi.unpack(lengths, 2 * read_count):
+                append(block[pos:pos + length])
+                pos += length
+        self._iterCheckError(it)
+        return rows
+
+    def _iterStep(self, it, forward):
+        error = self._ffi.new("char**")
+        self._lib.leveldb_py_iter_step(it, forward, error)
+        self._checkError(error)
+
+    def _iterCheckError(self, it):
+        error = self._ffi.new("char**")
+        self._lib.leveldb_iter_get_error(it, error)
+        self._checkError(error)
+
+    def iterSeek(self, it, key):
+        key, key_len = self._readBuffer(key)
+        self._lib.leveldb_iter_seek(it, key, key_len)
+        self._iterCheckError(it)
+
+    def iterSeekFirst(self, it):
+        self._lib.leveldb_iter_seek_to_first(it)
+        self._iterCheckError(it)
+
+    def iterSeekLast(self, it):
+        self._lib.leveldb_iter_seek_to_last(it)
+        self._iterCheckError(it)
+
+    def iterNext(self, it):
+        self._lib.leveldb_iter_next(it)
+        self._iterCheckError(it)
+
+    def iterPrev(self, it):
+        self._lib.leveldb_iter_prev(it)
+        self._iterCheckError(it)
+
+    def iterRead(self, it, count, backward=False):
+        # see _CTypesBackend.iterRead
+        lib, unpack = self._lib, self._ffi.unpack
+        valid, key, value = (lib.leveldb_iter_valid, lib.leveldb_iter_key,
+                             lib.leveldb_iter_value)
+        step = lib.leveldb_iter_prev if backward else lib.leveldb_iter_next
+        length = self._ffi.new("size_t*")
+        rows = []
+        append = rows.append
+        for _ in xrange(count):
+            if not valid(it):
+                break
+            append(unpack(key(it, length), length[0]))
+            append(unpack(value(it, length), length[0]))
+            step(it)
+        self._iterCheckError(it)
+        return rows
+
+    def iterReadKeys(self, it, count, backward=False):
+        # see _CTypesBackend.iterReadKeys
+        lib, unpack = self._lib, self._ffi.unpack
+        valid, key = lib.leveldb_iter_valid, lib.leveldb_iter_key
+        step = lib.leveldb_iter_prev if backward else lib.leveldb_iter_next
+        length = self._ffi.new("size_t*")
+        keys = []
+        append = keys.append
+        for _ in xrange(count):
+            if not valid(it):
+                break
+            append(unpack(key(it, length), length[0]))
+            step(it)
+        self._iterCheckError(it)
+        return keys
+
+    def approximateSizes(self, db, ranges):
+        ffi = self._ffi
+        # the key buffers have to outlive the call
+        start_keys = [ffi.new("char[]", start) for start, _ in ranges]
+        end_keys = [ffi.new("char[]", end) for _, end in ranges]
+        sizes = ffi.new("uint64_t[]", len(ranges))
+        self._lib.leveldb_approximate_sizes(db, len(ranges),
+                ffi.new("char*[]", start_keys),
+                ffi.new("size_t[]", [len(start) for start, _ in ranges]),
+                ffi.new("char*[]", end_keys),
+                ffi.new("size_t[]", [len(end) for _, end in ranges]), sizes)
+        return list(sizes)
+
+    def compactRange(self, db, start_key, end_key):
+        null = self._null
+        self._lib.leveldb_compact_range(db,
+                null if start_key is None else start_key,
+                len(start_key or ""), null if end_key is None else end_key,
+                len(end_key or ""))
+
+    def createSnapshot(self, db):
+        return self._lib.leveldb_create_snapshot(db)
+
+    def releaseSnapshot(self, db, snapshot):
+        self._lib.leveldb_release_snapshot(db, snapshot)
+
+
+def _createBackend(name=None, path=None, cffi_module=None):
+    if name is None:
+        name = os.environ.get("LEVELDB_BACKEND") or "ctypes"
+    if name not in ("cffi", "ctypes"):
+        raise ValueError("unknown leveldb backend %r" % name)
+    if name == "cffi":
+        if cffi_module is None:
+            cffi_module = os.environ.get("LEVELDB_CFFI_MODULE")
+        ffi, lib = _loadCFFI(path, cffi_module)
+        return _CFFIBackend(ffi, lib)
+    _ldb.load(path)
+    return _CTypesBackend()
+
+
+class _BackendProxy(object):
+
+    """Forwards to the backend in use, which is picked the first time any
+    method is used. Like _Library, each method is cached as an attribute
+    after its first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backend = None
+
+    def select(self, name=None, path=None, cffi_module=None):
+        with self._lock:
+            if self._backend is None:
+                self._backend = _createBackend(name, path, cffi_module)
+            return self._backend
+
+    def reset(self):
+        """Forgets the backend in use, if any, and destroys its shared
+        options, so the next use picks one again. Every database must be
+        closed first."""
+        with self._lock:
+            backend, self._backend = self._backend, None
+            for name in self.__dict__.keys():
+                if not name.startswith("_"):
+                    del self.__dict__[name]
+        if backend is not None:
+            backend.destroyOptions()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        attr = getattr(self.select(), name)
+        setattr(self, name, attr)
+        return attr
+
+
+_backend = _BackendProxy()
+
+
+class _IteratorDbImpl(object):
+
+    __slots__ = ["_ref"]
+
+    def __init__(self, iterator_ref):
+        self._ref = iterator_ref
+
+    def valid(self):
+        return _backend.iterValid(self._ref.ref)
+
+    def key(self):
+        return _backend.iterKey(self._ref.ref)
+
+    def val(self):
+        return _backend.iterValue(self._ref.ref)
+
+    def item(self):
+        return _backend.iterItem(self._ref.ref)
+
+    def readRows(self, count, backward=False):
+        return _backend.iterRead(self._ref.ref, count, backward)
+
+    def readKeys(self, count, backward=False):
+        return _backend.iterReadKeys(self._ref.ref, count, backward)
+
     def seek(self, key):
-        _ldb.leveldb_iter_seek(self._ref.ref, key, len(key))
-        self._checkError()
+        _backend.iterSeek(self._ref.ref, key)
 
     def seekFirst(self):
-        _ldb.leveldb_iter_seek_to_first(self._ref.ref)
-        self._checkError()
+        _backend.iterSeekFirst(self._ref.ref)
 
     def seekLast(self):
-        _ldb.leveldb_iter_seek_to_last(self._ref.ref)
-        self._checkError()
+        _backend.iterSeekLast(self._ref.ref)
 
     def prev(self):
-        _ldb.leveldb_iter_prev(self._ref.ref)
-        self._checkError()
+        _backend.iterPrev(self._ref.ref)
 
     def next(self):
-        _ldb.leveldb_iter_next(self._ref.ref)
-        self._checkError()
-
-    def _checkError(self):
-        error = ctypes.POINTER(ctypes.c_char)()
-        _ldb.leveldb_iter_get_error(self._ref.ref, ctypes.byref(error))
-        _checkError(error)
+        _backend.iterNext(self._ref.ref)
 
     def close(self):
       self._ref.close()
 
 
+class _PooledIteratorDbImpl(_IteratorDbImpl):
+
+    """An iterator checked out of an _IteratorPool. Closing it checks it back
+    in instead of destroying it."""
+
+    __slots__ = ["_pool", "_options", "_entry", "_positioned"]
+
+    def __init__(self, pool, options, entry):
+        _IteratorDbImpl.__init__(self, entry[0])
+        self._pool = pool
+        self._options = options
+        self._entry = entry
+        # a new iterator is invalid until it is positioned, so a reused one
+        # has to be too
+        self._positioned = False
+
+    def valid(self):
+        return self._positioned and _IteratorDbImpl.valid(self)
+
+    def readRows(self, count, backward=False):
+        if not self._positioned:
+            return []
+        return _IteratorDbImpl.readRows(self, count, backward)
+
+    def readKeys(self, count, backward=False):
+        if not self._positioned:
+            return []
+        return _IteratorDbImpl.readKeys(self, count, backward)
+
+    def seek(self, key):
+        _IteratorDbImpl.seek(self, key)
+        self._positioned = True
+
+    def seekFirst(self):
+        _IteratorDbImpl.seekFirst(self)
+        self._positioned = True
+
+    def seekLast(self):
+        _IteratorDbImpl.seekLast(self)
+        self._positioned = True
+
+    def close(self):
+        entry, self._entry = self._entry, None
+        self._ref = None
+        if entry is not None:
+            self._pool.checkin(self._options, entry)
+
+
+class _IteratorPool(object):
+
+    """Idle iterators of one database or snapshot, by read options. Entries
+    are (iterator _PointerRef, creation time, times checked out, generation)
+    tuples. Iterators past max_uses or max_age, or created before the last
+    write (which bumps generation), are destroyed instead of reused."""
+
+    __slots__ = ["_size", "_max_uses", "_max_age", "_idle", "_lock",
+                 "generation"]
+
+    def __init__(self, size, max_uses, max_age):
+        self._size = size
+        self._max_uses = max_uses
+        self._max_age = max_age
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def clear(self):
+        """Destroys the idle iterators"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for entries in idle.itervalues():
+            for entry in entries:
+                entry[0].close()
+
+    def idleRefs(self):
+        """Returns the _PointerRefs of the idle iterators"""
+        with self._lock:
+            return set(entry[0] for entries in self._idle.itervalues()
+                       for entry in entries)
+
+    def emptyCopy(self):
+        return _IteratorPool(self._size, self._max_uses, self._max_age)
+
+    def _fresh(self, entry, now):
+        it_ref, created, uses, generation = entry
+        return (it_ref.ref is not None and uses < self._max_uses and
+                now - created < self._max_age and
+                generation == self.generation)
+
+    def checkout(self, options):
+        """Returns an idle entry to reuse, or None"""
+        now, stale = time.time(), []
+        try:
+            with self._lock:
+                idle = self._idle.get(options)
+                while idle:
+                    entry = idle.pop()
+                    if self._fresh(entry, now):
+                        return entry[0], entry[1], entry[2] + 1, entry[3]
+                    stale.append(entry[0])
+        finally:
+            for it_ref in stale:
+                it_ref.close()
+        return None
+
+    def checkin(self, options, entry):
+        with self._lock:
+            idle = self._idle.setdefault(options, [])
+            if len(idle) < self._size and self._fresh(entry, time.time()):
+                idle.append(entry)
+                return
+        entry[0].close()
+
+
+class Cache(object):
+
+    """An LRU block cache of capacity bytes. One Cache may be passed to many
+    DB() calls, so that all of those databases share a single memory budget.
+
+    The cache is destroyed once it is garbage collected, which can't happen
+    while any database using it is open. Closing it explicitly closes every
+    database still using it first.
+    """
+
+    __slots__ = ["_ref", "capacity"]
+
+    def __init__(self, capacity=(8 * 1024 * 1024)):
+        self.capacity = capacity
+        self._ref = _PointerRef(_backend.createCache(capacity),
+                                _backend.destroyCache)
+
+    def close(self):
+        self._ref.close()
+
+
+class BloomFilterPolicy(object):
+
+    """A bloom filter policy using bits_per_key bits per key. Like Cache, one
+    BloomFilterPolicy may be shared by many DB() calls.
+    """
+
+    __slots__ = ["_ref", "bits_per_key"]
+
+    def __init__(self, bits_per_key=10):
+        self.bits_per_key = bits_per_key
+        self._ref = _PointerRef(_backend.createBloomFilter(bits_per_key),
+                                _backend.destroyFilterPolicy)
+
+    def close(self):
+        self._ref.close()
+
+
 def DB(path, bloom_filter_size=10, create_if_missing=False,
        error_if_exists=False, paranoid_checks=False,
        write_buffer_size=(4 * 1024 * 1024), max_open_files=1000,
        block_cache_size=(8 * 1024 * 1024), block_size=(4 * 1024),
        default_sync=False, default_verify_checksums=False,
-       default_fill_cache=True):
+       default_fill_cache=True, cache=None, filter_policy=None,
+       iterator_pool_size=0, iterator_max_uses=1000, iterator_max_age=1.0,
+       value_codec=None):
     """This is the expected way to open a database. Returns a DBInterface.
+
+    To share a block cache or bloom filter policy between databases, pass a
+    Cache as cache or a BloomFilterPolicy as filter_policy. These override
+    block_cache_size and bloom_filter_size, and stay open when the database
+    is closed. Otherwise, each database gets its own.
+
+    If iterator_pool_size is more than 0, up to that many closed iterators
+    are kept for reuse (per snapshot, and per set of read options), which
+    makes many short scans much cheaper. An iterator only sees the database
+    as it was when the iterator was created, so every write through the
+    database makes the idle iterators stale, and they are replaced. They
+    are also replaced once they have been used iterator_max_uses times or
+    are iterator_max_age seconds old, so they don't hold on to old files.
+
+    If value_codec (such as a ZlibCodec) is given, values are encoded with
+    it as they are written and decoded as they are read.
     """
 
-    filter_policy = _PointerRef(
-            _ldb.leveldb_filterpolicy_create_bloom(bloom_filter_size),
-            _ldb.leveldb_filterpolicy_destroy)
-    cache = _PointerRef(
-            _ldb.leveldb_cache_create_lru(block_cache_size),
-            _ldb.leveldb_cache_destroy)
-
-    options = _ldb.leveldb_options_create()
-    _ldb.leveldb_options_set_filter_policy(
-            options, filter_policy.ref)
-    _ldb.leveldb_options_set_create_if_missing(options, create_if_missing)
-    _ldb.leveldb_options_set_error_if_exists(options, error_if_exists)
-    _ldb.leveldb_options_set_paranoid_checks(options, paranoid_checks)
-    _ldb.leveldb_options_set_write_buffer_size(options, write_buffer_size)
-    _ldb.leveldb_options_set_max_open_files(options, max_open_files)
-    _ldb.leveldb_options_set_cache(options, cache.ref)
-    _ldb.leveldb_options_set_block_size(options, block_size)
-
-    error = ctypes.POINTER(ctypes.c_char)()
-    db = _ldb.leveldb_open(options, path, ctypes.byref(error))
-    _ldb.leveldb_options_destroy(options)
-    _checkError(error)
-
-    db = _PointerRef(db, _ldb.leveldb_close)
-    filter_policy.addReferrer(db)
-    cache.addReferrer(db)
-
-    return DBInterface(_LevelDBImpl(db, other_objects=(filter_policy, cache)),
-                       allow_close=True, default_sync=default_sync,
+    owned, shared = [], []
+    if filter_policy is None:
+        filter_policy = BloomFilterPolicy(bloom_filter_size)
+        owned.append(filter_policy)
+    else:
+        shared.append(filter_policy)
+    if cache is None:
+        cache = Cache(block_cache_size)
+        owned.append(cache)
+    else:
+        shared.append(cache)
+
+    db = _PointerRef(
+            _backend.open(path, filter_policy._ref.ref, cache._ref.ref,
+                          create_if_missing=create_if_missing,
+                          error_if_exists=error_if_exists,
+                          paranoid_checks=paranoid_checks,
+                          write_buffer_size=write_buffer_size,
+                          max_open_files=max_open_files,
+                          block_size=block_size),
+            _backend.close)
+    filter_policy._ref.addReferrer(db)
+    cache._ref.addReferrer(db)
+
+    iterators = None
+    if iterator_pool_size > 0:
+        iterators = _IteratorPool(iterator_pool_size, iterator_max_uses,
+                                  iterator_max_age)
+    impl = _LevelDBImpl(db, other_objects=tuple(owned),
+                        shared_objects=tuple(shared), iterators=iterators)
+    if value_codec is not None:
+        impl = _CodecDBImpl(impl, value_codec)
+    return DBInterface(impl, allow_close=True, default_sync=default_sync,
                        default_verify_checksums=default_verify_checksums,
                        default_fill_cache=default_fill_cache)
 
 
 class _LevelDBImpl(object):
 
-    __slots__ = ["_objs", "_db", "_snapshot"]
+    # other_objects are closed along with the database. shared_objects are
+    # only kept alive for as long as the database is. iterators is an
+    # _IteratorPool, or None to create a new iterator every time.
+    __slots__ = ["_objs", "_shared", "_db", "_snapshot", "_iterators",
+                 "__weakref__"]
 
-    def __init__(self, db_ref, snapshot_ref=None, other_objects=()):
+    def __init__(self, db_ref, snapshot_ref=None, other_objects=(),
+                 shared_objects=(), iterators=None):
         self._objs = other_objects
+        self._shared = shared_objects
         self._db = db_ref
         self._snapshot = snapshot_ref
+        self._iterators = iterators
 
     def close(self):
+        if self._snapshot is not None:
+            # closing a snapshot only releases the snapshot
+            self._snapshot.close()
+            if self._iterators is not None:
+                self._iterators.clear()
+            return
         db, self._db = self._db, None
         objs, self._objs = self._objs, ()
+        self._shared = ()
         if db is not None:
             db.close()
         for obj in objs:
             obj.close()
 
+    def _wrote(self):
+        # pooled iterators don't see writes made after they were created
+        if self._iterators is not None:
+            self._iterators.generation += 1
+
     def put(self, key, val, sync=False):
         if self._snapshot is not None:
             raise TypeError("cannot put on leveldb snapshot")
-        error = ctypes.POINTER(ctypes.c_char)()
-        options = _ldb.leveldb_writeoptions_create()
-        _ldb.leveldb_writeoptions_set_sync(options, sync)
-        _ldb.leveldb_put(self._db.ref, options, key, len(key), val, len(val),
-                ctypes.byref(error))
-        _ldb.leveldb_writeoptions_destroy(options)
-        _checkError(error)
+        _backend.put(self._db.ref, key, val, sync)
+        self._wrote()
 
     def delete(self, key, sync=False):
         if self._snapshot is not None:
             raise TypeError("cannot delete on leveldb snapshot")
-        error = ctypes.POINTER(ctypes.c_char)()
-        options = _ldb.leveldb_writeoptions_create()
-        _ldb.leveldb_writeoptions_set_sync(options, sync)
-        _ldb.leveldb_delete(self._db.ref, options, key, len(key),
-                ctypes.byref(error))
-        _ldb.leveldb_writeoptions_destroy(options)
-        _checkError(error)
+        _backend.delete(self._db.ref, key, sync)
+        self._wrote()
+
+    def _snapshotRef(self):
+        if self._snapshot is None:
+            return None
+        if self._snapshot.ref is None:
+            raise Error("leveldb snapshot is closed")
+        return self._snapshot.ref
 
     def get(self, key, verify_checksums=False, fill_cache=True):
-        error = ctypes.POINTER(ctypes.c_char)()
-        options = _ldb.leveldb_readoptions_create()
-        _ldb.leveldb_readoptions_set_verify_checksums(options,
-                verify_checksums)
-        _ldb.leveldb_readoptions_set_fill_cache(options, fill_cache)
-        if self._snapshot is not None:
-            _ldb.leveldb_readoptions_set_snapshot(options, self._snapshot.ref)
-        size = ctypes.c_size_t(0)
-        val_p = _ldb.leveldb_get(self._db.ref, options, key, len(key),
-                ctypes.byref(size), ctypes.byref(error))
-        if bool(val_p):
-            val = ctypes.string_at(val_p, size.value)
-            _ldb.leveldb_free(ctypes.cast(val_p, ctypes.c_void_p))
-        else:
-            val = None
-        _ldb.leveldb_readoptions_destroy(options)
-        _checkError(error)
-        return val
+        return _backend.get(self._db.ref, key, verify_checksums, fill_cache,
+                            self._snapshotRef())
+
+    def getMany(self, keys, verify_checksums=False, fill_cache=True):
+        return _backend.getMany(self._db.ref, keys, verify_checksums,
+                                fill_cache, self._snapshotRef())
 
     # pylint: disable=W0212
     def write(self, batch, sync=False):
         if self._snapshot is not None:
             raise TypeError("cannot delete on leveldb snapshot")
-        real_batch = _ldb.leveldb_writebatch_create()
-        for key, val in batch._puts.iteritems():
-            _ldb.leveldb_writebatch_put(real_batch, key, len(key), val,
-                    len(val))
-        for key in batch._deletes:
-            _ldb.leveldb_writebatch_delete(real_batch, key, len(key))
-        error = ctypes.POINTER(ctypes.c_char)()
-        options = _ldb.leveldb_writeoptions_create()
-        _ldb.leveldb_writeoptions_set_sync(options, sync)
-        _ldb.leveldb_write(self._db.ref, options, real_batch,
-                ctypes.byref(error))
-        _ldb.leveldb_writeoptions_destroy(options)
-        _ldb.leveldb_writebatch_destroy(real_batch)
-        _checkError(error)
+        _backend.write(self._db.ref, batch._puts.iteritems(), batch._deletes,
+                       sync)
+        self._wrote()
 
-    def iterator(self, verify_checksums=False, fill_cache=True):
-        options = _ldb.leveldb_readoptions_create()
-        if self._snapshot is not None:
-            _ldb.leveldb_readoptions_set_snapshot(options, self._snapshot.ref)
-        _ldb.leveldb_readoptions_set_verify_checksums(
-                options, verify_checksums)
-        _ldb.leveldb_readoptions_set_fill_cache(options, fill_cache)
+    def _newIterator(self, verify_checksums, fill_cache):
         it_ref = _PointerRef(
-                _ldb.leveldb_create_iterator(self._db.ref, options),
-                _ldb.leveldb_iter_destroy)
-        _ldb.leveldb_readoptions_destroy(options)
+                _backend.createIterator(self._db.ref, verify_checksums,
+                                        fill_cache, self._snapshotRef()),
+                _backend.destroyIterator)
         self._db.addReferrer(it_ref)
-        return _IteratorDbImpl(it_ref)
+        return it_ref
+
+    def iterator(self, verify_checksums=False, fill_cache=True):
+        if self._iterators is None:
+            return _IteratorDbImpl(
+                    self._newIterator(verify_checksums, fill_cache))
+        options = (bool(verify_checksums), bool(fill_cache))
+        entry = self._iterators.checkout(options)
+        if entry is None:
+            # the generation is taken first, so a write that lands while
+            # the iterator is created makes it stale rather than missed
+            generation = self._iterators.generation
+            entry = (self._newIterator(verify_checksums, fill_cache),
+                     time.time(), 1, generation)
+        return _PooledIteratorDbImpl(self._iterators, options, entry)
 
     def approximateDiskSizes(self, *ranges):
         if self._snapshot is not None:
             raise TypeError("cannot calculate disk sizes on leveldb snapshot")
         assert len(ranges) > 0
-        key_type = ctypes.c_void_p * len(ranges)
-        len_type = ctypes.c_size_t * len(ranges)
-        start_keys, start_lens = key_type(), len_type()
-        end_keys, end_lens = key_type(), len_type()
-        sizes = (ctypes.c_uint64 * len(ranges))()
-        for i, range_ in enumerate(ranges):
+        for range_ in ranges:
             assert isinstance(range_, tuple) and len(range_) == 2
             assert isinstance(range_[0], str) and isinstance(range_[1], str)
-            start_keys[i] = ctypes.cast(range_[0], ctypes.c_void_p)
-            end_keys[i] = ctypes.cast(range_[1], ctypes.c_void_p)
-            start_lens[i], end_lens[i] = len(range_[0]), len(range_[1])
-        _ldb.leveldb_approximate_sizes(self._db.ref, len(ranges), start_keys,
-                start_lens, end_keys, end_lens, sizes)
-        return list(sizes)
+        return _backend.approximateSizes(self._db.ref, ranges)
 
     def compactRange(self, start_key, end_key):
-        assert isinstance(start_key, str) and isinstance(end_key, str)
-        _ldb.leveldb_compact_range(self._db.ref, start_key, len(start_key),
-                end_key, len(end_key))
+        # None means the start or end of the database
+        assert start_key is None or isinstance(start_key, str)
+        assert end_key is None or isinstance(end_key, str)
+        _backend.compactRange(self._db.ref, start_key, end_key)
 
     def snapshot(self):
+        # referrers are closed before the db itself, so the raw db pointer is
+        # still good by the time the snapshot gets released.
+        db = self._db.ref
         snapshot_ref = _PointerRef(
-                _ldb.leveldb_create_snapshot(self._db.ref),
-                lambda ref: _ldb.leveldb_release_snapshot(self._db.ref, ref))
+                _backend.createSnapshot(db),
+                lambda ref: _backend.releaseSnapshot(db, ref))
         self._db.addReferrer(snapshot_ref)
+        iterators = None
+        if self._iterators is not None:
+            iterators = self._iterators.emptyCopy()
         return _LevelDBImpl(self._db, snapshot_ref=snapshot_ref,
-                            other_objects=self._objs)
+                            other_objects=self._objs,
+                            shared_objects=self._shared,
+                            iterators=iterators)
+
+
+# The DBServer wire protocol. Every frame is a 5 byte header (payload length,
+# opcode or status) followed by the payload, which is a list of length
+# prefixed fields. Requests on a connection are answered in order, so a client
+# may pipeline as many requests as it likes before reading the responses.
+_FRAME_HEADER = struct.Struct("!IB")
+_FIELD_LENGTH = struct.Struct("!I")
+_UINT64 = struct.Struct("!Q")
+_NULL_LENGTH = 0xffffffff
+
+_OP_GET = 1
+_OP_PUT = 2
+_OP_DELETE = 3
+_OP_WRITE = 4
+_OP_ITER_OPEN = 5
+_OP_ITER_READ = 6
+_OP_SNAPSHOT = 7
+_OP_RELEASE = 8
+_OP_SIZES = 9
+_OP_COMPACT = 10
+_OP_VERSION = 11
+_OP_COMMIT = 12
+
+_STATUS_OK = 0
+_STATUS_ERROR = 1
+_STATUS_TYPE_ERROR = 2
+_STATUS_FAILURE = 3
+_STATUS_CONFLICT = 4
+
+_ITER_SEEK = 0
+_ITER_FIRST = 1
+_ITER_LAST = 2
+_ITER_AFTER = 3
+_ITER_BEFORE = 4
+
+_FLAG_VERIFY_CHECKSUMS = 1
+_FLAG_FILL_CACHE = 2
+
+
+def _packFields(fields):
+    parts = []
+    for field in fields:
+        if field is None:
+            parts.append(_FIELD_LENGTH.pack(_NULL_LENGTH))
+        else:
+            field = _toBytes(field)
+            parts.append(_FIELD_LENGTH.pack(len(field)))
+            parts.append(field)
+    return "".join(parts)
+
+
+def _unpackFields(payload):
+    fields, offset = [], 0
+    while offset < len(payload):
+        length, = _FIELD_LENGTH.unpack_from(payload, offset)
+        offset += _FIELD_LENGTH.size
+        if length == _NULL_LENGTH:
+            fields.append(None)
+        else:
+            fields.append(payload[offset:offset + length])
+            offset += length
+    return fields
+
+
+def _packFrame(code, fields):
+    payload = _packFields(fields)
+    return _FRAME_HEADER.pack(len(payload), code) + payload
+
+
+def _parseFrames(buf):
+    """Splits buf into complete (code, fields) frames. Returns the frames and
+    whatever trailing partial frame is left over."""
+    frames, offset = [], 0
+    while len(buf) - offset >= _FRAME_HEADER.size:
+        length, code = _FRAME_HEADER.unpack_from(buf, offset)
+        end = offset + _FRAME_HEADER.size + length
+        if end > len(buf):
+            break
+        frames.append((code, _unpackFields(
+                buf[offset + _FRAME_HEADER.size:end])))
+        offset = end
+    return frames, buf[offset:]
+
+
+def _readFlags(verify_checksums, fill_cache):
+    flags = 0
+    if verify_checksums:
+        flags |= _FLAG_VERIFY_CHECKSUMS
+    if fill_cache:
+        flags |= _FLAG_FILL_CACHE
+    return chr(flags)
+
+
+def _readRows(it, mode, key, count, keys_only=False):
+    """Positions the iterator (implementation) it according to mode and reads
+    up to count rows from there, backwards for _ITER_LAST and _ITER_BEFORE.
+    Returns the rows as a flat list of keys and values (which are None if
+    keys_only is true)."""
+    if mode == _ITER_SEEK:
+        it.seek(key)
+    elif mode == _ITER_FIRST:
+        it.seekFirst()
+    elif mode == _ITER_LAST:
+        it.seekLast()
+    elif mode == _ITER_AFTER:
+        it.seek(key)
+        if it.valid() and it.key() == key:
+            it.next()
+    elif mode == _ITER_BEFORE:
+        it.seek(key)
+        if it.valid():
+            it.prev()
+        else:
+            it.seekLast()
+    else:
+        raise ValueError("unknown iterator mode %d" % mode)
+    return _collectRows(it, count, mode in (_ITER_LAST, _ITER_BEFORE),
+                        keys_only)
+
+
+def _collectRows(it, count, backward=False, keys_only=False):
+    """Reads up to count rows from wherever the iterator (implementation) it
+    is, as a flat list of keys and values (which are None if keys_only is
+    true)."""
+    if keys_only:
+        read_keys = getattr(it, "readKeys", None)
+        if read_keys is not None:
+            keys = read_keys(count, backward)
+        else:
+            keys = []
+            while len(keys) < count and it.valid():
+                keys.append(it.key())
+                if backward:
+                    it.prev()
+                else:
+                    it.next()
+        rows = [None] * (2 * len(keys))
+        rows[::2] = keys
+        return rows
+    read_rows = getattr(it, "readRows", None)
+    if read_rows is not None:
+        # iterators over LevelDB itself read a chunk in one backend call
+        return read_rows(count, backward)
+    rows = []
+    while len(rows) < 2 * count and it.valid():
+        rows.extend(it.item())
+        if backward:
+            it.prev()
+        else:
+            it.next()
+    return rows
+
+
+class _DBRequestHandler(SocketServer.BaseRequestHandler):
+
+    """Serves a single client connection. Iterators and snapshots opened by
+    the client live until it releases them or disconnects.
+    """
+
+    def setup(self):
+        self._db = self.server.db
+        self._handles = {}
+        self._next_handle = 1
+
+    def handle(self):
+        buf = ""
+        while True:
+            data = self.request.recv(self.server.recv_size)
+            if not data:
+                return
+            frames, buf = _parseFrames(buf + data)
+            if frames:
+                self.request.sendall("".join(self._process(frames)))
+
+    def finish(self):
+        handles, self._handles = self._handles, {}
+        for handle in handles.itervalues():
+            if isinstance(handle, Iterator):
+                handle.close()
+
+    def _process(self, frames):
+        # consecutive puts, deletes and writes that arrive together are
+        # committed as a single native write batch.
+        # a malformed write fails the whole batch, without writing any of it.
+        responses = []
+        batch, batch_ops, batch_sync, batch_error = None, 0, False, None
+        for code, fields in frames:
+            if code in (_OP_PUT, _OP_DELETE, _OP_WRITE):
+                if batch is None:
+                    batch = self._db.newBatch()
+                batch_ops += 1
+                if batch_error is not None:
+                    continue
+                try:
+                    self._addToBatch(batch, code, fields)
+                    batch_sync = batch_sync or fields[0] != "\x00"
+                except Exception, e:
+                    batch_error = e
+                continue
+            if batch is not None:
+                responses.extend(self._commit(batch, batch_ops, batch_sync,
+                                              batch_error))
+                batch, batch_ops, batch_sync, batch_error = (None, 0, False,
+                                                             None)
+            try:
+                result = self._dispatch(code, fields)
+            except Exception, e:
+                responses.append(self._errorFrame(e))
+            else:
+                responses.append(_packFrame(_STATUS_OK, result))
+        if batch is not None:
+            responses.extend(self._commit(batch, batch_ops, batch_sync,
+                                          batch_error))
+        return responses
+
+    def _addToBatch(self, batch, code, fields):
+        if code == _OP_PUT:
+            self._db.putTo(batch, fields[1], fields[2])
+        elif code == _OP_DELETE:
+            self._db.deleteFrom(batch, fields[1])
+        else:
+            puts, = _UINT64.unpack(fields[1])
+            end = 2 + 2 * puts
+            if end > len(fields):
+                raise ValueError("write request is missing fields")
+            for i in xrange(2, end, 2):
+                self._db.putTo(batch, fields[i], fields[i + 1])
+            for key in fields[end:]:
+                self._db.deleteFrom(batch, key)
+
+    def _commit(self, batch, ops, sync, error=None):
+        if error is not None:
+            return [self._errorFrame(error)] * ops
+        try:
+            self._db.write(batch, sync=sync)
+        except Exception, e:
+            response = self._errorFrame(e)
+        else:
+            response = _packFrame(_STATUS_OK, ())
+        return [response] * ops
+
+    @staticmethod
+    def _errorFrame(e):
+        if isinstance(e, TransactionConflict):
+            status = _STATUS_CONFLICT
+        elif isinstance(e, Error):
+            status = _STATUS_ERROR
+        elif isinstance(e, TypeError):
+            status = _STATUS_TYPE_ERROR
+        else:
+            status = _STATUS_FAILURE
+        return _packFrame(status, [str(e)])
+
+    # pylint: disable=W0212
+    def _commitTransaction(self, fields):
+        # the keys a transaction read and their values, then its writes, laid
+        # out like those of a write request.
+        version, = _UINT64.unpack(fields[1])
+        reads, = _UINT64.unpack(fields[2])
+        end = 3 + 2 * reads
+        if end + 1 > len(fields):
+            raise ValueError("commit request is missing fields")
+        prefix = self._db._prefix or ""
+        reads = dict((prefix + fields[i], fields[i + 1])
+                     for i in xrange(3, end, 2))
+        batch = self._db.newBatch()
+        self._addToBatch(batch, _OP_WRITE, [fields[0]] + fields[end:])
+        self._db.flush(sync=False)
+        _commitBatch(self._db._impl, version, reads, batch,
+                     fields[0] != "\x00")
+
+    def _addHandle(self, handle):
+        handle_id = self._next_handle
+        self._next_handle += 1
+        self._handles[handle_id] = handle
+        return _UINT64.pack(handle_id)
+
+    def _source(self, snapshot_id):
+        if snapshot_id is None:
+            return self._db
+        return self._handles[_UINT64.unpack(snapshot_id)[0]]
+
+    def _dispatch(self, code, fields):
+        if code == _OP_GET:
+            flags = ord(fields[1])
+            return self._source(fields[0]).getMany(fields[2:],
+                    verify_checksums=bool(flags & _FLAG_VERIFY_CHECKSUMS),
+                    fill_cache=bool(flags & _FLAG_FILL_CACHE))
+        if code == _OP_ITER_OPEN:
+            flags = ord(fields[1])
+            return [self._addHandle(self._source(fields[0]).iterator(
+                    verify_checksums=bool(flags & _FLAG_VERIFY_CHECKSUMS),
+                    fill_cache=bool(flags & _FLAG_FILL_CACHE)))]
+        if code == _OP_ITER_READ:
+            return _readRows(_IteratorWrapperImpl(
+                    self._handles[_UINT64.unpack(fields[0])[0]]),
+                    ord(fields[1]), fields[3], _UINT64.unpack(fields[2])[0])
+        if code == _OP_SNAPSHOT:
+            return [self._addHandle(self._db.snapshot())]
+        if code == _OP_RELEASE:
+            for handle_id in fields:
+                handle = self._handles.pop(_UINT64.unpack(handle_id)[0], None)
+                if isinstance(handle, Iterator):
+                    handle.close()
+            return ()
+        if code == _OP_SIZES:
+            ranges = [(fields[i], fields[i + 1])
+                      for i in xrange(0, len(fields), 2)]
+            return [_UINT64.pack(size)
+                    for size in self._db.approximateDiskSizes(*ranges)]
+        if code == _OP_COMPACT:
+            self._db.compactRange(fields[0], fields[1])
+            return ()
+        if code == _OP_VERSION:
+            return [_UINT64.pack(_keyVersion(self._db._impl))]
+        if code == _OP_COMMIT:
+            self._commitTransaction(fields)
+            return ()
+        raise ValueError("unknown opcode %d" % code)
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+    recv_size = 256 * 1024
+
+    def __init__(self, path, db):
+        self.db = db
+        SocketServer.UnixStreamServer.__init__(self, path, _DBRequestHandler)
+
+
+class DBServer(object):
+
+    """Owns a DBInterface and serves it to other processes over a Unix domain
+    socket, since only one process may have a LevelDB open at a time. Connect
+    to it with RemoteDB.
+
+    Each client connection is served by its own thread. Writes that a client
+    pipelines together are committed to LevelDB as a single write batch.
+    """
+
+    def __init__(self, db, path):
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # a socket left behind by a server that is gone is replaced, but
+            # not one that another server is still accepting on.
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise Error("a leveldb server is already listening on %s"
+                            % path)
+            finally:
+                sock.close()
+        self.path = path
+        self._server = _UnixServer(path, db)
+        self._thread = None
+
+    def serveForever(self):
+        """Serves requests in the calling thread until close is called"""
+        self._server.serve_forever()
+
+    def start(self):
+        """Serves requests from a background thread.
+
+        @return: self
+        @rtype: DBServer
+        """
+        self._thread = threading.Thread(target=self.serveForever,
+                                        name="leveldb-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stops accepting connections. Does not close the served database.
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _RemoteCall(object):
+
+    """Requests of one caller waiting to go out on a _RemoteClient, and then
+    their responses or the error that kept them from coming back."""
+
+    __slots__ = ["frames", "responses", "error"]
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.responses = None
+        self.error = None
+
+
+class _RemoteClient(object):
+
+    """A connection to a DBServer. Requests are answered in order, one batch
+    at a time. Callers on other threads that queue up requests while a batch
+    is in flight have theirs sent together as the next batch, in a single
+    send, and the responses are read back in one go. This way the server
+    sees their writes together, and commits them as one write batch.
+    """
+
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._rfile = self._sock.makefile("rb", 256 * 1024)
+        self._lock = threading.Lock()
+        self._releases = []
+        self._calls = []
+
+    def release(self, handle_id):
+        # this gets called from __del__ methods, possibly while another
+        # request is in flight on this thread, so the release is queued up
+        # and only sent right away if the connection is free. Otherwise the
+        # request in flight sends it when it's done.
+        self._releases.append(handle_id)
+        if not self._lock.acquire(False):
+            return
+        try:
+            if self._sock is not None:
+                self._sendReleases()
+        except (Error, socket.error):
+            pass
+        finally:
+            self._lock.release()
+
+    def _sendReleases(self):
+        # the lock must be held. other threads may be appending, so only what
+        # was copied is removed.
+        while self._releases:
+            releases = self._releases[:]
+            del self._releases[:len(releases)]
+            self._sock.sendall(_packFrame(_OP_RELEASE, releases))
+            self._readResponse()
+
+    def call(self, code, fields):
+        return self.callMany([(code, fields)])[0]
+
+    def callMany(self, requests):
+        call = _RemoteCall([_packFrame(code, fields)
+                            for code, fields in requests])
+        self._calls.append(call)
+        with self._lock:
+            # whoever got the lock first may have sent this call already
+            if call.responses is None and call.error is None:
+                self._sendCalls()
+        if call.error is not None:
+            raise call.error
+        results = []
+        for status, fields in call.responses:
+            if status == _STATUS_ERROR:
+                raise Error(fields[0])
+            if status == _STATUS_TYPE_ERROR:
+                raise TypeError(fields[0])
+            if status == _STATUS_CONFLICT:
+                raise TransactionConflict(fields[0])
+            if status != _STATUS_OK:
+                raise Error("leveldb server failure: %s" % fields[0])
+            results.append(fields)
+        return results
+
+    def _sendCalls(self):
+        # the lock must be held. other threads may be appending, so only what
+        # was copied is removed.
+        calls = self._calls[:]
+        del self._calls[:len(calls)]
+        try:
+            if self._sock is None:
+                raise Error("connection to leveldb server is closed")
+            releases = self._releases[:]
+            del self._releases[:len(releases)]
+            frames = []
+            if releases:
+                frames.append(_packFrame(_OP_RELEASE, releases))
+            for call in calls:
+                frames.extend(call.frames)
+            self._sock.sendall("".join(frames))
+            if releases:
+                self._readResponse()
+            for call in calls:
+                call.responses = [self._readResponse() for _ in call.frames]
+            self._sendReleases()
+        except Exception, e:
+            for call in calls:
+                if call.responses is None:
+                    call.error = e
+
+    def _readResponse(self):
+        header = self._rfile.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            raise Error("connection to leveldb server lost")
+        length, status = _FRAME_HEADER.unpack(header)
+        payload = self._rfile.read(length)
+        if len(payload) < length:
+            raise Error("connection to leveldb server lost")
+        return status, _unpackFields(payload)
+
+    def close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+            if sock is not None:
+                self._rfile.close()
+                sock.close()
+
+
+def RemoteDB(path, default_sync=False, default_verify_checksums=False,
+             default_fill_cache=True, iterator_chunk_size=256):
+    """Connects to a DBServer listening on the Unix domain socket at path.
+    Returns a DBInterface.
+
+    Iterators fetch iterator_chunk_size rows per round trip. Threads sharing
+    the returned DBInterface share its connection: requests they make while
+    another one is waiting for the server are sent together and answered in
+    one round trip, and their puts, deletes and writes are committed to
+    LevelDB as a single write batch. So a writer that wants throughput from
+    one connection can use several threads.
+    """
+    return DBInterface(
+            _RemoteDBImpl(_RemoteClient(path), iterator_chunk_size),
+            allow_close=True, default_sync=default_sync,
+            default_verify_checksums=default_verify_checksums,
+            default_fill_cache=default_fill_cache)
+
+
+class _ChunkedIteratorImpl(object):
+
+    """Buffers a chunk of rows, in key order, around the current position of
+    some underlying iterator. read(mode, key, count) positions the underlying
+    iterator according to mode and returns up to count rows from there as a
+    flat list of keys and values (see _readRows).
+    """
+
+    __slots__ = ["_read", "_close", "_chunk_size", "_rows", "_idx",
+                 "_at_start", "_at_end"]
+
+    def __init__(self, read, close, chunk_size):
+        self._read = read
+        self._close = close
+        self._chunk_size = chunk_size
+        self._rows = []
+        self._idx = 0
+        self._at_start = self._at_end = True
+
+    def _load(self, mode, key=None):
+        fields = self._read(mode, key, self._chunk_size)
+        rows = zip(fields[::2], fields[1::2])
+        exhausted = len(rows) < self._chunk_size
+        if mode in (_ITER_LAST, _ITER_BEFORE):
+            rows.reverse()
+            self._idx = len(rows) - 1
+            self._at_start = exhausted
+            self._at_end = mode == _ITER_LAST
+        else:
+            self._idx = 0
+            self._at_start = mode == _ITER_FIRST
+            self._at_end = exhausted
+        self._rows = rows
+
+    def valid(self):
+        return 0 <= self._idx < len(self._rows)
+
+    def key(self):
+        return self._rows[self._idx][0]
+
+    def val(self):
+        return self._rows[self._idx][1]
+
+    def item(self):
+        return self._rows[self._idx]
+
+    def seek(self, key):
+        self._load(_ITER_SEEK, key)
+
+    def seekFirst(self):
+        self._load(_ITER_FIRST)
+
+    def seekLast(self):
+        self._load(_ITER_LAST)
+
+    def prev(self):
+        self._idx -= 1
+        if self._idx < 0 and not self._at_start and self._rows:
+            self._load(_ITER_BEFORE, self._rows[0][0])
+
+    def next(self):
+        self._idx += 1
+        if self._idx >= len(self._rows) and not self._at_end and self._rows:
+            self._load(_ITER_AFTER, self._rows[-1][0])
+
+    def close(self):
+        self._rows = []
+        self._close()
+
+
+def _readAhead(it, mode, key, count, keys_only, chunks, stop):
+    """The body of a _ReadaheadReader's thread. Puts chunks of count rows,
+    read forward from where mode and key position the iterator
+    (implementation) it, into the queue chunks, until the rows run out or
+    stop is set. An exception is put into the queue in place of a chunk."""
+    try:
+        chunk = _readRows(it, mode, key, count, keys_only)
+        while True:
+            chunks.put(chunk)
+            if len(chunk) < 2 * count or stop.is_set():
+                return
+            chunk = _collectRows(it, count, keys_only=keys_only)
+    except Exception:
+        chunks.put(sys.exc_info())
+
+
+class _ReadaheadReader(object):
+
+    """The read function of a _ChunkedIteratorImpl over a local iterator
+    (implementation). A background thread reads forward chunks into a
+    bounded queue ahead of the consumer. Reading in any other direction, or
+    from anywhere else, stops the thread first, as only one thread may use
+    the iterator at a time.
+
+    The thread doesn't refer back to the reader, so a reader that is
+    garbage collected without being closed still stops it. The reader is a
+    referrer of the native iterators under it, so closing them, or their
+    database, stops the thread before they are destroyed.
+
+    If keys_only is true, values aren't read, and are None.
+    """
+
+    def __init__(self, it, depth, keys_only=False):
+        self._it = self.ref = it
+        self._keys_only = keys_only
+        self._chunks = Queue.Queue(depth)
+        self._stop = None
+        self._thread = None
+        self._next_key = None
+        self._registrations = []
+        for it_ref in _iteratorRefs(it):
+            it_ref.addReferrer(self)
+
+    def _start(self, mode, key, count):
+        self._chunks = Queue.Queue(self._chunks.maxsize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=_readAhead, args=(
+                self._it, mode, key, count, self._keys_only, self._chunks,
+                self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _cancel(self):
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop.set()
+        # the thread checks stop after each chunk it queues. emptying the
+        # queue makes sure it isn't stuck waiting for room.
+        try:
+            while True:
+                self._chunks.get_nowait()
+        except Queue.Empty:
+            pass
+        thread.join()
+
+    def read(self, mode, key, count):
+        if mode == _ITER_AFTER and self._thread is not None and (
+                key == self._next_key):
+            chunk = self._chunks.get()
+        elif mode in (_ITER_FIRST, _ITER_SEEK, _ITER_AFTER):
+            self._cancel()
+            self._start(mode, key, count)
+            chunk = self._chunks.get()
+        else:
+            self._cancel()
+            return _readRows(self._it, mode, key, count, self._keys_only)
+        if isinstance(chunk, tuple) or len(chunk) < 2 * count:
+            # the thread is done
+            self._cancel()
+        if isinstance(chunk, tuple):
+            raise chunk[0], chunk[1], chunk[2]
+        self._next_key = chunk[-2] if chunk else None
+        return chunk
+
+    def close(self):
+        it, self._it = self._it, None
+        if it is None:
+            return
+        self.ref = None
+        self._cancel()
+        it.close()
+
+    __del__ = _cancel
+
+
+# pylint: disable=W0212
+def _iteratorRefs(it):
+    """Returns the _PointerRefs of the native iterators under the iterator
+    (implementation) it"""
+    if isinstance(it, _IteratorDbImpl):
+        return [it._ref]
+    if isinstance(it, _CodecIteratorImpl):
+        return _iteratorRefs(it._it)
+    if isinstance(it, _BufferedIteratorImpl):
+        return _iteratorRefs(it._merged)
+    if isinstance(it, _MergedIteratorImpl):
+        return [it_ref for child in it._children
+                for it_ref in _iteratorRefs(child)]
+    return []
+
+
+class _RemoteDBImpl(object):
+
+    __slots__ = ["_client", "_chunk_size", "_snapshot", "__weakref__"]
+
+    def __init__(self, client, chunk_size, snapshot_ref=None):
+        self._client = client
+        self._chunk_size = chunk_size
+        self._snapshot = snapshot_ref
+
+    def _snapshotId(self):
+        if self._snapshot is None:
+            return None
+        if self._snapshot.ref is None:
+            raise Error("leveldb snapshot is closed")
+        return self._snapshot.ref
+
+    def close(self):
+        if self._snapshot is None:
+            self._client.close()
+        else:
+            self._snapshot.close()
+
+    def put(self, key, val, sync=False):
+        if self._snapshot is not None:
+            raise TypeError("cannot put on leveldb snapshot")
+        self._client.call(_OP_PUT, [chr(sync), key, val])
+
+    def delete(self, key, sync=False):
+        if self._snapshot is not None:
+            raise TypeError("cannot delete on leveldb snapshot")
+        self._client.call(_OP_DELETE, [chr(sync), key])
+
+    def get(self, key, verify_checksums=False, fill_cache=True):
+        return self.getMany([key], verify_checksums=verify_checksums,
+                fill_cache=fill_cache)[0]
+
+    def getMany(self, keys, verify_checksums=False, fill_cache=True):
+        return self._client.call(_OP_GET, [self._snapshotId(),
+                _readFlags(verify_checksums, fill_cache)] + list(keys))
+
+    # pylint: disable=W0212
+    def write(self, batch, sync=False):
+        if self._snapshot is not None:
+            raise TypeError("cannot write on leveldb snapshot")
+        fields = [chr(sync), _UINT64.pack(len(batch._puts))]
+        for key, val in batch._puts.iteritems():
+            fields.append(key)
+            fields.append(val)
+        fields.extend(batch._deletes)
+        self._client.call(_OP_WRITE, fields)
+
+    def version(self):
+        return _UINT64.unpack(self._client.call(_OP_VERSION, ())[0])[0]
+
+    # pylint: disable=W0212
+    def commit(self, version, reads, batch, sync=False):
+        if self._snapshot is not None:
+            raise TypeError("cannot write on leveldb snapshot")
+        fields = [chr(sync), _UINT64.pack(version), _UINT64.pack(len(reads))]
+        for key, val in reads.iteritems():
+            fields.append(key)
+            fields.append(val)
+        fields.append(_UINT64.pack(len(batch._puts)))
+        for key, val in batch._puts.iteritems():
+            fields.append(key)
+            fields.append(val)
+        fields.extend(batch._deletes)
+        self._client.call(_OP_COMMIT, fields)
+
+    def iterator(self, verify_checksums=False, fill_cache=True):
+        iterator_id, = self._client.call(_OP_ITER_OPEN, [self._snapshotId(),
+                _readFlags(verify_checksums, fill_cache)])
+        iterator_ref = _PointerRef(iterator_id, self._client.release)
+
+        def read(mode, key, count):
+            return self._client.call(_OP_ITER_READ, [iterator_ref.ref,
+                    chr(mode), _UINT64.pack(count), key])
+
+        return _ChunkedIteratorImpl(read, iterator_ref.close,
+                                    self._chunk_size)
+
+    def approximateDiskSizes(self, *ranges):
+        if self._snapshot is not None:
+            raise TypeError("cannot calculate disk sizes on leveldb snapshot")
+        fields = []
+        for start_key, end_key in ranges:
+            fields.append(start_key)
+            fields.append(end_key)
+        return [_UINT64.unpack(size)[0]
+                for size in self._client.call(_OP_SIZES, fields)]
+
+    def compactRange(self, start_key, end_key):
+        self._client.call(_OP_COMPACT, [start_key, end_key])
+
+    def snapshot(self):
+        if self._snapshot is not None:
+            # shares the server's snapshot, which closing this one leaves
+            # alone, and closing the original closes this one too.
+            snapshot_ref = _PointerRef(self._snapshotId(), None)
+            self._snapshot.addReferrer(snapshot_ref)
+            return _RemoteDBImpl(self._client, self._chunk_size,
+                                 snapshot_ref=snapshot_ref)
+        snapshot_id, = self._client.call(_OP_SNAPSHOT, ())
+        return _RemoteDBImpl(self._client, self._chunk_size,
+                snapshot_ref=_PointerRef(snapshot_id, self._client.release))
+
+
+class _ReversedKey(object):
+
+    """Inverts key ordering so heapq can be used as a max-heap"""
+
+    __slots__ = ["key"]
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class _MergedIteratorImpl(object):
+
+    """Merges several iterator implementations into a single ordered one. The
+    child whose current key sorts first (last, when moving backwards) is kept
+    at the top of a heap.
+
+    duplicates decides what happens when several children share a key:
+    "first" and "last" yield only the row from the first or last such child,
+    while "all" yields every row, in child order (reverse child order when
+    moving backwards).
+    """
+
+    __slots__ = ["_children", "_heap", "_forward", "_dedupe", "_sign"]
+
+    def __init__(self, children, duplicates="all"):
+        if duplicates not in ("first", "last", "all"):
+            raise ValueError("unknown duplicates policy %r" % (duplicates,))
+        self._children = children
+        self._heap = []
+        self._forward = True
+        self._dedupe = duplicates != "all"
+        self._sign = -1 if duplicates == "last" else 1
+
+    def _entry(self, i, key):
+        # heap entries are (sort key, tie breaker, child index). with
+        # deduplication the winning child must stay on top in either
+        # direction, otherwise child order flips along with the keys.
+        if self._forward:
+            return (key, self._sign * i, i)
+        if self._dedupe:
+            return (_ReversedKey(key), self._sign * i, i)
+        return (_ReversedKey(key), -i, i)
+
+    def _rebuild(self, forward):
+        self._forward = forward
+        heap = [self._entry(i, child.key())
+                for i, child in enumerate(self._children) if child.valid()]
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def valid(self):
+        return bool(self._heap)
+
+    def key(self):
+        if self._forward:
+            return self._heap[0][0]
+        return self._heap[0][0].key
+
+    def val(self):
+        return self._children[self._heap[0][2]].val()
+
+    def item(self):
+        return self._children[self._heap[0][2]].item()
+
+    def seek(self, key):
+        for child in self._children:
+            child.seek(key)
+        self._rebuild(True)
+
+    def seekFirst(self):
+        for child in self._children:
+            child.seekFirst()
+        self._rebuild(True)
+
+    def seekLast(self):
+        for child in self._children:
+            child.seekLast()
+        self._rebuild(False)
+
+    def _turnForward(self):
+        # every other child is behind the current row. move each to its first
+        # row after it. when yielding all duplicates, children later in the
+        # order still have to yield the current key themselves.
+        key, current = self.key(), self._heap[0][2]
+        for i, child in enumerate(self._children):
+            if i == current:
+                continue
+            child.seek(key)
+            if child.valid() and child.key() == key and (
+                    self._dedupe or i < current):
+                child.next()
+        self._rebuild(True)
+
+    def _turnBackward(self):
+        # the mirror image of _turnForward
+        key, current = self.key(), self._heap[0][2]
+        for i, child in enumerate(self._children):
+            if i == current:
+                continue
+            child.seek(key)
+            if not child.valid():
+                child.seekLast()
+            elif child.key() != key or self._dedupe or i > current:
+                child.prev()
+        self._rebuild(False)
+
+    def _step(self, forward):
+        heap = self._heap
+        key = heap[0][0]
+        while True:
+            i = heap[0][2]
+            child = self._children[i]
+            if forward:
+                child.next()
+            else:
+                child.prev()
+            if child.valid():
+                heapq.heapreplace(heap, self._entry(i, child.key()))
+            else:
+                heapq.heappop(heap)
+            # when deduplicating, every child on the old key moves past it
+            if not (self._dedupe and heap and heap[0][0] == key):
+                return
+
+    def next(self):
+        if not self._forward:
+            self._turnForward()
+        self._step(True)
+
+    def prev(self):
+        if self._forward:
+            self._turnBackward()
+        self._step(False)
+
+    def close(self):
+        self._heap = []
+        for child in self._children:
+            child.close()
+
+
+class _IteratorWrapperImpl(object):
+
+    """Presents a public Iterator as an iterator implementation"""
+
+    __slots__ = ["valid", "key", "val", "item", "seek", "seekFirst",
+                 "seekLast", "next", "prev", "close"]
+
+    def __init__(self, iterator):
+        self.valid = iterator.valid
+        self.key = iterator.key
+        self.val = iterator.value
+        self.item = iterator.item
+        self.seek = iterator.seek
+        self.seekFirst = iterator.seekFirst
+        self.seekLast = iterator.seekLast
+        self.next = iterator.stepForward
+        self.prev = iterator.stepBackward
+        self.close = iterator.close
+
+
+def MergedIterator(iterators, duplicates="first", keys_only=False,
+                   batch_size=None):
+    """Merges several Iterators, over different scopes, databases or
+    snapshots, into one ordered Iterator without loading them into memory.
+    The merged Iterator supports seeking and iterating in reverse, and closing
+    it closes all of the iterators it merges.
+
+    If several iterators have rows with the same key, duplicates="first" only
+    yields the row from whichever comes first in iterators, "last" only the
+    row from whichever comes last, and "all" yields every one of them.
+
+    If batch_size is given, rows are read from each iterator batch_size at a
+    time.
+
+    @rtype: Iterator
+    """
+    children = [_IteratorWrapperImpl(iterator) for iterator in iterators]
+    if batch_size is not None:
+        children = [_ChunkedIteratorImpl(
+                functools.partial(_readRows, child), child.close, batch_size)
+                for child in children]
+    return Iterator(_MergedIteratorImpl(children, duplicates=duplicates),
+                    keys_only=keys_only)
+
+
+def _runParallel(calls):
+    """Runs each of calls in its own thread (the last in this one) and waits
+    for them all. Re-raises the first exception any of them raised."""
+    errors = []
+
+    def run(call):
+        try:
+            call()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run, args=(call,))
+               for call in calls[:-1]]
+    for thread in threads:
+        thread.start()
+    if calls:
+        run(calls[-1])
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+# batches with fewer operations than this are written shard by shard in the
+# calling thread, unless they are synced, since handing the pieces to the
+# shards' writer threads costs more than writing them.
+_SHARD_INLINE_WRITE_OPS = 256
+
+
+def _runShardWriter(calls):
+    while True:
+        item = calls.get()
+        if item is None:
+            return
+        call, errors, done = item
+        try:
+            call()
+        except Exception:
+            errors.append(sys.exc_info())
+        done.release()
+
+
+class _ShardWriters(object):
+
+    """A long-lived daemon thread per shard, which runs the pieces of write
+    batches handed to it, so that parallel writes don't start threads of
+    their own."""
+
+    __slots__ = ["_calls", "_threads"]
+
+    def __init__(self, count):
+        self._calls = [Queue.Queue() for _ in xrange(count)]
+        self._threads = []
+        for calls in self._calls:
+            thread = threading.Thread(target=_runShardWriter, args=(calls,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self, calls):
+        """Runs each of calls, a list of (shard, call) pairs, on its shard's
+        thread (the last in this one) and waits for them all. Re-raises the
+        first exception any of them raised."""
+        errors = []
+        done = threading.Semaphore(0)
+        for shard, call in calls[:-1]:
+            self._calls[shard].put((call, errors, done))
+        if calls:
+            try:
+                calls[-1][1]()
+            except Exception:
+                errors.append(sys.exc_info())
+        for _ in xrange(len(calls) - 1):
+            done.acquire()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def close(self):
+        for calls in self._calls:
+            calls.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def ShardedDB(paths, partition="hash", boundaries=None, default_sync=False,
+              default_verify_checksums=False, default_fill_cache=True,
+              **kwargs):
+    """Opens a separate LevelDB at each of paths and returns a DBInterface
+    that spreads keys across all of them. LevelDB serializes writers within a
+    single database, so independent shards allow for more write throughput.
+
+    With partition="hash", keys are placed by a hash of the whole key. With
+    partition="range", boundaries must be a sorted list of len(paths) - 1
+    keys, and shard i holds the keys from boundaries[i - 1] (inclusive) up to
+    boundaries[i] (exclusive).
+
+    Write batches are split up by shard and the pieces are written in
+    parallel, by a writer thread per shard, so a batch is only atomic within
+    each shard. Likewise,
+    snapshots are taken shard by shard. Any other keyword arguments are passed
+    along to DB.
+    """
+    if not paths:
+        raise ValueError("at least one shard path is required")
+    if partition == "hash":
+        if boundaries is not None:
+            raise ValueError("boundaries only apply to range partitioning")
+        count = len(paths)
+        placement = lambda key: (
+                zlib.crc32(_toBytes(key)) & 0xffffffff) % count
+    elif partition == "range":
+        boundaries = list(boundaries or ())
+        if len(boundaries) != len(paths) - 1 or boundaries != sorted(
+                boundaries):
+            raise ValueError("range partitioning requires %d sorted "
+                             "boundaries" % (len(paths) - 1))
+        placement = lambda key: bisect.bisect_right(boundaries,
+                                                    _toBytes(key))
+    else:
+        raise ValueError("unknown partition type %r" % (partition,))
+    shards = []
+    try:
+        for path in paths:
+            # pylint: disable=W0212
+            shards.append(DB(path, **kwargs)._impl)
+    except Exception:
+        for shard in shards:
+            shard.close()
+        raise
+    return DBInterface(_ShardedDBImpl(shards, placement,
+                                      _ShardWriters(len(shards))),
+                       allow_close=True,
+                       default_sync=default_sync,
+                       default_verify_checksums=default_verify_checksums,
+                       default_fill_cache=default_fill_cache)
+
+
+class _ShardedDBImpl(object):
+
+    __slots__ = ["_shards", "_placement", "_writers", "__weakref__"]
+
+    def __init__(self, shards, placement, writers=None):
+        self._shards = shards
+        self._placement = placement
+        self._writers = writers
+
+    def _shard(self, key):
+        return self._shards[self._placement(key)]
+
+    def close(self):
+        shards, self._shards = self._shards, []
+        writers, self._writers = self._writers, None
+        if writers is not None:
+            writers.close()
+        for shard in shards:
+            shard.close()
+
+    def put(self, key, val, sync=False):
+        self._shard(key).put(key, val, sync=sync)
+
+    def delete(self, key, sync=False):
+        self._shard(key).delete(key, sync=sync)
+
+    def get(self, key, verify_checksums=False, fill_cache=True):
+        return self._shard(key).get(key, verify_checksums=verify_checksums,
+                fill_cache=fill_cache)
+
+    def getMany(self, keys, verify_checksums=False, fill_cache=True):
+        by_shard = {}
+        for idx, key in enumerate(keys):
+            by_shard.setdefault(self._placement(key), []).append(idx)
+        vals = [None] * len(keys)
+        for shard, idxs in by_shard.iteritems():
+            shard_vals = self._shards[shard].getMany(
+                    [keys[idx] for idx in idxs],
+                    verify_checksums=verify_checksums, fill_cache=fill_cache)
+            for idx, val in zip(idxs, shard_vals):
+                vals[idx] = val
+        return vals
+
+    # pylint: disable=W0212
+    def write(self, batch, sync=False):
+        batches = {}
+
+        def shardBatch(key):
+            shard = self._placement(key)
+            if shard not in batches:
+                batches[shard] = _OpaqueWriteBatch()
+            return batches[shard]
+
+        for key, val in batch._puts.iteritems():
+            shardBatch(key)._puts[key] = val
+        for key in batch._deletes:
+            shardBatch(key)._deletes.add(key)
+        calls = [(shard, functools.partial(self._shards[shard].write,
+                                           shard_batch, sync=sync))
+                 for shard, shard_batch in batches.iteritems()]
+        if len(calls) > 1 and self._writers is not None and (
+                sync or len(batch._puts) + len(batch._deletes) >=
+                _SHARD_INLINE_WRITE_OPS):
+            self._writers.run(calls)
+        else:
+            for _, call in calls:
+                call()
+
+    def iterator(self, verify_checksums=False, fill_cache=True):
+        return _MergedIteratorImpl([shard.iterator(
+                verify_checksums=verify_checksums, fill_cache=fill_cache)
+                for shard in self._shards])
+
+    def approximateDiskSizes(self, *ranges):
+        sizes = [0] * len(ranges)
+        for shard in self._shards:
+            for i, size in enumerate(shard.approximateDiskSizes(*ranges)):
+                sizes[i] += size
+        return sizes
+
+    def compactRange(self, start_key, end_key):
+        _runParallel([functools.partial(shard.compactRange, start_key,
+                                        end_key)
+                      for shard in self._shards])
+
+    def snapshot(self):
+        return _ShardedDBImpl([shard.snapshot() for shard in self._shards],
+                              self._placement)
+
+
+class DBPool(object):
+
+    """Opens databases on demand and keeps at most max_open of them open at a
+    time. When another one is needed, the least recently used database that
+    has no open iterators or snapshots is closed. If every open database is
+    busy, the limit is exceeded until one frees up.
+
+    Every database is opened with DB(path, **kwargs). Pass a shared Cache as
+    cache to put all of them on one block cache budget. Each open database
+    may use up to max_open_files file descriptors, plus a few for its logs.
+    """
+
+    def __init__(self, max_open=64, **kwargs):
+        self.max_open = max_open
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._dbs = OrderedDict()
+        self._key_locks = {}
+
+    def open(self, path, default_sync=False, default_verify_checksums=False,
+             default_fill_cache=True):
+        """Returns a DBInterface for the database at path. The database
+        itself is only opened when the DBInterface is used, and may be closed
+        and reopened behind its back. Closing the DBInterface does nothing;
+        close the pool instead.
+
+        @rtype: DBInterface
+        """
+        return DBInterface(_PooledDBImpl(self, path), allow_close=False,
+                           default_sync=default_sync,
+                           default_verify_checksums=default_verify_checksums,
+                           default_fill_cache=default_fill_cache)
+
+    def _keyLocks(self, path):
+        # these outlive the databases, which may be closed and reopened
+        # while a transaction is open on them.
+        with self._lock:
+            key_locks = self._key_locks.get(path)
+            if key_locks is None:
+                key_locks = self._key_locks[path] = _KeyLocks()
+            return key_locks
+
+    def _acquire(self, path):
+        # databases are opened outside of the pool lock, so a slow open only
+        # holds up users of that one path, which wait for its entry.
+        with self._lock:
+            entry = self._dbs.pop(path, None)
+            opening = entry is None
+            if opening:
+                entry = _PoolEntry()
+            self._dbs[path] = entry
+            with entry.lock:
+                entry.busy += 1
+            self._evict()
+        if opening:
+            try:
+                # pylint: disable=W0212
+                entry.impl = DB(path, **self._kwargs)._impl
+            except Exception, e:
+                entry.error = e
+                with self._lock:
+                    if self._dbs.get(path) is entry:
+                        del self._dbs[path]
+            entry.opened.set()
+        else:
+            entry.opened.wait()
+        if entry.impl is None:
+            self._release(entry)
+            raise entry.error
+        return entry
+
+    def _release(self, entry):
+        with entry.lock:
+            entry.busy -= 1
+            idle = not entry.busy
+        if idle and len(self._dbs) > self.max_open:
+            with self._lock:
+                self._evict()
+
+    # pylint: disable=W0212
+    def _evict(self):
+        # the pool lock must be held, and busy counts only go up under it.
+        if len(self._dbs) <= self.max_open:
+            return
+        for path, entry in self._dbs.items():
+            if entry.busy or entry.impl is None:
+                continue
+            db = entry.impl
+            while isinstance(db, _CodecDBImpl):
+                db = db._impl
+            # idle pooled iterators don't keep the database open, but are
+            # only destroyed along with it.
+            idle = ()
+            if db._iterators is not None:
+                idle = db._iterators.idleRefs()
+            if db._db.hasReferrers(ignore=idle):
+                continue
+            if db._iterators is not None:
+                db._iterators.clear()
+            del self._dbs[path]
+            db.close()
+            if len(self._dbs) <= self.max_open:
+                return
+
+    def close(self):
+        """Closes every database in the pool"""
+        with self._lock:
+            dbs, self._dbs = self._dbs, OrderedDict()
+        for entry in dbs.itervalues():
+            if entry.impl is not None:
+                entry.impl.close()
+
+
+class _PoolEntry(object):
+
+    """A database of a DBPool, or a placeholder for it while it's opened.
+    busy counts the calls using it."""
+
+    __slots__ = ["impl", "error", "busy", "lock", "opened"]
+
+    def __init__(self):
+        self.impl = None
+        self.error = None
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.opened = threading.Event()
+
+
+class _PooledDBImpl(object):
+
+    __slots__ = ["_pool", "_path"]
+
+    def __init__(self, pool, path):
+        self._pool = pool
+        self._path = path
+
+    def _call(self, name, *args, **kwargs):
+        # the database can't be closed while it's in use here, and iterators
+        # and snapshots keep it open after that through their references.
+        entry = self._pool._acquire(self._path)
+        try:
+            return getattr(entry.impl, name)(*args, **kwargs)
+        finally:
+            self._pool._release(entry)
+
+    def close(self):
+        pass
+
+    def put(self, key, val, sync=False):
+        self._call("put", key, val, sync=sync)
+
+    def delete(self, key, sync=False):
+        self._call("delete", key, sync=sync)
+
+    def get(self, key, verify_checksums=False, fill_cache=True):
+        return self._call("get", key, verify_checksums=verify_checksums,
+                          fill_cache=fill_cache)
+
+    def getMany(self, keys, verify_checksums=False, fill_cache=True):
+        return self._call("getMany", keys, verify_checksums=verify_checksums,
+                          fill_cache=fill_cache)
+
+    def write(self, batch, sync=False):
+        self._call("write", batch, sync=sync)
+
+    def iterator(self, verify_checksums=False, fill_cache=True):
+        return self._call("iterator", verify_checksums=verify_checksums,
+                          fill_cache=fill_cache)
+
+    def approximateDiskSizes(self, *ranges):
+        return self._call("approximateDiskSizes", *ranges)
+
+    def compactRange(self, start_key, end_key):
+        self._call("compactRange", start_key, end_key)
+
+    def snapshot(self):
+        return self._call("snapshot")
+
+
+def trainDictionary(samples, size=(16 * 1024), gram=6):
+    """Builds a preset dictionary for ZlibCodec of up to size bytes out of
+    sample values. Samples are picked for how common their substrings of
+    gram bytes are among all of the samples, skipping those that add no new
+    substrings, and the most typical ones go last, where zlib finds them
+    with the shortest distances. A few hundred samples are plenty.
+
+    @rtype: string
+    """
+    samples = [_toBytes(sample) for sample in samples]
+    counts = {}
+    grams = []
+    for sample in samples:
+        sample_grams = frozenset(sample[i:i + gram]
+                                 for i in xrange(len(sample) - gram + 1))
+        grams.append(sample_grams)
+        for substring in sample_grams:
+            counts[substring] = counts.get(substring, 0) + 1
+    typicality = [sum(counts[substring] for substring in sample_grams) /
+                  float(len(sample) or 1)
+                  for sample, sample_grams in itertools.izip(samples, grams)]
+    chosen, covered, total = [], set(), 0
+    for i in sorted(xrange(len(samples)), key=typicality.__getitem__,
+                    reverse=True):
+        if total + len(samples[i]) > size or grams[i] <= covered:
+            continue
+        chosen.append(samples[i])
+        covered.update(grams[i])
+        total += len(samples[i])
+    chosen.reverse()
+    return "".join(chosen)
+
+
+# starts every value ZlibCodec has to mark. Neither byte occurs in UTF-8.
+_ZLIB_MAGIC = "\xc0\xc1"
+
+
+class ZlibCodec(object):
+
+    """Compresses values with zlib, for DB and DBInterface.scope's
+    value_codec, using preset dictionaries (see trainDictionary) so that
+    even small values compress well.
+
+    Compressed values start with a two byte magic prefix (bytes that never
+    occur in UTF-8) and a header byte: 1 for zlib without a dictionary, and
+    2 + i for zlib with dictionaries[i]. A value that compressing doesn't
+    make smaller is stored as is, unless it starts with the magic prefix,
+    in which case it gets the prefix and a header byte of 0. Anything
+    without the prefix is read as is, so a codec can be put on a scope of
+    values that were written without one, including empty values.
+
+    New values are compressed with the last dictionary, so a newly trained
+    one can be appended while values compressed with the older ones stay
+    readable. Keep the dictionaries somewhere, as values can't be read
+    without them.
+
+    The zlib module only takes preset dictionaries on newer Pythons, so a
+    dictionary is instead run through a compressor and a decompressor once,
+    and copies of those are used for each value.
+    """
+
+    def __init__(self, dictionaries=(), level=6):
+        if len(dictionaries) > 254:
+            raise ValueError("too many dictionaries")
+        self.dictionaries = list(dictionaries)
+        self._level = level
+        self._compressors = [zlib.compressobj(level, zlib.DEFLATED, -15)]
+        self._decompressors = [zlib.decompressobj(-15)]
+        for dictionary in self.dictionaries:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            primer = (compressor.compress(dictionary) +
+                      compressor.flush(zlib.Z_SYNC_FLUSH))
+            decompressor = zlib.decompressobj(-15)
+            decompressor.decompress(primer)
+            self._compressors.append(compressor)
+            self._decompressors.append(decompressor)
+        self._header = _ZLIB_MAGIC + chr(len(self._compressors))
+
+    def encode(self, val):
+        val = _toBytes(val)
+        compressor = self._compressors[-1].copy()
+        data = compressor.compress(val) + compressor.flush()
+        if len(data) + len(self._header) < len(val):
+            return self._header + data
+        if val.startswith(_ZLIB_MAGIC):
+            return _ZLIB_MAGIC + "\x00" + val
+        return val
+
+    def decode(self, data):
+        start = len(_ZLIB_MAGIC) + 1
+        if len(data) < start or not data.startswith(_ZLIB_MAGIC):
+            return data
+        header = ord(data[start - 1])
+        if header == 0:
+            return data[start:]
+        if header > len(self._decompressors):
+            raise Error("value needs zlib dictionary %d" % (header - 2))
+        decompressor = self._decompressors[header - 1].copy()
+        return (decompressor.decompress(buffer(data, start)) +
+                decompressor.flush())
+
+
+# pylint: disable=W0212
+def recompress(db, codec, encoded=True, sync=None, batch_bytes=(1024 * 1024),
+               progress=None):
+    """Compresses every value in db again with codec's newest dictionary,
+    to be called on the DBInterface (or scope) without the codec. If
+    encoded is false, the values are taken to have been written without a
+    codec, which moves existing data over to one.
+
+    Values are read from a snapshot and written in batches of roughly
+    batch_bytes. Writes made to the same keys in the meantime may be
+    overwritten. After each batch, progress (if given) is called with the
+    number of values written so far.
+
+    @return: the number of values written
+    @rtype: int
+    """
+    batch, size, written = db.newBatch(), 0, 0
+    snapshot = db.snapshot()
+    it = snapshot.iterator(fill_cache=False).seekFirst()
+    try:
+        for key, data in it:
+            val = codec.decode(data) if encoded else data
+            new_data = codec.encode(val)
+            if new_data == data:
+                continue
+            batch.put(key, new_data)
+            size += len(key) + len(new_data)
+            if size >= batch_bytes:
+                db.write(batch, sync=sync)
+                written += len(batch._puts)
+                batch.clear()
+                size = 0
+                if progress is not None:
+                    progress(written)
+    finally:
+        it.close()
+        snapshot.close()
+    if size:
+        db.write(batch, sync=sync)
+        written += len(batch._puts)
+        if progress is not None:
+            progress(written)
+    return written
+
+
+class _CodecIteratorImpl(object):
+
+    __slots__ = ["_it", "_decode", "valid", "key", "seek", "seekFirst",
+                 "seekLast", "prev", "next", "close"]
+
+    def __init__(self, it, decode):
+        self._it = it
+        self._decode = decode
+        self.valid = it.valid
+        self.key = it.key
+        self.seek = it.seek
+        self.seekFirst = it.seekFirst
+        self.seekLast = it.seekLast
+        self.prev = it.prev
+        self.next = it.next
+        self.close = it.close
+
+    def val(self):
+        return self._decode(self._it.val())
+
+    def item(self):
+        key, data = self._it.item()
+        return key, self._decode(data)
+
+
+class _CodecDBImpl(object):
+
+    """Encodes values with a codec on their way into another implementation,
+    and decodes them on the way out"""
+
+    __slots__ = ["_impl", "_codec"]
+
+    def __init__(self, impl, codec):
+        self._impl = impl
+        self._codec = codec
+
+    def close(self):
+        self._impl.close()
+
+    def flush(self, sync=False):
+        flush = getattr(self._impl, "flush", None)
+        if flush is not None:
+            flush(sync=sync)
+
+    def put(self, key, val, sync=False):
+        self._impl.put(key, self._codec.encode(val), sync=sync)
+
+    def delete(self, key, sync=False):
+        self._impl.delete(key, sync=sync)
+
+    def get(self, key, verify_checksums=False, fill_cache=True):
+        data = self._impl.get(key, verify_checksums=verify_checksums,
+                              fill_cache=fill_cache)
+        if data is None:
+            return None
+        return self._codec.decode(data)
+
+    def getMany(self, keys, verify_checksums=False, fill_cache=True):
+        return [None if data is None else self._codec.decode(data)
+                for data in self._impl.getMany(
+                    keys, verify_checksums=verify_checksums,
+                    fill_cache=fill_cache)]
+
+    # pylint: disable=W0212
+    def write(self, batch, sync=False):
+        encoded = _OpaqueWriteBatch()
+        for key, val in batch._puts.iteritems():
+            encoded._puts[key] = self._codec.encode(val)
+        encoded._deletes = batch._deletes
+        self._impl.write(encoded, sync=sync)
+
+    def iterator(self, verify_checksums=False, fill_cache=True):
+        return _CodecIteratorImpl(
+                self._impl.iterator(verify_checksums=verify_checksums,
+                                    fill_cache=fill_cache),
+                self._codec.decode)
+
+    def approximateDiskSizes(self, *ranges):
+        return self._impl.approximateDiskSizes(*ranges)
+
+    def compactRange(self, start_key, end_key):
+        self._impl.compactRange(start_key, end_key)
+
+    def snapshot(self):
+        return _CodecDBImpl(self._impl.snapshot(), self._codec)
+
+
+def BufferedDB(db, max_bytes=(4 * 1024 * 1024), flush_interval=1.0):
+    """Returns a DBInterface over db (which must not be a scope) that keeps
+    puts and deletes in an in-memory buffer, and writes them to db in one
+    batch when the buffer holds max_bytes of keys and values, when it has
+    waited flush_interval seconds (from a background thread), when a write
+    asks for sync, or when flush is called. Writes that are still buffered
+    are lost if the process dies.
+
+    Reads see the buffered writes: get checks the buffer first, and
+    iterators merge a copy of the buffer with an iterator over db. Snapshots
+    flush the buffer first. Closing the DBInterface flushes the buffer and
+    closes db.
+
+    @rtype: DBInterface
+    """
+    if db._prefix is not None:
+        raise ValueError("cannot buffer a scope; scope the result instead")
+    return DBInterface(_BufferedDBImpl(db._impl, max_bytes, flush_interval),
+                       allow_close=True, default_sync=db._default_sync,
+                       default_verify_checksums=db._default_verify_checksums,
+                       default_fill_cache=db._default_fill_cache)
+
+
+class _BufferedIteratorImpl(object):
+
+    """Skips the deletions in a merge of a buffer with an iterator over the
+    database. The buffer comes first in the merge, so whenever its key is
+    the current key, the current row came from the buffer."""
+
+    __slots__ = ["_merged", "_buffer"]
+
+    def __init__(self, merged, buffer_impl):
+        self._merged = merged
+        self._buffer = buffer_impl
+
+    def _skipDeleted(self, forward):
+        merged, buf = self._merged, self._buffer
+        while merged.valid() and buf.valid() and buf.val() is None and (
+                buf.key() == merged.key()):
+            if forward:
+                merged.next()
+            else:
+                merged.prev()
+
+    def valid(self):
+        return self._merged.valid()
+
+    def key(self):
+        return self._merged.key()
+
+    def val(self):
+        return self._merged.val()
+
+    def item(self):
+        return self._merged.item()
+
+    def seek(self, key):
+        self._merged.seek(key)
+        self._skipDeleted(True)
+
+    def seekFirst(self):
+        self._merged.seekFirst()
+        self._skipDeleted(True)
+
+    def seekLast(self):
+        self._merged.seekLast()
+        self._skipDeleted(False)
+
+    def prev(self):
+        self._merged.prev()
+        self._skipDeleted(False)
+
+    def next(self):
+        self._merged.next()
+        self._skipDeleted(True)
+
+    def close(self):
+        self._merged.close()
+
+
+class _BufferedDBImpl(object):
+
+    __slots__ = ["_db", "_max_bytes", "_lock", "_batch", "_size", "_error",
+                 "_stop", "_thread"]
+
+    def __init__(self, db, max_bytes, flush_interval):
+        self._db = db
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._batch = _OpaqueWriteBatch()
+        self._size = 0
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = None
+        if flush_interval is not None:
+            self._thread = threading.Thread(target=self._flushPeriodically,
+                                            args=(flush_interval,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _flushPeriodically(self, interval):
+        # a failed write leaves the rows buffered, to be tried again, and the
+        # error is raised from the next put, delete, write or flush.
+        while not self._stop.wait(interval):
+            with self._lock:
+                try:
+                    self._flush(False)
+                except Exception, e:
+                    self._error = e
+
+    def _raiseError(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    # pylint: disable=W0212
+    def _flush(self, sync):
+        if self._batch._puts or self._batch._deletes:
+            self._db.write(self._batch, sync=sync)
+            self._batch = _OpaqueWriteBatch()
+            self._size = 0
+
+    # pylint: disable=W0212
+    def _unbuffer(self, key):
+        # takes back the size of the row a new put or delete of key replaces
+        val = self._batch._puts.pop(key, None)
+        if val is not None:
+            self._size -= len(key) + len(val)
+        elif key in self._batch._deletes:
+            self._batch._deletes.discard(key)
+            self._size -= len(key)
+
+    def flush(self, sync=False):
+        with self._lock:
+            self._raiseError()
+            self._flush(sync)
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._db.close()
+
+    # pylint: disable=W0212
+    def put(self, key, val, sync=False):
+        key, val = _toBytes(key), _toBytes(val)
+        with self._lock:
+            self._raiseError()
+            self._unbuffer(key)
+            self._batch._puts[key] = val
+            self._size += len(key) + len(val)
+            if sync or self._size >= self._max_bytes:
+                self._flush(sync)
+
+    # pylint: disable=W0212
+    def delete(self, key, sync=False):
+        key = _toBytes(key)
+        with self._lock:
+            self._raiseError()
+            self._unbuffer(key)
+            self._batch._deletes.add(key)
+            self._size += len(key)
+            if sync or self._size >= self._max_bytes:
+                self._flush(sync)
+
+    # pylint: disable=W0212
+    def get(self, key, verify_checksums=False, fill_cache=True):
+        key = _toBytes(key)
+        with self._lock:
+            val = self._batch._puts.get(key)
+            if val is None and key not in self._batch._deletes:
+                val = self._db.get(key, verify_checksums=verify_checksums,
+                                   fill_cache=fill_cache)
+            return val
+
+    # pylint: disable=W0212
+    def getMany(self, keys, verify_checksums=False, fill_cache=True):
+        keys = [_toBytes(key) for key in keys]
+        with self._lock:
+            puts, deletes = self._batch._puts, self._batch._deletes
+            missing = [key for key in keys
+                       if key not in puts and key not in deletes]
+            found = dict(itertools.izip(missing, self._db.getMany(
+                    missing, verify_checksums=verify_checksums,
+                    fill_cache=fill_cache)))
+            found.update(puts)
+            return [found.get(key) for key in keys]
+
+    # pylint: disable=W0212
+    def write(self, batch, sync=False):
+        with self._lock:
+            self._raiseError()
+            puts, deletes = self._batch._puts, self._batch._deletes
+            for key, val in batch._puts.iteritems():
+                val = _toBytes(val)
+                self._unbuffer(key)
+                puts[key] = val
+                self._size += len(key) + len(val)
+            for key in batch._deletes:
+                self._unbuffer(key)
+                deletes.add(key)
+                self._size += len(key)
+            if sync or self._size >= self._max_bytes:
+                self._flush(sync)
+
+    # pylint: disable=W0212
+    def iterator(self, verify_checksums=False, fill_cache=True):
+        with self._lock:
+            it = self._db.iterator(verify_checksums=verify_checksums,
+                                   fill_cache=fill_cache)
+            if not self._batch._puts and not self._batch._deletes:
+                return it
+            # deletions are kept in the copy as rows without a value
+            rows = self._batch._puts.items()
+            rows.extend((key, None) for key in self._batch._deletes)
+        rows.sort()
+        buffer_impl = _IteratorMemImpl(rows)
+        return _BufferedIteratorImpl(
+                _MergedIteratorImpl([buffer_impl, it], duplicates="first"),
+                buffer_impl)
+
+    def approximateDiskSizes(self, *ranges):
+        return self._db.approximateDiskSizes(*ranges)
+
+    def compactRange(self, start_key, end_key):
+        self._db.compactRange(start_key, end_key)
+
+    def snapshot(self):
+        with self._lock:
+            self._flush(False)
+            return self._db.snapshot()
+
+
+def _indexValue(value):
+    """Returns an index value as a str. unicode is encoded as UTF-8, which
+    sorts by code point."""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    try:
+        return _toBytes(value)
+    except TypeError:
+        raise TypeError("index values must be strings or buffers, not %r" %
+                        (value,))
+
+
+def _encodeIndexValue(value):
+    """Escapes value so that index keys sort by value first, then by primary
+    key, and no encoded value is a prefix of another."""
+    return _indexValue(value).replace("\x00", "\x00\xff") + "\x00\x01"
+
+
+def _decodeIndexKey(index_key):
+    """Splits an index key into the index value and the primary key."""
+    pos = index_key.find("\x00")
+    while index_key[pos + 1] != "\x01":
+        pos = index_key.find("\x00", pos + 2)
+    return index_key[:pos].replace("\x00\xff", "\x00"), index_key[pos + 2:]
+
+
+def _indexValues(extractor, key, val):
+    if val is None:
+        return frozenset()
+    values = extractor(key, val)
+    if values is None:
+        return frozenset()
+    if isinstance(values, (basestring, bytearray, buffer, memoryview)):
+        values = [values]
+    return frozenset(_indexValue(value) for value in values)
+
+
+class IndexedDB(object):
+
+    """Keeps secondary indexes over the rows of a DBInterface (which may be a
+    scope). The rows are stored in db.scope("d"), and each index in its own
+    scope, db.scope("i" + name + "\\x00"), next to them.
+
+    indexes maps index names to extractor functions. An extractor is called
+    with the key and value of a row, and returns the row's value for that
+    index, a list of values, or None to leave the row out of the index.
+    Index values are strs (or other buffers), or unicode, which is indexed
+    as UTF-8 so that it sorts by code point. Any other value raises
+    TypeError before anything is written.
+
+    Every put, delete or write updates the rows and the index entries in one
+    write batch. The index entries to remove are found by reading the old
+    rows with a single getMany, and writes are serialized by a lock so that
+    two writes can't both see the same old row. Rows must only be changed
+    through this class, or the indexes go stale (see rebuildIndex).
+    """
+
+    def __init__(self, db, indexes):
+        for name in indexes:
+            if "\x00" in name:
+                raise ValueError("index names can't contain zero bytes")
+        self.db = db
+        self.rows = db.scope("d")
+        self._extractors = dict(indexes)
+        self._lock = threading.Lock()
+
+    def _indexScope(self, db, name):
+        if name not in self._extractors:
+            raise KeyError(name)
+        return db.scope("i%s\x00" % name)
+
+    def get(self, key, verify_checksums=None, fill_cache=None):
+        return self.rows.get(key, verify_checksums=verify_checksums,
+                             fill_cache=fill_cache)
+
+    def getMany(self, keys, verify_checksums=None, fill_cache=None):
+        return self.rows.getMany(keys, verify_checksums=verify_checksums,
+                                 fill_cache=fill_cache)
+
+    def iterator(self, **kwargs):
+        """Returns an Iterator over the rows. Takes the same arguments as
+        DBInterface.iterator.
+
+        @rtype: Iterator
+        """
+        return self.rows.iterator(**kwargs)
+
+    def put(self, key, val, sync=None):
+        batch = WriteBatch()
+        batch.put(key, val)
+        self.write(batch, sync=sync)
+
+    def delete(self, key, sync=None):
+        batch = WriteBatch()
+        batch.delete(key)
+        self.write(batch, sync=sync)
+
+    # pylint: disable=W0212
+    def write(self, batch, sync=None):
+        """Writes a WriteBatch of rows, along with the index entries that
+        change because of it."""
+        if batch._private:
+            raise ValueError("expected a WriteBatch")
+        changes = batch._puts.items()
+        changes.extend((key, None) for key in batch._deletes)
+        native = self.db.newBatch()
+        rows = native.scope("d")
+        with self._lock:
+            olds = self.rows.getMany([key for key, _ in changes],
+                                     fill_cache=False)
+            for (key, val), old in itertools.izip(changes, olds):
+                if val is None:
+                    rows.delete(key)
+                else:
+                    rows.put(key, val)
+                for name, extractor in self._extractors.iteritems():
+                    old_values = _indexValues(extractor, key, old)
+                    new_values = _indexValues(extractor, key, val)
+                    if old_values == new_values:
+                        continue
+                    index = native.scope("i%s\x00" % name)
+                    for value in old_values - new_values:
+                        index.delete(_encodeIndexValue(value) + key)
+                    for value in new_values - old_values:
+                        index.put(_encodeIndexValue(value) + key, "")
+            self.db.write(native, sync=sync)
+
+    def queryIndex(self, name, value_range=None, keys_only=False,
+                   chunk_size=100, verify_checksums=None, fill_cache=None):
+        """A generator for the rows whose value for the named index falls in
+        value_range, in index order. value_range is either a single value, or
+        a pair (start_value, end_value) of an inclusive start and exclusive
+        end, either of which may be None. A row with several matching values
+        is returned once per value. If keys_only is true, only the primary
+        keys are returned.
+
+        The index and the rows are read from one snapshot, and the rows are
+        looked up chunk_size at a time.
+
+        @rtype: Row (namedtuple of key, value) if keys_only=False, otherwise
+                string
+        """
+        if value_range is None:
+            start_key = end_key = None
+        elif isinstance(value_range, basestring):
+            start_key = _encodeIndexValue(value_range)
+            end_key = _nextPrefix(start_key)
+        else:
+            start_value, end_value = value_range
+            start_key = end_key = None
+            if start_value is not None:
+                start_key = _encodeIndexValue(start_value)
+            if end_value is not None:
+                end_key = _encodeIndexValue(end_value)
+        if name not in self._extractors:
+            raise KeyError(name)
+        snapshot = self.db.snapshot()
+        it = self._indexScope(snapshot, name).iterator(
+            verify_checksums=verify_checksums, fill_cache=fill_cache)
+        rows = snapshot.scope("d")
+        try:
+            index_rows = it.range(start_key=start_key, end_key=end_key)
+            while True:
+                keys = [_decodeIndexKey(row.key)[1]
+                        for row in itertools.islice(index_rows, chunk_size)]
+                if not keys:
+                    break
+                if keys_only:
+                    for key in keys:
+                        yield key
+                    continue
+                vals = rows.getMany(keys, verify_checksums=verify_checksums,
+                                    fill_cache=fill_cache)
+                for key, val in itertools.izip(keys, vals):
+                    yield Row(key, val)
+        finally:
+            it.close()
+            snapshot.close()
+
+    # pylint: disable=W0212
+    def rebuildIndex(self, name, sync=None, batch_size=1000):
+        """Throws away the named index and builds it again from the rows, for
+        an index that was just added or went stale. Writes are held off
+        until it is done."""
+        extractor = self._extractors[name]
+        index = self._indexScope(self.db, name)
+        with self._lock:
+            index.deleteRange(sync=sync)
+            batch = index.newBatch()
+            it = self.rows.iterator(fill_cache=False).seekFirst()
+            try:
+                for key, val in it:
+                    for value in _indexValues(extractor, key, val):
+                        batch.put(_encodeIndexValue(value) + key, "")
+                    if len(batch._puts) >= batch_size:
+                        index.write(batch, sync=sync)
+                        batch.clear()
+            finally:
+                it.close()
+            index.write(batch, sync=sync)
+
+
+class Counters(object):
+
+    """Combines updates to keys of a DBInterface (which may be a scope) in
+    memory, and writes them in batches every flush_interval seconds, from a
+    background thread, instead of reading and writing each key on every
+    update.
+
+    By default, the values are integers stored as decimal strings, and
+    updates are added to them. For other kinds of values, pass merge, an
+    associative function that combines two values (or pending updates) into
+    one, and decode and encode, which convert values from and to strings.
+
+    The keys are spread over stripes locks, so updates to different keys
+    rarely wait for each other. Reads see the written value merged with the
+    pending updates. The keys must only be written through this object, and
+    it must be closed, which writes the last updates and stops the thread.
+    """
+
+    def __init__(self, db, flush_interval=1.0, stripes=16, merge=None,
+                 decode=int, encode=str, sync=None):
+        self.db = db
+        self._merge = merge or operator.add
+        self._decode = decode
+        self._encode = encode
+        self._sync = sync
+        self._locks = [threading.Lock() for _ in xrange(stripes)]
+        self._pending = [{} for _ in xrange(stripes)]
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = None
+        if flush_interval is not None:
+            self._thread = threading.Thread(target=self._flushPeriodically,
+                                            args=(flush_interval,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _stripe(self, key):
+        return hash(key) % len(self._locks)
+
+    def _raiseError(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def merge(self, key, value):
+        """Merges value into the value of key."""
+        self._raiseError()
+        key = _toBytes(key)
+        stripe = self._stripe(key)
+        pending = self._pending[stripe]
+        with self._locks[stripe]:
+            if key in pending:
+                pending[key] = self._merge(pending[key], value)
+            else:
+                pending[key] = value
+
+    def increment(self, key, delta=1):
+        self.merge(key, delta)
+
+    def get(self, key, default=None):
+        """Returns the value of key, including the pending updates, or
+        default if it has neither."""
+        key = _toBytes(key)
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            val = self.db.get(key)
+            if val is not None:
+                val = self._decode(val)
+            if key not in self._pending[stripe]:
+                return default if val is None else val
+            if val is None:
+                return self._pending[stripe][key]
+            return self._merge(val, self._pending[stripe][key])
+
+    def flush(self):
+        """Writes the pending updates, a stripe at a time. Each stripe is
+        locked while it is written, so reads never miss an update."""
+        self._raiseError()
+        self._flush()
+
+    def _flush(self):
+        for stripe, lock in enumerate(self._locks):
+            with lock:
+                pending = self._pending[stripe]
+                if not pending:
+                    continue
+                keys = pending.keys()
+                batch = self.db.newBatch()
+                for key, val in itertools.izip(keys, self.db.getMany(keys)):
+                    if val is None:
+                        val = pending[key]
+                    else:
+                        val = self._merge(self._decode(val), pending[key])
+                    batch.put(key, self._encode(val))
+                self.db.write(batch, sync=self._sync)
+                pending.clear()
+
+    def _flushPeriodically(self, interval):
+        # a stripe that fails to write keeps its updates, to be tried again,
+        # and the error is raised from the next merge or flush.
+        while not self._stop.wait(interval):
+            try:
+                self._flush()
+            except Exception, e:
+                self._error = e
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+# leveldb's info log lines, as written by its default logger. The C api has no
+# way to create any other logger, so these are parsed from the LOG file.
+_LOG_LINE = re.compile(
+        r"(\d+)/(\d+)/(\d+)-(\d+):(\d+):(\d+)\.(\d+) (\S+) (.*)$")
+_LOG_FLUSH_START = re.compile(r"Level-0 table #(\d+): started$")
+_LOG_FLUSH = re.compile(r"Level-0 table #(\d+): (\d+) bytes (.*)$")
+_LOG_COMPACTING = re.compile(r"Compacting \d+@(\d+) \+ \d+@\d+ files$")
+_LOG_GENERATED = re.compile(r"Generated table #\d+@\d+: (\d+) keys,")
+_LOG_COMPACTED = re.compile(
+        r"Compacted \d+@(\d+) \+ \d+@\d+ files => (\d+) bytes$")
+_LOG_MOVED = re.compile(r"Moved #\d+ to level-(\d+) (\d+) bytes")
+_LOG_STALL = re.compile(
+        r"(Current memtable full|Too many L0 files); waiting\.\.\.$")
+_LOG_ERROR = re.compile(r"Compaction error: ")
+
+
+class _InfoLogParser(object):
+
+    # Pairs up the lines that start and finish each flush and compaction.
+    # Compactions run on one background thread, so they are paired by thread.
+    # A write stall has no line of its own when it ends, so it is taken to
+    # last until the flush (for a full memtable) or compaction (for too many
+    # level-0 files) that the writer was waiting for finishes.
+
+    def __init__(self):
+        self._flushes = {}
+        self._compactions = {}
+        self._stalls = {}
+
+    def _endStall(self, level, now, events):
+        if level in self._stalls:
+            start, message = self._stalls.pop(level)
+            events.append(LogEvent("stall", start, now - start, level, None,
+                                   None, message))
+
+    def feed(self, line):
+        """Returns the LogEvents that line completes."""
+        match = _LOG_LINE.match(line)
+        if match is None:
+            return []
+        fields = [int(field) for field in match.groups()[:6]]
+        micros = match.group(7)
+        now = (time.mktime(tuple(fields) + (0, 0, -1)) +
+               int(micros) / 10.0 ** len(micros))
+        thread, message = match.group(8), match.group(9)
+        events = []
+
+        match = _LOG_FLUSH_START.match(message)
+        if match is not None:
+            self._flushes[match.group(1)] = now
+            events.append(LogEvent("flush_start", now, None, 0, None, None,
+                                   message))
+            return events
+        match = _LOG_FLUSH.match(message)
+        if match is not None:
+            start = self._flushes.pop(match.group(1), now)
+            kind = "flush" if match.group(3) == "OK" else "error"
+            events.append(LogEvent(kind, start, now - start, 0,
+                                   int(match.group(2)), None, message))
+            self._endStall(None, now, events)
+            return events
+        match = _LOG_COMPACTING.match(message)
+        if match is not None:
+            level = int(match.group(1))
+            self._compactions[thread] = [now, 0]
+            events.append(LogEvent("compaction_start", now, None, level, None,
+                                   None, message))
+            return events
+        match = _LOG_GENERATED.match(message)
+        if match is not None:
+            if thread in self._compactions:
+                self._compactions[thread][1] += int(match.group(1))
+            return events
+        match = _LOG_COMPACTED.match(message)
+        if match is not None:
+            start, keys = self._compactions.pop(thread, (now, None))
+            events.append(LogEvent("compaction", start, now - start,
+                                   int(match.group(1)), int(match.group(2)),
+                                   keys, message))
+            self._endStall(0, now, events)
+            return events
+        match = _LOG_MOVED.match(message)
+        if match is not None:
+            events.append(LogEvent("move", now, 0.0, int(match.group(1)),
+                                   int(match.group(2)), None, message))
+            self._endStall(0, now, events)
+            return events
+        match = _LOG_STALL.match(message)
+        if match is not None:
+            # the writer logs again every time it wakes up and has to keep
+            # waiting, which is still the same stall.
+            level = None if match.group(1).startswith("Current") else 0
+            self._stalls.setdefault(level, (now, message))
+            return events
+        if _LOG_ERROR.match(message) is not None:
+            self._compactions.pop(thread, None)
+            events.append(LogEvent("error", now, None, None, None, None,
+                                   message))
+        return events
+
+
+class InfoLog(object):
+
+    """Follows the info log (the LOG file) of the database at path, and turns
+    its lines into LogEvents, which are passed to callback (if given) and
+    returned by poll.
+
+    The kinds of event are:
+      * "flush_start" and "flush" - a full memtable was switched for a new
+        one and is being, or has been, written to a level-0 table of bytes
+        bytes
+      * "compaction_start" and "compaction" - files of level (and the next
+        level) are being, or have been, merged into keys keys and bytes bytes
+      * "move" - a file was moved down to level without rewriting it
+      * "stall" - writes waited for a memtable flush (level is None) or
+        because there were too many level-0 files (level is 0)
+      * "error" - a flush or compaction failed
+
+    time is the time the event started, in seconds since the epoch, and
+    duration (None for *_start and "error" events) is how long it took. The
+    fields that do not apply to an event are None. message is the log line
+    itself.
+
+    Unless from_start is true, only lines written after the InfoLog was
+    created are reported. If poll_interval is not None, poll is called every
+    poll_interval seconds from a background thread, until close. The log is
+    followed across the database being closed and opened again.
+    """
+
+    def __init__(self, path, callback=None, poll_interval=1.0,
+                 from_start=False):
+        self.path = os.path.join(path, "LOG")
+        self._callback = callback
+        self._parser = _InfoLogParser()
+        self._lock = threading.Lock()
+        self._file = None
+        self._buffer = ""
+        self._skip = not from_start
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._open()
+        if poll_interval is not None:
+            self._thread = threading.Thread(target=self._pollPeriodically,
+                                            args=(poll_interval,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self):
+        try:
+            self._file = open(self.path, "rb")
+        except IOError:
+            return
+        finally:
+            skip, self._skip = self._skip, False
+        if skip:
+            self._file.seek(0, os.SEEK_END)
+
+    def _replaced(self):
+        # opening the database again renames LOG to LOG.old and starts a new
+        # LOG, so the old one will not grow any more.
+        try:
+            return os.stat(self.path).st_ino != os.fstat(
+                    self._file.fileno()).st_ino
+        except OSError:
+            return False
+
+    def poll(self):
+        """Reads the lines written since the last poll, and returns (after
+        passing them to callback) the LogEvents they complete.
+
+        An error raised by callback, or by reading the log, in the polling
+        thread does not stop it, and is raised from the next poll or close
+        instead. Every event is passed to callback even if it raises for one
+        of them, and the first error is raised after that."""
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+        events = []
+        with self._lock:
+            if self._file is None and not self._stop.is_set():
+                self._open()
+            while self._file is not None:
+                replaced = self._replaced()
+                lines = (self._buffer + self._file.read()).split("\n")
+                self._buffer = lines.pop()
+                for line in lines:
+                    events.extend(self._parser.feed(line))
+                if not replaced:
+                    break
+                self._file.close()
+                self._buffer = ""
+                self._open()
+        if self._callback is not None:
+            for event in events:
+                try:
+                    self._callback(event)
+                except Exception, e:
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+        return events
+
+    def _pollPeriodically(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.poll()
+            except Exception, e:
+                self._error = e
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.poll()
+        finally:
+            with self._lock:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
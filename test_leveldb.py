@@ -25,13 +25,26 @@ import os
 import sys
 import time
 import shutil
+import socket
+import struct
+import hashlib
 import random
+import StringIO
 import leveldb
 import argparse
 import tempfile
+import threading
 import unittest
 
 
+def pieceCounts(db, keys, start_key=None, end_key=None):
+    """Counts the rows of the pieces that split points keys cut a range of db
+    into."""
+    bounds = [start_key] + keys + [end_key]
+    return [sum(1 for _ in db.range(bounds[i], bounds[i + 1]))
+            for i in xrange(len(bounds) - 1)]
+
+
 class LevelDBTestCasesMixIn(object):
 
     db_class = None
@@ -66,6 +79,22 @@ class LevelDBTestCasesMixIn(object):
         self.assertEqual(list(db.values(prefix="key1")), ["val1"])
         db.close()
 
+    def testGetMany(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.put("key1", "val1")
+        db.put("key3", "val3")
+        self.assertEqual(db.getMany(["key1", "key2", "key3"]),
+                ["val1", None, "val3"])
+        self.assertEqual(db.getMany([]), [])
+        scoped = db.scope("key")
+        self.assertEqual(scoped.getMany(["3", "1"], fill_cache=False),
+                ["val3", "val1"])
+        snapshot = db.snapshot()
+        db.put("key2", "val2")
+        self.assertEqual(snapshot.getMany(["key1", "key2"]), ["val1", None])
+        self.assertEqual(db.getMany(["key1", "key2"]), ["val1", "val2"])
+        db.close()
+
     def testDelete(self):
         db = self.db_class(self.db_path, create_if_missing=True)
         self.assertTrue(db.get("key1") is None)
@@ -84,6 +113,94 @@ class LevelDBTestCasesMixIn(object):
         self.assertEqual(db.get("key3"), "val3")
         db.close()
 
+    def testDeleteRange(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        for i in xrange(100):
+            db.put("a%02d" % i, "x")
+            db.put("b%02d" % i, "x")
+        progress = []
+        self.assertEqual(db.deleteRange("a10", "a50", batch_bytes=30,
+                                        progress=progress.append), 40)
+        self.assertEqual(progress, range(10, 40, 10) + [40])
+        self.assertEqual(len(list(db.keys(prefix="a"))), 60)
+        self.assertEqual(db.get("a09"), "x")
+        self.assertEqual(db.get("a10"), None)
+        self.assertEqual(db.get("a50"), "x")
+        scoped = db.scope("a")
+        self.assertEqual(scoped.deleteRange(end_key="05", compact=True), 5)
+        self.assertEqual(scoped.deleteRange("90"), 10)
+        self.assertEqual(list(scoped.keys())[0], "05")
+        self.assertEqual(list(scoped.keys())[-1], "89")
+        self.assertEqual(len(list(db.keys(prefix="b"))), 100)
+        self.assertEqual(scoped.deleteRange(), 45)
+        self.assertEqual(list(scoped.keys()), [])
+        self.assertEqual(len(list(db.keys())), 100)
+        db.close()
+
+    def testDeletePrefix(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        for key in ["a", "b", "b1", "b2", "b\xff", "c", "\xff", "\xff1"]:
+            db.put(key, "x")
+        self.assertEqual(db.deletePrefix("b", compact=True), 4)
+        self.assertEqual(list(db.keys()), ["a", "c", "\xff", "\xff1"])
+        self.assertEqual(db.scope("\xff").deletePrefix("1"), 1)
+        self.assertEqual(db.deletePrefix("\xff", batch_bytes=1), 1)
+        self.assertEqual(db.deletePrefix("d"), 0)
+        self.assertEqual(list(db.keys()), ["a", "c"])
+        db.close()
+
+    def testApproximateCountSmallRanges(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped = db.scope("t1_")
+        for i in xrange(30):
+            scoped.put("%02d" % i, "x" * i)
+            db.put("t2_%02d" % i, "y")
+        self.assertEqual(scoped.approximateCount(), (30, 30, 30))
+        self.assertEqual(scoped.approximateCount("10", "20"), (10, 10, 10))
+        self.assertEqual(db.approximateCount(), (60, 60, 60))
+        self.assertEqual(db.snapshot().approximateCount(), (60, 60, 60))
+        self.assertTrue(db.approximateCount(samples=10).low >= 11)
+        self.assertEqual(db.scope("t3_").approximateCount(), (0, 0, 0))
+        self.assertTrue(scoped.approximateSize() >= 0)
+        self.assertEqual(db.scope("t3_").approximateSize(), 0)
+        db.close()
+
+    def testPage(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped = db.scope("t1_")
+        for i in xrange(25):
+            scoped.put("%02d" % i, str(i))
+            db.put("t2_%02d" % i, str(i))
+        for reverse in (False, True):
+            keys, token = [], None
+            while True:
+                page = scoped.page(start_after=token, limit=10,
+                                   reverse=reverse)
+                self.assertTrue(len(page.rows) <= 10)
+                keys.extend(row.key for row in page.rows)
+                token = page.token
+                if token is None:
+                    break
+            expected = ["%02d" % i for i in xrange(25)]
+            if reverse:
+                expected.reverse()
+            self.assertEqual(keys, expected)
+        page = db.page(limit=3, prefix="t2_1")
+        self.assertEqual(page.rows, [("0", "10"), ("1", "11"), ("2", "12")])
+        page = db.page(start_after=page.token, limit=100, prefix="t2_1")
+        self.assertEqual([row.key for row in page.rows],
+                [str(i) for i in xrange(3, 10)])
+        self.assertEqual(page.token, None)
+        page = scoped.page(limit=5)
+        self.assertRaises(ValueError, db.page, start_after=page.token)
+        self.assertRaises(ValueError, db.scope("t2_").page,
+                          start_after=page.token)
+        self.assertRaises(ValueError, scoped.page, start_after=page.token,
+                          reverse=True)
+        self.assertRaises(ValueError, scoped.page, start_after="garbage!")
+        self.assertEqual(db.scope("t3_").page(), ([], None))
+        db.close()
+
     def testRange(self):
         db = self.db_class(self.db_path, create_if_missing=True)
 
@@ -289,6 +406,529 @@ class LevelDBTestCasesMixIn(object):
         for i, scope in enumerate(scopes):
             self.assertEquals(scope.get(str(i)), None)
 
+    def testScopedWriteBatch(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped_db = db.scope("prefix1_")
+        batch = scoped_db.newBatch()
+        self.assertTrue(isinstance(batch, leveldb.ScopedWriteBatch))
+        nested = batch.scope("a_")
+        batch.put("1", "2")
+        nested.put("3", "4")
+        nested.put("5", "6")
+        nested.delete("5")
+        db.scope("prefix2_").putTo(batch, "7", "8")
+        db.scope("prefix3_").write(batch)
+        self.assertEqual(list(db), [("prefix1_1", "2"), ("prefix1_a_3", "4"),
+                                    ("prefix2_7", "8")])
+        batch.clear()
+        self.assertEqual(nested._puts, {})
+        nested.delete("3")
+        db.newBatch().scope("prefix2_").put("9", "10")
+        scoped_db.write(batch)
+        self.assertEqual(list(db), [("prefix1_1", "2"), ("prefix2_7", "8")])
+        db.close()
+
+    def testBuffers(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped_db = db.scope("s_")
+        val = bytearray("v" * 100)
+        db.put(bytearray("a"), val)
+        db.put(memoryview("b"), memoryview(val)[:10])
+        scoped_db.put(bytearray("c"), buffer(val, 0, 5))
+        scoped_db.put(memoryview("d" * 100), "1")
+        batch = scoped_db.newBatch()
+        batch.put(bytearray("e"), val)
+        batch.delete(memoryview("d" * 100))
+        scoped_db.write(batch)
+        batch = leveldb.WriteBatch()
+        batch.put(memoryview("f"), bytearray("2"))
+        scoped_db.write(batch)
+        self.assertEqual(list(db), [("a", "v" * 100), ("b", "v" * 10),
+                                    ("s_c", "v" * 5), ("s_e", "v" * 100),
+                                    ("s_f", "2")])
+        self.assertEqual(db.get(bytearray("b")), "v" * 10)
+        self.assertEqual(scoped_db.get(memoryview("c")), "v" * 5)
+        self.assertEqual(scoped_db.getMany([bytearray("f"), "e"]),
+                         ["2", "v" * 100])
+        it = scoped_db.iterator().seek(bytearray("d"))
+        self.assertEqual(it.key(), "e")
+        scoped_db.delete(bytearray("e"))
+        db.delete(memoryview("a"))
+        self.assertEqual(list(db.keys()), ["b", "s_c", "s_f"])
+        self.assertRaises(TypeError, db.put, u"u", "v")
+        self.assertRaises(TypeError, scoped_db.put, "u", u"v")
+        self.assertEqual(list(db.keys()), ["b", "s_c", "s_f"])
+        db.close()
+
+    def testReadahead(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = leveldb.WriteBatch()
+        for i in xrange(100):
+            batch.put("%03d" % i, str(i))
+        db.write(batch)
+        threads = threading.active_count()
+        it = db.iterator(readahead=7, readahead_chunks=2)
+        self.assertEqual(list(it.seekFirst()), list(db))
+        self.assertEqual(threading.active_count(), threads)
+        it.seek("050")
+        self.assertEqual(it.next(), ("050", "50"))
+        self.assertEqual(it.next(), ("051", "51"))
+        self.assertEqual(it.prev(), ("052", "52"))
+        self.assertEqual(it.prev(), ("051", "51"))
+        self.assertEqual(it.prev(), ("050", "50"))
+        self.assertEqual(it.prev(), ("049", "49"))
+        self.assertEqual([row.key for row in it.range("090", "093")],
+                         ["090", "091", "092"])
+        self.assertEqual(list(db.iterator(prefix="09",
+                                          readahead=3).seekFirst().keys()),
+                         [str(i) for i in xrange(10)])
+        it.seekFirst()
+        it.next()
+        it.close()
+        self.assertEqual(threading.active_count(), threads)
+        it = db.iterator(readahead=5, readahead_chunks=1).seekFirst()
+        it.next()
+        del it
+        self.assertEqual(threading.active_count(), threads)
+        it = db.iterator(keys_only=True, readahead=5).seekFirst()
+        self.assertEqual(it.value(), None)
+        self.assertEqual(list(it), ["%03d" % i for i in xrange(100)])
+        db.close()
+
+    def testSplitPoints(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = db.newBatch()
+        for i in xrange(3000):
+            batch.put("k%05d" % (i * 7), "v" * (i % 50))
+        db.put("a", "before")
+        db.write(batch)
+        scoped_db = db.scope("k")
+        for source in (scoped_db, scoped_db.snapshot()):
+            splits = source.splitPoints(4)
+            self.assertEqual(len(splits.keys), 3)
+            self.assertEqual(splits.keys, sorted(splits.keys))
+            counts = pieceCounts(source, splits.keys)
+            for count, estimate in zip(counts, splits.counts):
+                self.assertTrue(500 < count < 1000, counts)
+                self.assertTrue(0.8 < float(estimate) / count < 1.25,
+                                (counts, splits.counts))
+            self.assertEqual(len(splits.sizes), 4)
+        splits = db.splitPoints(3, "k01000", "k02000")
+        self.assertTrue(all("k01000" < key < "k02000"
+                            for key in splits.keys))
+        self.assertEqual(db.scope("z").splitPoints(3), ([], [0], [0]))
+        self.assertEqual(db.splitPoints(5, "a", "b").keys, [])
+        self.assertEqual(db.splitPoints(1).keys, [])
+        self.assertRaises(ValueError, db.splitPoints, 0)
+        db.close()
+
+    def testSplitPointsSkewed(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = db.newBatch()
+        for i in xrange(100):
+            batch.put("account/%03d" % i, "x" * 50)
+            batch.put("zone/%03d" % i, "x" * 50)
+        for i in xrange(8000):
+            batch.put("event/2024-01-01T%02d:%02d:%02d.%03d" % (
+                    i // 3600, i // 60 % 60, i % 60, i % 1000), "x" * 50)
+        db.write(batch)
+        for source in (db, db.snapshot()):
+            splits = source.splitPoints(4)
+            self.assertEqual(len(splits.keys), 3)
+            self.assertTrue(all(key.startswith("event/")
+                                for key in splits.keys), splits.keys)
+            counts = pieceCounts(source, splits.keys)
+            for count, estimate in zip(counts, splits.counts):
+                self.assertTrue(1000 < count < 3000, counts)
+                self.assertTrue(0.25 < float(estimate) / count < 4,
+                                (counts, splits.counts))
+            splits = source.splitPoints(4, probes=1)
+            self.assertTrue(splits.keys)
+            self.assertTrue(sum(splits.counts) < 100000, splits.counts)
+        db.close()
+
+    def testSplitPointsHexKeys(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = db.newBatch()
+        for i in xrange(8000):
+            batch.put(hashlib.md5(str(i)).hexdigest(), "x" * 50)
+        db.write(batch)
+        splits = db.splitPoints(4)
+        self.assertEqual(len(splits.keys), 3)
+        counts = pieceCounts(db, splits.keys)
+        for count, estimate in zip(counts, splits.counts):
+            self.assertTrue(1000 < count < 3000, counts)
+            self.assertTrue(0.6 < float(estimate) / count < 1.6,
+                            (counts, splits.counts))
+        db.close()
+
+    def testBlobsStayOutOfScopes(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped_db = db.scope("s/")
+        batch = scoped_db.newBatch()
+        for i in xrange(2000):
+            batch.put("%05d" % i, "x" * 50)
+        scoped_db.write(batch)
+        data = "".join(chr(i % 251) for i in xrange(100000))
+        scoped_db.putStream("blob", StringIO.StringIO(data), chunk_size=1024)
+        keys = list(scoped_db.keys())
+        self.assertEqual(len(keys), 2001)
+        self.assertEqual(keys[-1], "blob")
+        splits = scoped_db.splitPoints(4)
+        self.assertEqual(len(splits.keys), 3)
+        self.assertTrue(all(key[:1] in "0b" for key in splits.keys),
+                        splits.keys)
+        self.assertTrue(sum(splits.counts) < 4000, splits.counts)
+        page = scoped_db.page(limit=5000)
+        self.assertEqual([key for key, _ in page.rows], keys)
+        self.assertEqual(scoped_db.scope("blob").keys().next(), "")
+        with scoped_db.openStream("blob") as blob:
+            self.assertEqual(blob.read(), data)
+        db.close()
+
+    def testToArrays(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped_db = db.scope("m")
+        batch = scoped_db.newBatch()
+        for i in xrange(50):
+            batch.put(struct.pack(">I", i), struct.pack("<dd", i, -i))
+        db.write(batch)
+        db.put("v1", "a")
+        db.put("v2", "")
+        db.put("v3", "bcd")
+        keys, vals = scoped_db.toArrays(key_dtype=">u4",
+                                        value_dtype=[("x", "<f8"),
+                                                     ("y", "<f8")],
+                                        chunk_size=7)
+        self.assertEqual(keys.tolist(), range(50))
+        self.assertEqual(vals["y"].tolist(), [-i for i in xrange(50)])
+        keys, vals = scoped_db.toArrays(struct.pack(">I", 10),
+                                        struct.pack(">I", 20),
+                                        key_dtype=">u4", chunk_size=4)
+        self.assertEqual(keys.tolist(), range(10, 20))
+        offsets, data = vals
+        self.assertEqual(offsets.tolist(), range(0, 161, 16))
+        self.assertEqual(data.tostring()[16:32], struct.pack("<dd", 11, -11))
+        (key_offsets, key_data), (offsets, data) = db.scope("v").toArrays()
+        self.assertEqual(key_offsets.tolist(), [0, 1, 2, 3])
+        self.assertEqual(key_data.tostring(), "123")
+        self.assertEqual(offsets.tolist(), [0, 1, 1, 4])
+        self.assertEqual(data.tostring(), "abcd")
+        keys, vals = db.scope("z").toArrays(key_dtype="S2", value_dtype="u1")
+        self.assertEqual((len(keys), len(vals)), (0, 0))
+        self.assertRaises(ValueError, db.toArrays, key_dtype=">u4")
+        db.close()
+
+    def testIndexedDB(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        people = leveldb.IndexedDB(db.scope("people/"), {
+            "city": lambda key, val: val.split(",")[0],
+            "tag": lambda key, val: val.split(",")[1:] or None})
+        people.put("ann", "oslo,a,b")
+        people.put("bob", "rome")
+        people.put("cat", "oslo\x00x,b")
+        batch = leveldb.WriteBatch()
+        batch.put("dan", "lima,a")
+        batch.put("eve", "rome,c")
+        people.write(batch)
+        self.assertEqual(list(people.queryIndex("city", "oslo")),
+                         [("ann", "oslo,a,b")])
+        self.assertEqual(list(people.queryIndex("city", ("m", "z"),
+                                                keys_only=True)),
+                         ["ann", "cat", "bob", "eve"])
+        self.assertEqual(list(people.queryIndex("tag", "b", keys_only=True)),
+                         ["ann", "cat"])
+        people.put("ann", "rome,c")
+        people.delete("cat")
+        self.assertEqual(list(people.queryIndex("city", (None, "p"),
+                                                keys_only=True)),
+                         ["dan"])
+        self.assertEqual(list(people.queryIndex("tag", ("b", None),
+                                                keys_only=True, chunk_size=1)),
+                         ["ann", "eve"])
+        self.assertEqual(people.get("ann"), "rome,c")
+        self.assertEqual(list(db.scope("people/d").keys()),
+                         ["ann", "bob", "dan", "eve"])
+        self.assertRaises(KeyError, list, people.queryIndex("age"))
+        db.scope("people/itag\x00").deleteRange()
+        self.assertEqual(list(people.queryIndex("tag")), [])
+        people.rebuildIndex("tag", batch_size=1)
+        self.assertEqual(list(people.queryIndex("tag", keys_only=True)),
+                         ["dan", "ann", "eve"])
+        names = leveldb.IndexedDB(db.scope("names/"), {
+            "name": lambda key, val: val.decode("utf-8"),
+            "length": lambda key, val: len(val)})
+        self.assertRaises(TypeError, names.put, "1", "z")
+        self.assertEqual(list(db.scope("names/").keys()), [])
+        del names._extractors["length"]
+        names.put("1", u"\u00e9".encode("utf-8"))
+        names.put("2", "z")
+        names.put("3", u"\u0100".encode("utf-8"))
+        self.assertEqual(list(names.queryIndex("name", keys_only=True)),
+                         ["2", "1", "3"])
+        self.assertEqual(list(names.queryIndex("name", u"\u00e9",
+                                               keys_only=True)), ["1"])
+        db.close()
+
+    def testCounters(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.put("hits/a", "5")
+        counters = leveldb.Counters(db.scope("hits/"), flush_interval=None,
+                                    stripes=4)
+
+        def count():
+            for i in xrange(200):
+                counters.increment("a")
+                counters.increment("b", 2)
+
+        threads = [threading.Thread(target=count) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counters.get("a"), 805)
+        self.assertEqual(counters.get("b"), 1600)
+        self.assertEqual(counters.get("c", 0), 0)
+        self.assertEqual(db.get("hits/b"), None)
+        counters.flush()
+        counters.increment("a", -5)
+        self.assertEqual(db.get("hits/a"), "805")
+        self.assertEqual(counters.get("a"), 800)
+        counters.close()
+        self.assertEqual(db.get("hits/a"), "800")
+        with leveldb.Counters(db.scope("max/"), flush_interval=0.01,
+                              merge=max, decode=float,
+                              encode=repr) as highs:
+            highs.merge("t", 1.5)
+            highs.merge("t", 0.5)
+            for _ in xrange(100):
+                if db.get("max/t") is not None:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(db.get("max/t"), "1.5")
+            highs.merge("t", 2.5)
+            self.assertEqual(highs.get("t"), 2.5)
+        self.assertEqual(db.get("max/t"), "2.5")
+        db.close()
+
+    def testCountersFlushError(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        counters = leveldb.Counters(FailingWrites(db), flush_interval=0.01)
+        counters.increment("a")
+        for _ in xrange(100):
+            if counters._error is not None:
+                break
+            time.sleep(0.01)
+        self.assertRaises(leveldb.Error, counters.increment, "a")
+        self.assertTrue(counters._thread.is_alive())
+        counters.increment("a")
+        counters.close()
+        self.assertEqual(db.get("a"), "2")
+        db.close()
+
+    def testUpdate(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped_db = db.scope("u/")
+
+        def increment(val):
+            return str(int(val or "0") + 1)
+
+        def count():
+            for i in xrange(50):
+                scoped_db.update("a", increment)
+                scoped_db.updateMany(["b", "c", "b"], increment)
+
+        threads = [threading.Thread(target=count) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scoped_db.getMany(["a", "b", "c"]),
+                         ["200", "400", "200"])
+        self.assertEqual(scoped_db.updateMany(["a", "c"], lambda val: None),
+                         [None, None])
+        self.assertEqual(list(db.keys()), ["u/b"])
+        self.assertEqual(scoped_db.update("d", increment), "1")
+        db.close()
+
+    def testValueCodec(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        records = ['{"id": %d, "status": "%s", "owner": "user%d"}' %
+                   (i, ("active", "deleted")[i % 2], i % 7)
+                   for i in xrange(200)]
+        codec = leveldb.ZlibCodec([leveldb.trainDictionary(records[:100])])
+        docs = db.scope("docs/", value_codec=codec)
+        batch = docs.newBatch()
+        for i, record in enumerate(records):
+            batch.put("%03d" % i, record)
+        docs.write(batch)
+        docs.put("empty", "")
+        self.assertEqual(docs.get("150"), records[150])
+        self.assertEqual(docs.getMany(["001", "empty", "x"]),
+                         [records[1], "", None])
+        self.assertEqual(list(docs.range("010", "013")),
+                         [("%03d" % i, records[i]) for i in xrange(10, 13)])
+        self.assertEqual(docs.snapshot().get("199"), records[199])
+        raw = db.scope("docs/")
+        self.assertEqual(raw.get("150")[:3], "\xc0\xc1\x02")
+        self.assertEqual(raw.get("empty"), "")
+        self.assertTrue(len(raw.get("150")) < len(records[150]) // 2)
+        self.assertEqual(docs.scope("0").get("42"), records[42])
+        self.assertEqual(db.scope("docs/0", value_codec=codec).get("42"),
+                         records[42])
+        newer = leveldb.ZlibCodec(codec.dictionaries + ["owner status"])
+        self.assertEqual(leveldb.recompress(raw, newer, batch_bytes=100),
+                         200)
+        self.assertEqual(raw.get("150")[:3], "\xc0\xc1\x03")
+        self.assertRaises(leveldb.Error, docs.get, "150")
+        self.assertEqual(raw.get("empty"), "")
+        db.put("plain/a", records[0])
+        plain = db.scope("plain/")
+        self.assertEqual(leveldb.recompress(plain, codec, encoded=False), 1)
+        self.assertEqual(plain.get("a")[:3], "\xc0\xc1\x02")
+        db.close()
+
+    def testValueCodecOverPlainValues(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        vals = ["", "x", "plain value", "\x00\x01\x02", "\xc0\xc1"]
+        for i, val in enumerate(vals):
+            db.put("v/%d" % i, val)
+        codec = leveldb.ZlibCodec()
+        docs = db.scope("v/", value_codec=codec)
+        self.assertEqual(docs.getMany(map(str, xrange(len(vals)))), vals)
+        self.assertEqual(list(docs.values()), vals)
+        long_val = "compressible " * 20
+        for key, val in [("a", long_val), ("b", "\xc0\xc1\x01tricky"),
+                         ("c", "")]:
+            docs.put(key, val)
+            self.assertEqual(docs.get(key), val)
+        raw = db.scope("v/")
+        self.assertEqual(raw.get("a")[:3], "\xc0\xc1\x01")
+        self.assertEqual(raw.get("b"), "\xc0\xc1\x00\xc0\xc1\x01tricky")
+        self.assertEqual(raw.get("c"), "")
+        db.close()
+
+    def testStreams(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        files = db.scope("files/")
+        data = "".join(chr(i % 251) for i in xrange(10000))
+        self.assertEqual(files.putStream("a", StringIO.StringIO(data),
+                                         chunk_size=1024, batch_bytes=3000),
+                         10000)
+        chunk_keys = list(db.keys(prefix="\xff\xffblob\x00"))
+        self.assertEqual(len(chunk_keys), 10)
+        self.assertEqual(list(files.keys()), ["a"])
+        blob = files.openStream("a")
+        self.assertEqual(blob.size, 10000)
+        self.assertEqual(blob.read(10), data[:10])
+        blob.seek(1020)
+        self.assertEqual(blob.read(2000), data[1020:3020])
+        self.assertEqual(blob.tell(), 3020)
+        blob.seek(-5, os.SEEK_END)
+        self.assertEqual(blob.read(), data[-5:])
+        self.assertEqual(blob.read(), "")
+        blob.seek(0)
+        files.putStream("a", StringIO.StringIO("new"))
+        self.assertEqual(blob.read(), data)
+        blob.close()
+        with files.openStream("a") as blob:
+            self.assertEqual(blob.read(), "new")
+        files.putStream("empty", StringIO.StringIO(""))
+        self.assertEqual(files.openStream("empty").read(), "")
+        self.assertEqual(files.openStream("missing"), None)
+        files.put("plain", "value")
+        self.assertRaises(ValueError, files.openStream, "plain")
+        files.deleteStream("a")
+        files.deleteStream("empty")
+        self.assertEqual(list(db.keys()), ["files/plain"])
+        nested = files.scope("n/")
+        nested.putStream("b", StringIO.StringIO(data), chunk_size=1024)
+        with db.openStream("files/n/b") as blob:
+            self.assertEqual(blob.read(), data)
+        self.assertEqual(list(nested.keys()), ["b"])
+        self.assertEqual(len(list(db.keys())), 12)
+        self.assertEqual(files.deletePrefix("n/"), 1)
+        self.assertEqual(list(db.keys()), ["files/plain"])
+        nested.putStream("c", StringIO.StringIO(data), chunk_size=1024)
+        nested.deleteRange()
+        self.assertEqual(list(db.keys()), ["files/plain"])
+        nested.putStream("d", StringIO.StringIO(data), chunk_size=1024)
+        db.deleteStream("files/n/d")
+        self.assertEqual(list(db.keys()), ["files/plain"])
+        db.close()
+
+    def testTransactions(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped_db = db.scope("t/")
+        scoped_db.put("n", "0")
+        with scoped_db.transaction() as txn:
+            self.assertEqual(txn.getMany(["n", "m"]), ["0", None])
+            txn.put("m", "1")
+            txn.delete("n")
+            self.assertEqual(txn.get("m"), "1")
+            self.assertFalse(txn.has("n"))
+            self.assertEqual(scoped_db.get("n"), "0")
+        self.assertEqual(list(db.keys()), ["t/m"])
+        txn = scoped_db.transaction()
+        txn.get("m")
+        txn.put("x", "y")
+        scoped_db.put("m", "2")
+        self.assertRaises(leveldb.TransactionConflict, txn.commit)
+        self.assertEqual(scoped_db.get("x"), None)
+
+        def increment(txn):
+            txn.put("m", str(int(txn.get("m")) + 1))
+
+        def count():
+            for _ in xrange(20):
+                scoped_db.transact(increment, retries=1000)
+
+        threads = [threading.Thread(target=count) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scoped_db.get("m"), "82")
+        db.close()
+
+    def testTransactionsWithUpdates(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scoped_db = db.scope("t/")
+        scoped_db.put("a", "1")
+        txn = scoped_db.transaction()
+        self.assertEqual(txn.get("a"), "1")
+        txn.put("b", "1")
+        with scoped_db.transaction() as other:
+            other.put("a", "2")
+        db.update("t/a", lambda val: "1")
+        self.assertRaises(leveldb.TransactionConflict, txn.commit)
+        self.assertEqual(scoped_db.get("b"), None)
+
+        def increment(val):
+            return str(int(val) + 1)
+
+        def count(i):
+            for _ in xrange(20):
+                if i % 2:
+                    scoped_db.update("a", increment)
+                else:
+                    scoped_db.transact(
+                            lambda txn: txn.put("a", increment(txn.get("a"))),
+                            retries=1000)
+
+        threads = [threading.Thread(target=count, args=(i,))
+                   for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scoped_db.get("a"), "81")
+        db.close()
+
     def testKeysWithZeroBytes(self):
         db = self.db_class(self.db_path, create_if_missing=True)
         key_with_zero_byte = ("\x01\x00\x02\x03\x04")
@@ -385,6 +1025,124 @@ class LevelDBTestCases(LevelDBTestCasesMixIn, unittest.TestCase):
         self.assertRaises(leveldb.Error, self.db_class, self.db_path,
                 create_if_missing=True, error_if_exists=True)
 
+    def testApproximateCount(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = leveldb.WriteBatch()
+        for i in xrange(2000):
+            batch.put("k%05d" % i, os.urandom(100))
+        db.write(batch)
+        db.close()
+        db = self.db_class(self.db_path)
+        estimate = db.approximateCount(samples=50)
+        self.assertTrue(estimate.low <= estimate.value <= estimate.high)
+        self.assertTrue(1000 < estimate.value < 4000)
+        self.assertTrue(db.approximateSize("k") >= 100 * 2000)
+        self.assertEqual(db.approximateSize("j"), 0)
+        db.close()
+
+    def testApproximateCountMemtable(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = db.newBatch()
+        for i in xrange(20000):
+            batch.put(hashlib.md5(str(i)).hexdigest(), "x" * 50)
+        db.write(batch)
+        self.assertEqual(db.approximateSize(), 0)
+        for source in (db, db.snapshot()):
+            estimate = source.approximateCount()
+            self.assertTrue(estimate.low <= 20000 <= estimate.high, estimate)
+            self.assertTrue(14000 < estimate.value < 28000, estimate)
+        db.close()
+
+    def testIteratorPool(self):
+        db = self.db_class(self.db_path, create_if_missing=True,
+                           iterator_pool_size=2, iterator_max_uses=3)
+        db.put("a1", "1")
+        db.put("b1", "2")
+        self.assertEqual(list(db.keys(prefix="a")), ["1"])
+        it = db.iterator()
+        first_ref = it._impl._ref
+        self.assertFalse(it.valid())
+        it.close()
+        # the pool is per set of read options
+        it = db.iterator(fill_cache=False)
+        self.assertFalse(it._impl._ref is first_ref)
+        it.close()
+        # writes make the idle iterators stale, so reads see them right away
+        db.put("a2", "3")
+        self.assertEqual(list(db.keys(prefix="a")), ["1", "2"])
+        self.assertEqual(first_ref.ref, None)
+        it = db.iterator()
+        second_ref = it._impl._ref
+        it.close()
+        it = db.iterator()
+        self.assertTrue(it._impl._ref is second_ref)
+        it.close()
+        batch = db.newBatch()
+        batch.put("b2", "0")
+        db.write(batch)
+        it = db.iterator()
+        self.assertFalse(it._impl._ref is second_ref)
+        # abandoned scans still check their iterators back in
+        rows = db.range("a", "b")
+        self.assertEqual(rows.next(), ("a1", "1"))
+        del rows
+        self.assertEqual(len(db._impl._iterators._idle[False, True]), 1)
+        snapshot = db.snapshot()
+        db.put("a3", "4")
+        self.assertEqual(list(snapshot.keys(prefix="a")), ["1", "2"])
+        self.assertEqual(list(db.keys(prefix="a", verify_checksums=True)),
+                         ["1", "2", "3"])
+        it.close()
+        db.close()
+        db = self.db_class(self.db_path, iterator_pool_size=1,
+                           iterator_max_age=0)
+        self.assertEqual(list(db.keys(prefix="a")), ["1", "2", "3"])
+        db.put("a4", "5")
+        self.assertEqual(list(db.keys(prefix="a")), ["1", "2", "3", "4"])
+        db.close()
+
+    def testReferrersAreRemoved(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.put("a", "b")
+        db_ref = db._impl._db
+        its = [db.iterator() for _ in xrange(10)]
+        snapshot = db.snapshot()
+        self.assertEqual(len(db_ref._referrers), 11)
+        for it in its[:5]:
+            it.close()
+        self.assertEqual(len(db_ref._referrers), 6)
+        del its[5:]
+        self.assertEqual(len(db_ref._referrers), 1)
+        self.assertTrue(db_ref.hasReferrers())
+        it = snapshot.iterator().seekFirst()
+        db.close()
+        self.assertEqual(db_ref._referrers, {})
+        self.assertEqual(it._impl._ref.ref, None)
+        self.assertFalse(db_ref.hasReferrers())
+
+    def testSharedCache(self):
+        cache = leveldb.Cache(1024 * 1024)
+        filter_policy = leveldb.BloomFilterPolicy(8)
+        dbs = [self.db_class(os.path.join(self.db_path, str(i)),
+                             create_if_missing=True, cache=cache,
+                             filter_policy=filter_policy)
+               for i in xrange(3)]
+        for i, db in enumerate(dbs):
+            db.put("key", str(i))
+        dbs[0].close()
+        self.assertTrue(cache._ref.ref is not None)
+        self.assertTrue(filter_policy._ref.ref is not None)
+        self.assertEqual([db.get("key") for db in dbs[1:]], ["1", "2"])
+        dbs[1].close()
+        cache.close()
+        filter_policy.close()
+        # closing the cache closes whatever still uses it
+        self.assertTrue(dbs[2]._impl._db.ref is None)
+        db = self.db_class(os.path.join(self.db_path, "0"),
+                           cache=leveldb.Cache(1024 * 1024))
+        self.assertEqual(db.get("key"), "0")
+        db.close()
+
     def testPutSync(self, size=100):
         db = self.db_class(self.db_path, create_if_missing=True)
         for i in xrange(size):
@@ -420,6 +1178,111 @@ class LevelDBTestCases(LevelDBTestCasesMixIn, unittest.TestCase):
         self.assertTrue(sync_time > 10 * unsync_time)
         db.close()
 
+    def testSnapshotClose(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.put("a", "1")
+        with db.snapshot() as snapshot:
+            db.put("a", "2")
+            self.assertEqual(snapshot.get("a"), "1")
+        self.assertRaises(leveldb.Error, snapshot.get, "a")
+        self.assertRaises(leveldb.Error, snapshot.iterator)
+        self.assertEqual(db.get("a"), "2")
+        db.close()
+
+    def testSplitPointsCompacted(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = db.newBatch()
+        for i in xrange(40000):
+            batch.put("row%08d" % (i * 13), "v" * (i % 100))
+        db.write(batch)
+        batch = db.newBatch()
+        for i in xrange(100):
+            batch.put("z/account/%03d" % i, "x" * 50)
+            batch.put("z/zone/%03d" % i, "x" * 50)
+        for i in xrange(20000):
+            batch.put("z/event/2024-01-01T%02d:%02d:%02d.%03d" % (
+                    i // 3600, i // 60 % 60, i % 60, i % 1000), "x" * 50)
+        db.write(batch)
+        db.compactRange(None, None)
+        splits = db.splitPoints(4, end_key="s")
+        counts = pieceCounts(db, splits.keys, end_key="s")
+        for count, estimate in zip(counts, splits.counts):
+            self.assertTrue(9000 < count < 11000, counts)
+            self.assertTrue(0.9 < float(estimate) / count < 1.1,
+                            (counts, splits.counts))
+        scoped_db = db.scope("z/")
+        splits = scoped_db.splitPoints(4)
+        self.assertTrue(all(key.startswith("event/")
+                            for key in splits.keys), splits.keys)
+        counts = pieceCounts(scoped_db, splits.keys)
+        for count, estimate in zip(counts, splits.counts):
+            self.assertTrue(4000 < count < 6250, counts)
+            self.assertTrue(0.5 < float(estimate) / count < 3,
+                            (counts, splits.counts))
+        db.close()
+
+    def testReadaheadClosedDatabase(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        for i in xrange(1000):
+            db.put("%04d" % i, "x" * 100)
+        threads = threading.active_count()
+        its = [db.iterator(readahead=10, readahead_chunks=1).seekFirst()
+               for _ in xrange(3)]
+        its.append(db.snapshot().iterator(readahead=10).seek("0500"))
+        self.assertEqual(its[-1].next().key, "0500")
+        db.close()
+        self.assertEqual(threading.active_count(), threads)
+        for it in its:
+            it.close()
+
+    def testReleasesSnapshots(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db_ref = db._impl._db
+        db.put("a", "1")
+        txn = db.transaction()
+        self.assertEqual(txn.get("a"), "1")
+        self.assertTrue(db_ref.hasReferrers())
+        txn.put("a", "2")
+        txn.commit()
+        self.assertFalse(db_ref.hasReferrers())
+        txn = db.transaction()
+        txn.abort()
+        self.assertFalse(db_ref.hasReferrers())
+        txn = db.transaction()
+        self.assertEqual(txn.get("a"), "2")
+        db.update("a", lambda val: "3")
+        self.assertRaises(leveldb.TransactionConflict, txn.commit)
+        self.assertFalse(db_ref.hasReferrers())
+        db.putStream("b", StringIO.StringIO("data"))
+        blob = db.openStream("b")
+        self.assertTrue(db_ref.hasReferrers())
+        blob.close()
+        self.assertFalse(db_ref.hasReferrers())
+        self.assertEqual(db.openStream("missing"), None)
+        self.assertRaises(ValueError, db.openStream, "a")
+        self.assertFalse(db_ref.hasReferrers())
+        db.close()
+
+    def testKeyVersionLimit(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        key_locks = leveldb._keyLocks(db.scope("s/")._impl)
+        self.assertTrue(key_locks is leveldb._keyLocks(db._impl))
+        key_locks._max_versions = 2
+        db.put("a", "1")
+        txn = db.transaction()
+        late = None
+        for i, key in enumerate(["x", "y", "z"]):
+            db.update(key, lambda val: "1")
+            if i == 1:
+                late = db.transaction()
+        self.assertEqual(txn.get("a"), "1")
+        self.assertRaises(leveldb.TransactionConflict, txn.commit)
+        self.assertEqual(late.get("a"), "1")
+        late.put("b", "1")
+        late.commit()
+        self.assertEqual(db.get("b"), "1")
+        db.close()
+
     def testSegfaultFromIssue2(self, short_time=10):
         """https://code.google.com/p/leveldb-py/issues/detail?id=2"""
         # i assume the reporter meant opening a new db a bunch of times?
@@ -480,10 +1343,770 @@ class LevelDBTestCases(LevelDBTestCasesMixIn, unittest.TestCase):
             shutil.rmtree(path)
 
 
+class LibraryTestCases(unittest.TestCase):
+
+    def testLazyBinding(self):
+        lib = leveldb._Library(leveldb._SIGNATURES)
+        self.assertTrue(lib._lib is None)
+        self.assertRaises(AttributeError, getattr, lib, "leveldb_bogus")
+        self.assertTrue(lib._lib is None)
+        options = lib.leveldb_options_create()
+        self.assertTrue(lib._lib is not None)
+        self.assertTrue("leveldb_options_create" in lib.__dict__)
+        self.assertFalse("leveldb_options_destroy" in lib.__dict__)
+        self.assertEqual(lib.leveldb_options_destroy.restype, None)
+        lib.leveldb_options_destroy(options)
+
+    def testLibraryPath(self):
+        lib = leveldb._Library(leveldb._SIGNATURES)
+        os.environ["LEVELDB_LIBRARY"] = "/nonexistent/libleveldb.so"
+        try:
+            self.assertRaises(OSError, lib.load)
+            self.assertTrue(lib._lib is None)
+        finally:
+            del os.environ["LEVELDB_LIBRARY"]
+        lib.load()
+        self.assertTrue(lib.leveldb_options_create())
+
+    def testUnknownBackend(self):
+        proxy = leveldb._BackendProxy()
+        self.assertRaises(ValueError, proxy.select, "bogus")
+        self.assertTrue(proxy._backend is None)
+        self.assertEqual(proxy.select("ctypes").name, "ctypes")
+        proxy.reset()
+
+    def testBackendSelection(self):
+        environ = dict((name, os.environ.pop(name)) for name in
+                       ("LEVELDB_BACKEND", "LEVELDB_CFFI_MODULE")
+                       if name in os.environ)
+        try:
+            self._checkBackendSelection()
+        finally:
+            os.environ.update(environ)
+
+    def _checkBackendSelection(self):
+        proxy = leveldb._BackendProxy()
+        self.assertEqual(proxy.select().name, "ctypes")
+        proxy.reset()
+        self.assertEqual(proxy.select("ctypes").name, "ctypes")
+        self.assertEqual(proxy.select("cffi").name, "ctypes")
+        proxy.reset()
+        self.assertTrue(proxy._backend is None)
+        try:
+            import cffi  # pylint: disable=F0401,W0612
+        except ImportError:
+            return
+        backend = proxy.select("cffi")
+        self.assertEqual(backend.name, "cffi")
+        self.assertFalse(hasattr(backend._lib, "leveldb_py_iter_read"))
+        proxy.reset()
+        self.assertRaises(ImportError, proxy.select, "cffi", None,
+                          "/nonexistent/_leveldb_cffi.so")
+        module = cffiModule()
+        if module is not None:
+            backend = proxy.select("cffi", None, module)
+            self.assertTrue(hasattr(backend._lib, "leveldb_py_iter_read"))
+            proxy.reset()
+
+
+class DBPoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = tempfile.mkdtemp()
+        self.pool = leveldb.DBPool(max_open=2, create_if_missing=True,
+                                   cache=leveldb.Cache(1024 * 1024))
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.db_path, ignore_errors=True)
+
+    def testLRUClosing(self):
+        dbs = [self.pool.open(os.path.join(self.db_path, str(i)))
+               for i in xrange(4)]
+        for i, db in enumerate(dbs):
+            db.put("key", str(i))
+        self.assertEqual(self.pool._dbs.keys(), [os.path.join(
+                self.db_path, str(i)) for i in (2, 3)])
+        self.assertEqual([db.get("key") for db in dbs], ["0", "1", "2", "3"])
+        self.assertEqual(len(self.pool._dbs), 2)
+        dbs[0].close()
+        self.assertEqual(list(dbs[0].keys()), ["key"])
+
+    def testBusyDatabasesStayOpen(self):
+        dbs = [self.pool.open(os.path.join(self.db_path, str(i)))
+               for i in xrange(4)]
+        dbs[0].put("key", "0")
+        it = dbs[0].iterator().seekFirst()
+        snapshot = dbs[1].snapshot()
+        for db in dbs[2:]:
+            db.put("key", "x")
+        self.assertEqual(self.pool._dbs.keys(), [os.path.join(
+                self.db_path, str(i)) for i in (0, 1)])
+        self.assertEqual(it.next(), ("key", "0"))
+        self.assertEqual(snapshot.get("key"), None)
+        it.close()
+        del snapshot
+        dbs[3].put("key", "y")
+        self.assertEqual(self.pool._dbs.keys(), [os.path.join(
+                self.db_path, str(i)) for i in (1, 3)])
+
+    def testIdlePooledIteratorsDontPin(self):
+        pool = leveldb.DBPool(max_open=1, create_if_missing=True,
+                              iterator_pool_size=4)
+        dbs = [pool.open(os.path.join(self.db_path, str(i)))
+               for i in xrange(2)]
+        dbs[0].put("key", "0")
+        self.assertEqual(list(dbs[0].keys()), ["key"])
+        dbs[1].put("key", "1")
+        self.assertEqual(pool._dbs.keys(), [os.path.join(self.db_path, "1")])
+        snapshot = dbs[1].snapshot()
+        self.assertEqual(list(dbs[1].keys()), ["key"])
+        iterators = pool._dbs.values()[0].impl._iterators
+        self.assertEqual(len(iterators.idleRefs()), 1)
+        dbs[0].put("key", "2")
+        self.assertEqual(pool._dbs.keys(), [os.path.join(self.db_path, "1")])
+        self.assertEqual(len(iterators.idleRefs()), 1)
+        snapshot.close()
+        pool.close()
+
+    def testConcurrentOpens(self):
+        db = self.pool.open(os.path.join(self.db_path, "0"))
+        missing = self.pool.open(os.path.join(self.db_path, "missing", "x"))
+        errors = []
+
+        def run(i):
+            try:
+                db.put(str(i), str(i))
+                missing.get("key")
+            except leveldb.Error:
+                errors.append(i)
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(errors), range(8))
+        self.assertEqual(len(list(db.keys())), 8)
+        self.assertEqual(self.pool._dbs.keys(), [os.path.join(
+                self.db_path, "0")])
+
+
+class InfoLogTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_path, ignore_errors=True)
+
+    def testParsing(self):
+        log = leveldb.InfoLog(self.db_path, poll_interval=None)
+        self.assertEqual(log.poll(), [])
+        with open(os.path.join(self.db_path, "LOG"), "w") as f:
+            f.write(
+                    "2013/01/02-03:04:05.000000 7f01 Delete type=3 #1\n"
+                    "2013/01/02-03:04:05.100000 7f00 Current memtable full; "
+                    "waiting...\n"
+                    "2013/01/02-03:04:05.200000 7f01 Level-0 table #5: "
+                    "started\n"
+                    "2013/01/02-03:04:05.250000 7f00 Current memtable full; "
+                    "waiting...\n"
+                    "2013/01/02-03:04:05.700000 7f01 Level-0 table #5: "
+                    "1234 bytes OK\n"
+                    "2013/01/02-03:04:06.000000 7f00 Too many L0 files; "
+                    "waiting...\n"
+                    "2013/01/02-03:04:06.000000 7f01 Compacting 4@0 + 2@1 "
+                    "files\n"
+                    "2013/01/02-03:04:06.500000 7f01 Generated table #9@0: "
+                    "10 keys, 500 bytes\n"
+                    "2013/01/02-03:04:07.000000 7f01 Generated table #10@0: "
+                    "5 keys, 300 bytes\n"
+                    "2013/01/02-03:04:07.")
+        log = leveldb.InfoLog(self.db_path, poll_interval=None,
+                              from_start=True)
+        events = [(e.kind, e.duration and round(e.duration, 3), e.level,
+                   e.bytes, e.keys) for e in log.poll()]
+        self.assertEqual(events, [
+                ("flush_start", None, 0, None, None),
+                ("flush", 0.5, 0, 1234, None),
+                ("stall", 0.6, None, None, None),
+                ("compaction_start", None, 0, None, None)])
+        with open(os.path.join(self.db_path, "LOG"), "a") as f:
+            f.write("250000 7f01 Compacted 4@0 + 2@1 files => 800 bytes\n")
+        events = log.poll()
+        self.assertEqual([(e.kind, e.duration, e.level, e.bytes, e.keys)
+                          for e in events],
+                         [("compaction", 1.25, 0, 800, 15),
+                          ("stall", 1.25, 0, None, None)])
+        self.assertEqual(events[0].time,
+                         time.mktime((2013, 1, 2, 3, 4, 6, 0, 0, -1)))
+        log.close()
+
+    def testDatabaseEvents(self):
+        events = []
+        log = leveldb.InfoLog(self.db_path, callback=events.append,
+                              poll_interval=0.01)
+        for _ in xrange(2):
+            db = leveldb.DB(self.db_path, create_if_missing=True,
+                            write_buffer_size=64 * 1024)
+            for i in xrange(5000):
+                db.put("%08d" % i, "x" * 100)
+            db.compactRange(None, None)
+            db.close()
+        log.close()
+        flushes = [e for e in events if e.kind == "flush"]
+        compactions = [e for e in events if e.kind == "compaction"]
+        self.assertTrue(len(flushes) > 4)
+        self.assertTrue(compactions)
+        for event in flushes + compactions:
+            self.assertTrue(event.bytes > 0)
+            self.assertTrue(event.duration >= 0)
+        self.assertEqual(max(e.keys for e in compactions), 5000)
+        self.assertEqual(log.poll(), [])
+
+    def testCallbackErrors(self):
+        events = []
+
+        def callback(event):
+            events.append(event)
+            if len(events) == 1:
+                raise ValueError("callback failed")
+
+        log = leveldb.InfoLog(self.db_path, callback=callback,
+                              poll_interval=0.01)
+        with open(os.path.join(self.db_path, "LOG"), "w") as f:
+            f.write("2013/01/02-03:04:05.000000 7f01 Level-0 table #5: "
+                    "started\n"
+                    "2013/01/02-03:04:05.500000 7f01 Level-0 table #5: "
+                    "1234 bytes OK\n")
+        for _ in xrange(100):
+            if len(events) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual([e.kind for e in events], ["flush_start", "flush"])
+        self.assertTrue(log._thread.is_alive())
+        self.assertRaises(ValueError, log.poll)
+        with open(os.path.join(self.db_path, "LOG"), "a") as f:
+            f.write("2013/01/02-03:04:06.000000 7f01 Level-0 table #6: "
+                    "started\n")
+        for _ in xrange(100):
+            if len(events) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(events[-1].kind, "flush_start")
+        log.close()
+
+
 class MemLevelDBTestCases(LevelDBTestCasesMixIn, unittest.TestCase):
 
     db_class = staticmethod(leveldb.MemoryDB)
 
+    def testApproximateSizes(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.put("a1", "123")
+        db.put("b1", "12345")
+        db.put("b2", "1")
+        self.assertEqual(db.approximateDiskSizes(("a", "b"), ("b", "c"),
+                ("c", "d")), [5, 10, 0])
+        self.assertEqual(db.scope("b").approximateDiskSizes(("1", "2")), [7])
+        self.assertEqual(db.approximateSize(), 15)
+        self.assertEqual(db.approximateSize("b"), 10)
+        self.assertEqual(db.scope("b").approximateSize("2"), 3)
+
+    def testApproximateCount(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        for i in xrange(5000):
+            db.put("k%05d" % i, "v" * (i * 37 % 50))
+        estimate = db.approximateCount(samples=50)
+        self.assertTrue(estimate.low <= estimate.value <= estimate.high)
+        self.assertTrue(2500 < estimate.value < 10000)
+        estimate = db.scope("k01").approximateCount(samples=50)
+        self.assertTrue(500 < estimate.value < 2000)
+
+
+class RemoteDBTestMixIn(object):
+
+    """Runs the test cases against a RemoteDB connected to a DBServer. A tiny
+    iterator chunk size makes sure iteration crosses chunk boundaries."""
+
+    def setUp(self):
+        super(RemoteDBTestMixIn, self).setUp()
+        self.servers = []
+
+    def tearDown(self):
+        for server, db in self.servers:
+            server.close()
+            db.close()
+        super(RemoteDBTestMixIn, self).tearDown()
+
+    def db_class(self, path, **kwargs):
+        db = leveldb.DB(path, **kwargs)
+        server = leveldb.DBServer(db, os.path.join(path, "server.sock"))
+        self.servers.append((server.start(), db))
+        return leveldb.RemoteDB(server.path, iterator_chunk_size=3)
+
+
+class RemoteLevelDBTestCases(RemoteDBTestMixIn, LevelDBTestCasesMixIn,
+                             unittest.TestCase):
+
+    def testSharedServer(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        other = leveldb.RemoteDB(os.path.join(self.db_path, "server.sock"))
+        for i in xrange(10):
+            db.put("%02d" % i, str(i))
+        self.assertEqual(other.get("05"), "5")
+        other.delete("05")
+        self.assertEqual(db.get("05"), None)
+        self.assertEqual([row.key for row in other.iterator().seekLast(
+                ).range("03", "07")], ["03", "04", "06"])
+        other.close()
+        self.assertRaises(leveldb.Error, other.get, "01")
+        self.assertEqual(db.get("01"), "1")
+        db.close()
+
+    def testSnapshotOfSnapshot(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.putStream("b", StringIO.StringIO("data"))
+        snapshot = db.snapshot()
+        with snapshot.openStream("b") as blob:
+            self.assertEqual(blob.read(), "data")
+        self.assertEqual(snapshot.scope("x/").deleteRange(), 0)
+        with snapshot.openStream("b") as blob:
+            self.assertEqual(blob.read(), "data")
+        inner = snapshot.snapshot()
+        snapshot.close()
+        self.assertRaises(leveldb.Error, inner.get, "b")
+        db.close()
+
+    def testSharedTransactions(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        path = os.path.join(self.db_path, "server.sock")
+        db.put("a", "0")
+        txn = db.transaction()
+        self.assertEqual(txn.get("a"), "0")
+        txn.put("b", "1")
+        other = leveldb.RemoteDB(path)
+        other.update("a", lambda val: "1")
+        other.update("a", lambda val: "0")
+        self.assertRaises(leveldb.TransactionConflict, txn.commit)
+        other.close()
+
+        def count(i):
+            client = leveldb.RemoteDB(path).scope("n/")
+            for _ in xrange(20):
+                if i % 2:
+                    client.update("a", lambda val: str(int(val or "0") + 1))
+                else:
+                    client.transact(lambda txn: txn.put(
+                            "a", str(int(txn.get("a") or "0") + 1)),
+                            retries=1000)
+            client.close()
+
+        threads = [threading.Thread(target=count, args=(i,))
+                   for i in xrange(4)]
+        threads.append(threading.Thread(target=lambda: [
+                self.servers[-1][1].update("n/a",
+                        lambda val: str(int(val or "0") + 1))
+                for _ in xrange(20)]))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(db.get("n/a"), "100")
+        db.close()
+
+    def testSharedCodecScope(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        path = os.path.join(self.db_path, "server.sock")
+        codec = leveldb.ZlibCodec()
+        scoped_db = db.scope("c/", value_codec=codec)
+        scoped_db.put("a", "0")
+        txn = scoped_db.transaction()
+        self.assertEqual(txn.get("a"), "0")
+        txn.put("b", "1")
+        other = leveldb.RemoteDB(path)
+        other.scope("c/", value_codec=codec).put("a", "1")
+        self.assertRaises(leveldb.TransactionConflict, txn.commit)
+        other.close()
+
+        def count(i):
+            client = leveldb.RemoteDB(path)
+            scoped = client.scope("c/", value_codec=codec)
+            for _ in xrange(50):
+                if i % 2:
+                    scoped.update("n", lambda val: str(int(val or "0") + 1))
+                else:
+                    scoped.transact(lambda txn: txn.put(
+                            "n", str(int(txn.get("n") or "0") + 1)),
+                            retries=1000)
+            client.close()
+
+        threads = [threading.Thread(target=count, args=(i,))
+                   for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scoped_db.get("n"), "200")
+        self.assertEqual(codec.decode(db.get("c/n")), "200")
+        db.close()
+
+    def testPipelinedWrites(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        client = db._impl._client
+        requests = [(leveldb._OP_PUT, ["\x00", str(i), str(i)])
+                    for i in xrange(100)]
+        requests.append((leveldb._OP_GET, [None, "\x02", "42", "100"]))
+        self.assertEqual(client.callMany(requests)[-1], ["42", None])
+        self.assertEqual(len(list(db.keys())), 100)
+        self.assertRaises(TypeError, db.snapshot().put, "a", "b")
+        db.close()
+
+    def testConcurrentCallsShareRoundTrips(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batches = []
+        commit = leveldb._DBRequestHandler._commit
+
+        def countingCommit(handler, batch, ops, sync, error=None):
+            batches.append(ops)
+            return commit(handler, batch, ops, sync, error)
+
+        def write(i):
+            for j in xrange(100):
+                key = "%d-%03d" % (i, j)
+                db.put(key, key)
+                self.assertEqual(db.get(key), key)
+
+        leveldb._DBRequestHandler._commit = countingCommit
+        try:
+            threads = [threading.Thread(target=write, args=(i,))
+                       for i in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            leveldb._DBRequestHandler._commit = commit
+        self.assertEqual(len(list(db.keys())), 800)
+        self.assertEqual(sum(batches), 800)
+        self.assertTrue(max(batches) > 1, batches)
+        db.close()
+
+    def testMalformedWrites(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        client = db._impl._client
+        self.assertRaises(leveldb.Error, client.callMany, [
+                (leveldb._OP_PUT, ["\x00", "a", "1"]),
+                (leveldb._OP_WRITE, ["\x00", leveldb._UINT64.pack(5), "b"]),
+                (leveldb._OP_PUT, ["\x00", "c"])])
+        self.assertEqual(db.getMany(["a", "b", "c"]), [None, None, None])
+        db.put("a", "1")
+        self.assertEqual(db.get("a"), "1")
+        db.close()
+
+    def testImmediateReleases(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.put("a", "1")
+        it = db.iterator().seekFirst()
+        snapshot = db.snapshot()
+        it.close()
+        del snapshot
+        self.assertEqual(db._impl._client._releases, [])
+        db.close()
+
+    def testSocketInUse(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        path = os.path.join(self.db_path, "server.sock")
+        self.assertRaises(leveldb.Error, leveldb.DBServer, leveldb.MemoryDB(),
+                          path)
+        db.put("a", "1")
+        self.assertEqual(db.get("a"), "1")
+        db.close()
+        server, served = self.servers.pop()
+        server.close()
+        served.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        leveldb.DBServer(leveldb.MemoryDB(), path).close()
+
+    def testIteratorDirectionChanges(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        for i in xrange(10):
+            db.put(str(i), str(i))
+        it = db.iterator().seek("4")
+        self.assertEqual([it.next().key for _ in xrange(4)],
+                ["4", "5", "6", "7"])
+        self.assertEqual([it.prev().key for _ in xrange(6)],
+                ["8", "7", "6", "5", "4", "3"])
+        it.seekLast()
+        self.assertEqual([it.prev().key for _ in xrange(10)],
+                [str(i) for i in xrange(9, -1, -1)])
+        self.assertFalse(it.valid())
+        it.close()
+        db.close()
+
+
+def shardedDB(path, **kwargs):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return leveldb.ShardedDB([os.path.join(path, str(i)) for i in xrange(3)],
+                             **kwargs)
+
+
+class ShardedLevelDBTestCases(LevelDBTestCasesMixIn, unittest.TestCase):
+
+    db_class = staticmethod(shardedDB)
+
+    def testRangePartition(self):
+        paths = [os.path.join(self.db_path, str(i)) for i in xrange(3)]
+        db = leveldb.ShardedDB(paths, partition="range",
+                               boundaries=["b", "d"], create_if_missing=True)
+        batch = leveldb.WriteBatch()
+        for key in ["a1", "b1", "c1", "d1", "e1"]:
+            batch.put(key, key.upper())
+        db.write(batch)
+        self.assertEqual(list(db.keys()), ["a1", "b1", "c1", "d1", "e1"])
+        self.assertEqual(db.getMany(["e1", "a1", "c1", "x"]),
+                ["E1", "A1", "C1", None])
+        db.close()
+        shards = [leveldb.DB(path) for path in paths]
+        self.assertEqual([list(shard.keys()) for shard in shards],
+                [["a1"], ["b1", "c1"], ["d1", "e1"]])
+        for shard in shards:
+            shard.close()
+
+    def testBadPartition(self):
+        paths = [os.path.join(self.db_path, str(i)) for i in xrange(3)]
+        self.assertRaises(ValueError, leveldb.ShardedDB, [])
+        self.assertRaises(ValueError, leveldb.ShardedDB, paths,
+                          partition="range", boundaries=["b"])
+        self.assertRaises(ValueError, leveldb.ShardedDB, paths,
+                          partition="range", boundaries=["d", "b"])
+        self.assertRaises(ValueError, leveldb.ShardedDB, paths,
+                          partition="modulo")
+
+    def testHashPartitionSpreadsKeys(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        batch = leveldb.WriteBatch()
+        for i in xrange(300):
+            batch.put("%03d" % i, str(i))
+        db.write(batch)
+        self.assertEqual(list(db.keys()), ["%03d" % i for i in xrange(300)])
+        self.assertEqual([row.key for row in db.iterator().seekLast().range(
+                "100", "105")], ["100", "101", "102", "103", "104"])
+        db.close()
+        for i in xrange(3):
+            shard = leveldb.DB(os.path.join(self.db_path, str(i)))
+            self.assertTrue(50 < len(list(shard.keys())) < 150)
+            shard.close()
+
+    def testWritesDontStartThreads(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        started = []
+        start = threading.Thread.start
+        threading.Thread.start = lambda thread: (started.append(thread),
+                                                 start(thread))
+        try:
+            for i in xrange(20):
+                batch = leveldb.WriteBatch()
+                for j in xrange(i * 50):
+                    batch.put("%02d-%04d" % (i, j), str(j))
+                db.write(batch, sync=(i % 2 == 0))
+        finally:
+            threading.Thread.start = start
+        self.assertEqual(started, [])
+        self.assertEqual(len(list(db.keys())), sum(xrange(20)) * 50)
+        db.close()
+
+
+def codecDB(path, **kwargs):
+    return leveldb.DB(path, value_codec=leveldb.ZlibCodec(["value"]),
+                      **kwargs)
+
+
+class CodecLevelDBTestCases(LevelDBTestCasesMixIn, unittest.TestCase):
+
+    db_class = staticmethod(codecDB)
+
+    def testValueCodec(self):
+        self.skipTest("needs a database without a codec to see raw values")
+
+    def testValueCodecOverPlainValues(self):
+        self.skipTest("needs a database without a codec to see raw values")
+
+
+def bufferedDB(path, **kwargs):
+    return leveldb.BufferedDB(leveldb.DB(path, **kwargs), max_bytes=64,
+                              flush_interval=None)
+
+
+class BufferedLevelDBTestCases(LevelDBTestCasesMixIn, unittest.TestCase):
+
+    db_class = staticmethod(bufferedDB)
+
+    def testBufferedWrites(self):
+        db = leveldb.DB(self.db_path, create_if_missing=True)
+        db.put("a", "1")
+        db.put("c", "3")
+        buffered = leveldb.BufferedDB(db, flush_interval=None)
+        buffered.put("b", "2")
+        buffered.delete("c")
+        buffered.scope("d").put("x", "4")
+        self.assertEqual(db.get("b"), None)
+        self.assertEqual(db.get("c"), "3")
+        self.assertEqual(buffered.get("c"), None)
+        self.assertEqual(buffered.getMany(["a", "b", "c"]), ["1", "2", None])
+        self.assertEqual(list(buffered.keys()), ["a", "b", "dx"])
+        it = buffered.iterator()
+        it.seekLast()
+        self.assertEqual([it.prev().key for _ in xrange(3)],
+                         ["dx", "b", "a"])
+        self.assertEqual(it.seek("c").key(), "dx")
+        it.close()
+        buffered.flush()
+        self.assertEqual(list(db.keys()), ["a", "b", "dx"])
+        buffered.put("e", "5", sync=True)
+        self.assertEqual(db.get("e"), "5")
+        buffered.delete("a")
+        self.assertEqual(list(buffered.snapshot().keys()),
+                         ["b", "dx", "e"])
+        self.assertEqual(db.get("a"), None)
+        self.assertRaises(ValueError, leveldb.BufferedDB, db.scope("d"))
+        buffered.put("f", "6")
+        buffered.close()
+        db = leveldb.DB(self.db_path)
+        self.assertEqual(db.get("f"), "6")
+        db.close()
+
+    def testPeriodicFlush(self):
+        db = leveldb.DB(self.db_path, create_if_missing=True)
+        buffered = leveldb.BufferedDB(db, flush_interval=0.01)
+        buffered.put("a", "1")
+        for _ in xrange(100):
+            if db.get("a") is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(db.get("a"), "1")
+        buffered.close()
+
+    def testOverwriteSize(self):
+        db = leveldb.DB(self.db_path, create_if_missing=True)
+        buffered = leveldb.BufferedDB(db, max_bytes=16, flush_interval=None)
+        for i in xrange(20):
+            buffered.put("a", str(i % 10))
+            buffered.delete("b")
+        self.assertEqual(db.get("a"), None)
+        self.assertEqual(buffered.get("a"), "9")
+        buffered.put("c", "x" * 16)
+        self.assertEqual(db.get("a"), "9")
+        buffered.close()
+
+    def testPeriodicFlushError(self):
+        db = leveldb.DB(self.db_path, create_if_missing=True)
+        buffered = leveldb.BufferedDB(db, flush_interval=0.01)
+        impl = buffered._impl
+        impl._db = FailingWrites(impl._db)
+        buffered.put("a", "1")
+        for _ in xrange(100):
+            if impl._error is not None:
+                break
+            time.sleep(0.01)
+        self.assertRaises(leveldb.Error, buffered.put, "b", "2")
+        self.assertTrue(impl._thread.is_alive())
+        buffered.put("b", "2")
+        buffered.flush()
+        self.assertEqual(db.getMany(["a", "b"]), ["1", "2"])
+        buffered.close()
+
+
+class FailingWrites(object):
+
+    """Wraps a database, or its implementation, and fails its next write."""
+
+    def __init__(self, impl):
+        self.impl = impl
+
+    def __getattr__(self, name):
+        return getattr(self.impl, name)
+
+    def write(self, batch, sync=False):
+        self.write = self.impl.write
+        raise leveldb.Error("write failed")
+
+
+_cffi_module = []
+
+
+def cffiModule():
+    """Builds the cffi API mode module once, or returns None if it can't be
+    built here. LEVELDB_INCLUDE_DIR points the build at the LevelDB headers.
+    """
+    if not _cffi_module:
+        path = tempfile.mkdtemp()
+        kwargs = {}
+        if os.environ.get("LEVELDB_INCLUDE_DIR"):
+            kwargs["include_dirs"] = [os.environ["LEVELDB_INCLUDE_DIR"]]
+        try:
+            _cffi_module.append(leveldb.buildCFFIModule(path, **kwargs))
+        except Exception:
+            _cffi_module.append(None)
+    return _cffi_module[0]
+
+
+class BackendTestMixIn(object):
+
+    """Runs the test cases on a particular backend instead of the default.
+    If cffi_module is true, the cffi backend uses the API mode module."""
+
+    backend = None
+    cffi_module = False
+
+    def setUp(self):
+        super(BackendTestMixIn, self).setUp()
+        module = None
+        if self.backend == "cffi":
+            try:
+                import cffi  # pylint: disable=F0401,W0612
+            except ImportError:
+                self.skipTest("cffi is not installed")
+            if self.cffi_module:
+                module = cffiModule()
+                if module is None:
+                    self.skipTest("the cffi module can't be built")
+        self.default_backend = leveldb._backend
+        leveldb._backend = leveldb._BackendProxy()
+        leveldb._backend.select(self.backend, None, module)
+
+    def tearDown(self):
+        backend, leveldb._backend = leveldb._backend, self.default_backend
+        backend.reset()
+        super(BackendTestMixIn, self).tearDown()
+
+
+class CTypesLevelDBTestCases(BackendTestMixIn, LevelDBTestCasesMixIn,
+                             unittest.TestCase):
+
+    db_class = staticmethod(leveldb.DB)
+    backend = "ctypes"
+
+
+class CFFILevelDBTestCases(BackendTestMixIn, LevelDBTestCasesMixIn,
+                           unittest.TestCase):
+
+    db_class = staticmethod(leveldb.DB)
+    backend = "cffi"
+
+
+class CFFIModuleLevelDBTestCases(BackendTestMixIn, LevelDBTestCasesMixIn,
+                                 unittest.TestCase):
+
+    db_class = staticmethod(leveldb.DB)
+    backend = "cffi"
+    cffi_module = True
+
 
 class LevelDBIteratorTestMixIn(object):
 
@@ -572,6 +2195,20 @@ class LevelDBIteratorTestMixIn(object):
         self.assertRaises(StopIteration, iterator.next)
         db.close()
 
+    def test_item(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        db.put('ba', '1')
+        db.put('bb', '2')
+        db.put('c', '3')
+        iterator = db.iterator(prefix='b').seekFirst()
+        self.assertEqual(iterator.item(), ('a', '1'))
+        self.assertEqual(iterator.item().value, '1')
+        iterator.stepForward()
+        self.assertEqual(iterator.item(), ('b', '2'))
+        self.assertEqual(iterator.prev(), ('b', '2'))
+        self.assertEqual(iterator.item(), ('a', '1'))
+        db.close()
+
     def test_multiple_iterators(self):
         """
         Make sure that things work with multiple iterator objects
@@ -729,6 +2366,47 @@ class LevelDBIteratorTestMixIn(object):
                          "3")
         db.close()
 
+    def test_merged_iterator(self):
+        db = self.db_class(self.db_path, create_if_missing=True)
+        scopes = [db.scope("a"), db.scope("b"), db.scope("c")]
+        for i, keys in enumerate(["135", "236", "37"]):
+            for key in keys:
+                scopes[i].put(key, "abc"[i] + key)
+        for batch_size in (None, 2):
+            def merged(duplicates):
+                return leveldb.MergedIterator(
+                        [scope.iterator() for scope in scopes],
+                        duplicates=duplicates, batch_size=batch_size)
+            self.assertEqual(list(merged("first").seekFirst()),
+                    [("1", "a1"), ("2", "b2"), ("3", "a3"), ("5", "a5"),
+                     ("6", "b6"), ("7", "c7")])
+            self.assertEqual(dict(list(merged("last").seekFirst()))["3"], "c3")
+            everything = [("1", "a1"), ("2", "b2"), ("3", "a3"), ("3", "b3"),
+                          ("3", "c3"), ("5", "a5"), ("6", "b6"), ("7", "c7")]
+            self.assertEqual(list(merged("all").seekFirst()), everything)
+            it = merged("all").seekLast()
+            self.assertEqual([it.prev() for _ in everything],
+                    everything[::-1])
+            self.assertFalse(it.valid())
+            it = merged("all").seek("3")
+            self.assertEqual([it.next(), it.next()], everything[2:4])
+            self.assertEqual([it.prev(), it.prev(), it.prev(), it.next()],
+                    [everything[4], everything[3], everything[2],
+                     everything[1]])
+            it = merged("first").seek("4")
+            self.assertEqual(it.next(), ("5", "a5"))
+            self.assertEqual([it.prev(), it.prev(), it.next()],
+                    [("6", "b6"), ("5", "a5"), ("3", "a3")])
+            self.assertEqual([row.key for row in merged("last").range(
+                    "2", "6")], ["2", "3", "5"])
+            self.assertEqual(list(leveldb.MergedIterator(
+                    [scopes[0].iterator(), scopes[1].iterator()],
+                    keys_only=True).seekFirst()), ["1", "2", "3", "5", "6"])
+            merged("first").close()
+        self.assertRaises(ValueError, leveldb.MergedIterator,
+                          [db.iterator()], duplicates="any")
+        db.close()
+
     def test_scoped_then_iterate(self):
         db = self.db_class(os.path.join(self.db_path, "1"),
                 create_if_missing=True)
@@ -775,11 +2453,50 @@ class LevelDBIteratorTest(LevelDBIteratorTestMixIn, unittest.TestCase):
         db.close()
 
 
+class CTypesLevelDBIteratorTest(BackendTestMixIn, LevelDBIteratorTestMixIn,
+                                unittest.TestCase):
+
+    db_class = staticmethod(leveldb.DB)
+    backend = "ctypes"
+
+
+class CFFILevelDBIteratorTest(BackendTestMixIn, LevelDBIteratorTestMixIn,
+                              unittest.TestCase):
+
+    db_class = staticmethod(leveldb.DB)
+    backend = "cffi"
+
+
+class CFFIModuleLevelDBIteratorTest(BackendTestMixIn, LevelDBIteratorTestMixIn,
+                                    unittest.TestCase):
+
+    db_class = staticmethod(leveldb.DB)
+    backend = "cffi"
+    cffi_module = True
+
+
 class MemLevelDBIteratorTest(LevelDBIteratorTestMixIn, unittest.TestCase):
 
     db_class = staticmethod(leveldb.MemoryDB)
 
 
+class ShardedLevelDBIteratorTest(LevelDBIteratorTestMixIn,
+                                 unittest.TestCase):
+
+    db_class = staticmethod(shardedDB)
+
+
+class BufferedLevelDBIteratorTest(LevelDBIteratorTestMixIn,
+                                  unittest.TestCase):
+
+    db_class = staticmethod(bufferedDB)
+
+
+class RemoteLevelDBIteratorTest(RemoteDBTestMixIn, LevelDBIteratorTestMixIn,
+                                unittest.TestCase):
+    pass
+
+
 def main():
     parser = argparse.ArgumentParser("run tests")
     parser.add_argument("--runs", type=int, default=1)